@@ -7,14 +7,24 @@ and execute it remotely on Cloud Kotta.
 """
 import logging
 from kotta.kotta import Kotta
-from kotta.kotta_job import KottaJob
-from kotta.kotta_functions import kottajob, KottaFn
+from kotta.kotta_job import KottaJob, KottaJobError, PollPolicy
+from kotta.kotta_functions import kottajob, KottaFn, KottaMapError
+from kotta.kotta_async import AsyncKotta, AsyncKottaJob
+from kotta.kotta_cache import UploadCache, StatusCache, ResultCache
+from kotta.kotta_monitor import JobMonitor
+from kotta.kotta_future import KottaFuture
+from kotta.kotta_env import EnvBundle
+from kotta.kotta_runtime import RuntimeBundle
+from kotta.kotta_backends import KottaBackend, RemoteBackend, LocalBackend, RoutingBackend
 
 
 __author__  = 'Yadu Nand Babuji'
 __version__ = '0.1.0'
 
-__all__ = ['Kotta', 'KottaJob', 'KottaFn', 'kottajob']
+__all__ = ['Kotta', 'KottaJob', 'KottaJobError', 'PollPolicy', 'KottaFn', 'KottaMapError',
+           'kottajob', 'KottaFuture', 'AsyncKotta', 'AsyncKottaJob', 'UploadCache', 'StatusCache',
+           'ResultCache', 'JobMonitor', 'EnvBundle', 'RuntimeBundle', 'KottaBackend',
+           'RemoteBackend', 'LocalBackend', 'RoutingBackend']
 
 
 def set_stream_logger(name='kotta', level=logging.DEBUG, format_string=None):
@@ -7,9 +7,20 @@ functions such as submit, cancel, status.
 import os
 import json
 import logging
+import time
+import uuid
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .kotta_upload import UploadReader, MultipartUpload, BufferFile
+from .kotta_urlpool import UploadUrlPool
+from .kotta_monitor import JobMonitor
 
 
 logger  = logging.getLogger(__name__)
@@ -19,37 +30,138 @@ class Kotta(object):
     This class connects to the Kotta system. It keeps track of the credentials
     and provides means to submit and track kotta jobs.
     """
-    __server_url = "http://ec2-52-2-217-165.compute-1.amazonaws.com:8888"
-    __submit_url = __server_url + "/rest/v1/submit_task"
-    __status_url = __server_url + "/rest/v1/status_task"
-    __cancel_url = __server_url + "/rest/v1/cancel_task"
-    __list_url   = __server_url + "/rest/v1/list_tasks"
-    __upload_url = __server_url + "/rest/v1/upload_url"
+    server_url = "http://ec2-52-2-217-165.compute-1.amazonaws.com:8888"
+
+    # REST endpoints relative to server_url
+    endpoints  = {'submit'     : "/rest/v1/submit_task",
+                  'status'     : "/rest/v1/status_task",
+                  'cancel'     : "/rest/v1/cancel_task",
+                  'list'       : "/rest/v1/list_tasks",
+                  'upload_url' : "/rest/v1/upload_url"}
+
+    # (connect, read) timeouts in seconds for each endpoint. Override any of these
+    # with the timeouts kwarg to __init__
+    default_timeouts = {'submit'     : (3.05, 60),
+                        'status'     : (3.05, 30),
+                        'upload_url' : (3.05, 30),
+                        'upload'     : (3.05, 300)}
 
     # __init__ expects a string for creds
-    def __init__(self, creds):
+    def __init__(self, creds, pool_size=10, max_retries=3, backoff_factor=0.5, timeouts=None,
+                 server_url=None, multipart_threshold=64*1024*1024, part_size=16*1024*1024,
+                 multipart_workers=4, upload_cache=None, url_prefetch=0, status_cache=None):
+        """ Create a Kotta connection
+
+        Args:
+             - creds (string|dict) : Credentials as a json string or a dict
+
+        Kwargs:
+             - pool_size (int) : Max number of keep-alive connections held per host. Default=10
+             - max_retries (int) : Retries on connection errors and resets. Default=3
+             - backoff_factor (float) : Exponential backoff factor between retries. Default=0.5
+             - timeouts (dict) : Per endpoint (connect, read) timeouts that override
+               Kotta.default_timeouts. Keys are submit, status, upload_url and upload
+             - server_url (string) : Url of the Kotta server. Default=Kotta.server_url
+             - multipart_threshold (int) : Files of at least this many bytes are uploaded in
+               parallel parts, if the server supports it. None disables. Default=64MB
+             - part_size (int) : Size of each part of a multipart upload. Default=16MB
+             - multipart_workers (int) : Parts uploaded concurrently. Default=4
+             - upload_cache (UploadCache) : Skip uploading files whose contents were already
+               uploaded. Default=None, no caching
+             - url_prefetch (int) : Number of signed upload urls to keep ready for
+               reserve_upload. Default=0, urls are requested when needed
+             - status_cache (StatusCache) : Reuse recently fetched job stati, and never
+               refetch jobs in a terminal state. Default=None, no caching
+
+        """
         if isinstance(creds, str):
             self._creds = json.loads(creds)
         elif isinstance(creds, dict):
             self._creds = creds
 
-    def status_task(self, jobid):
-        """ Get the status of the task
+        if server_url:
+            self.server_url = server_url.rstrip('/')
 
-        Args: jobid
+        self.pool_size = pool_size
+        self.multipart_threshold = multipart_threshold
+        self.part_size = part_size
+        self.multipart_workers = multipart_workers
+        self.upload_cache = upload_cache
+        self.url_prefetch = url_prefetch
+        self.status_cache = status_cache
+        self._url_pool = None
+        self._buffer_urls = {}
+        self._lazy_lock = threading.Lock()
+        self._monitor = None
+        self.timeouts = dict(self.default_timeouts)
+        if timeouts:
+            self.timeouts.update(timeouts)
 
-        Returns: A Dict of results if job exists
+        # Retry only idempotent requests on read errors. Connection errors are retried
+        # for all methods since the request never reached the server.
+        retries = Retry(total=max_retries, connect=max_retries, read=max_retries,
+                        status=max_retries, backoff_factor=backoff_factor,
+                        status_forcelist=(502, 503, 504), raise_on_status=False)
 
+        # The adapter owns the urllib3 pool and is shared by the per-thread sessions.
+        self._adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                                    max_retries=retries)
+        self._local = threading.local()
+
+    @property
+    def session(self):
+        """ Returns the requests.Session for the calling thread.
+        Sessions are not guaranteed to be thread-safe, so each thread gets its own,
+        but all of them draw keep-alive connections from the same pool.
         """
-        logger.debug("Status task : %s", jobid)
-        status = {}
-        record = requests.get(self.__status_url + "/{0}".format(jobid))
-        if record.status_code != 200:
-            logging.error("Failed to fetch job, please check jobid")
-            return status
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('http://', self._adapter)
+            session.mount('https://', self._adapter)
+            self._local.session = session
+        return session
 
-        results = record.json()
-        status['status'] = results['status']
+    @property
+    def monitor(self):
+        """ The JobMonitor shared by everything that tracks jobs on this connection,
+        created on first use.
+        """
+        with self._lazy_lock:
+            if self._monitor is None:
+                self._monitor = JobMonitor(self)
+        return self._monitor
+
+    def url(self, endpoint):
+        """ Returns the full url of a REST endpoint
+        """
+        return self.server_url + self.endpoints[endpoint]
+
+    def close(self):
+        """ Close all pooled connections and stop prefetching upload urls
+        """
+        if self._url_pool is not None:
+            self._url_pool.close()
+        if self._monitor is not None:
+            self._monitor.stop()
+        self._adapter.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def parse_status(results):
+        """ Flatten the json record returned by the status endpoint into a status dict
+
+        Args: results, the decoded json record
+
+        Returns: A Dict of job attributes with inputs and outputs as lists
+
+        """
+        status = {'status' : results['status']}
 
         for index in results['items']:
             key_ = list(results['items'][index].keys())[0]
@@ -64,6 +176,96 @@ class Kotta(object):
 
         return status
 
+    def status_task(self, jobid):
+        """ Get the status of the task
+
+        Args: jobid
+
+        Returns: A Dict of results if job exists
+
+        """
+        logger.debug("Status task : %s", jobid)
+        status = self.status_cache.get(jobid) if self.status_cache is not None else None
+        if status is not None:
+            return status
+
+        status = {}
+        record = self.session.get("{0}/{1}".format(self.url('status'), jobid),
+                                  timeout=self.timeouts['status'])
+        if record.status_code != 200:
+            logging.error("Failed to fetch job, please check jobid")
+            return status
+
+        status = self.parse_status(record.json())
+        if self.status_cache is not None:
+            self.status_cache.put(jobid, status)
+        return status
+
+    def _status_or_error(self, jobid):
+        """ Same as status_task, but failures are returned as {'error' : reason}
+        instead of being logged, so that one bad job does not abort a sweep.
+        """
+        status = self.status_cache.get(jobid) if self.status_cache is not None else None
+        if status is not None:
+            return status
+
+        try:
+            record = self.session.get("{0}/{1}".format(self.url('status'), jobid),
+                                      timeout=self.timeouts['status'])
+        except requests.RequestException as e:
+            return {'error' : "Request failed : {0}".format(e)}
+
+        if record.status_code != 200:
+            return {'error' : "Failed to fetch job, HTTP {0}".format(record.status_code)}
+
+        try:
+            status = self.parse_status(record.json())
+        except (ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+            return {'error' : "Malformed status record : {0!r}".format(e)}
+
+        if self.status_cache is not None:
+            self.status_cache.put(jobid, status)
+        return status
+
+    def status_many(self, job_ids, max_workers=None, executor=None):
+        """ Get the status of many tasks concurrently
+
+        Args: job_ids, an iterable of jobids
+
+        Kwargs:
+             - max_workers (int) : Max number of concurrent requests. Default=pool_size
+             - executor (Executor) : Long-lived pool to make the requests from, so that
+               repeated calls reuse its threads and their sessions. max_workers is then
+               ignored. Default=a pool created for this call
+
+        Returns: A Dict keyed by jobid. Each value is the status dict as returned by
+        status_task, or {'error' : reason} if that job could not be fetched or parsed.
+
+        """
+        results = {}
+        missing = []
+        for jobid in dict.fromkeys(job_ids):
+            status = self.status_cache.get(jobid) if self.status_cache is not None else None
+            if status is None:
+                missing.append(jobid)
+            else:
+                results[jobid] = status
+
+        if not missing:
+            return results
+
+        if executor is not None:
+            logger.debug("Status many : %s jobs, %s cached", len(missing), len(results))
+            results.update(zip(missing, executor.map(self._status_or_error, missing)))
+            return results
+
+        workers = min(max_workers or self.pool_size, len(missing))
+        logger.debug("Status many : %s jobs over %s workers, %s cached",
+                     len(missing), workers, len(results))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results.update(zip(missing, executor.map(self._status_or_error, missing)))
+        return results
+
     def submit_task(self, task_desc):
         """ Submit a task
         Args: task_desc which a dictionary
@@ -72,41 +274,228 @@ class Kotta(object):
         """
         task_desc["access_token"]  = self._creds.get("access_token")
         task_desc["refresh_token"] = self._creds.get("refresh_token")
-        res = requests.post(self.__submit_url, data=task_desc)
+        res = self.session.post(self.url('submit'), data=task_desc,
+                                timeout=self.timeouts['submit'])
         return res.json()
 
-    @staticmethod
-    def _upload (url, filepath):
-        os.system("curl --request PUT --upload-file {0} '{1}' ".format(filepath, url))
-        return
+    def _upload(self, url, filepath, hash_upload=False):
+        """ Stream a local file to a signed url with a PUT, see _upload_stream
+        """
+        with open(filepath, 'rb') as infile:
+            return self._upload_stream(url, infile, os.fstat(infile.fileno()).st_size,
+                                       filepath, hash_upload=hash_upload)
+
+    def _upload_stream(self, url, fileobj, length, name, hash_upload=False):
+        """ Stream length bytes of fileobj, from its current position, to a signed url
+        with a PUT
 
-    def upload_file(self, path):
+        Kwargs:
+             - hash_upload (bool) : Also compute the sha256 of the data as it is sent
+
+        Returns: dict with the bytes sent, seconds taken and rate in bytes/sec, and the
+        sha256 digest if hash_upload
+
+        Raises: requests.HTTPError if the upload was not accepted
+
+        """
+        start = time.time()
+        reader = UploadReader(fileobj, length,
+                              hasher=hashlib.sha256() if hash_upload else None)
+        res = self.session.put(url, data=reader, timeout=self.timeouts['upload'])
+
+        if not 200 <= res.status_code < 300:
+            raise requests.HTTPError("Upload of {0} failed with HTTP {1} : {2}".format(
+                name, res.status_code, res.text[:512]), response=res)
+
+        elapsed = max(time.time() - start, 1e-6)
+        stats = {'bytes'   : reader.length,
+                 'seconds' : elapsed,
+                 'rate'    : reader.length / elapsed,
+                 'digest'  : reader.digest}
+        logger.info("Uploaded %s : %s bytes in %.2fs (%.0f bytes/sec)",
+                    name, stats['bytes'], stats['seconds'], stats['rate'])
+        return stats
+
+    def signed_url(self, path, **fields):
+        """ Request a signed upload url for path from Kotta
+
+        Kwargs: extra fields to send with the request
+
+        Returns: (http status code, decoded json response)
+
+        """
+        creds = { "access_token" : self._creds.get("access_token"),
+                  "refresh_token" : self._creds.get("refresh_token"),
+                  "filepath" : path }
+        creds.update(fields)
+
+        req_res = self.session.post(self.url('upload_url'), data=creds,
+                                    timeout=self.timeouts['upload_url'])
+        return req_res.status_code, req_res.json()
+
+    def reserve_upload(self):
+        """ Pick a new, unique path under pkl/ to upload to.
+
+        With url_prefetch enabled the path comes with a signed url from the prefetch pool
+        that can be passed to upload_file, which then skips requesting one.
+
+        Returns: (path, signed url or None)
+
+        """
+        if not self.url_prefetch:
+            return "pkl/{0}.in.pkl".format(uuid.uuid4()), None
+
+        with self._lazy_lock:
+            if self._url_pool is None:
+                self._url_pool = UploadUrlPool(self, size=self.url_prefetch)
+        return self._url_pool.acquire()
+
+    def upload_file(self, path, upload_url=None):
         """ Upload a local file
         Uses temporary creds to request a signed url from Kotta.
         Uploads file to this location. This allows kotta to avoid having to route
         data traffic through our webserver.
 
+        Files above multipart_threshold are uploaded in parallel parts when the server
+        issues part urls, see kotta.kotta_upload.MultipartUpload. An interrupted multipart
+        upload of an unchanged file resumes from the last completed part, or starts over
+        if the urls of its parts have expired.
+
+        With an upload_cache, a file whose contents were uploaded before returns the
+        earlier s3 url without uploading again.
+
         Args: Path to file
 
+        Kwargs:
+             - upload_url (string) : A signed url already issued for path, eg. by
+               reserve_upload. The file is uploaded to it in a single PUT.
+
+        Returns: The s3 url of the uploaded file, or -1 if a signed url was not issued
+
+        Raises: requests.HTTPError if the upload itself fails
+
         """
 
-        # Get a signed url
-        creds = { "access_token" : self._creds.get("access_token"),
-                  "refresh_token" : self._creds.get("refresh_token"),
-                  "filepath" : path }
+        cache  = self.upload_cache
+        digest = None
+        if cache:
+            digest = cache.digest(path)
+            s3_url = digest and cache.get(digest, os.path.getsize(path), path)
+            if s3_url:
+                return s3_url
 
-        req_res = requests.post(self.__upload_url, data=creds)
-        response = req_res.json()
-        if req_res.status_code != 200:
-            print ("ERROR: Failed to upload data :\n {0}".format(response.get('reason', 'Unknown')))
-            return -1
-        else:
-            self._upload(response.get('upload_url'), path)
-            #req_res = requests.put(response.get('upload_url'), files=files )
-            #if req_res.status_code != 200 :
-            #    print("Upload failed due to : \n {0}".format(req_res.text))
-            #    return None
-            parsed =  urlparse(response.get('upload_url')) #.split('?')[0]
-            s3_url =  "s3://{0}{1}".format(parsed.netloc.split('.')[0],
-                                           parsed.path)
+        s3_url, uploaded_digest = self._upload_file(path, upload_url,
+                                                    hash_upload=bool(cache) and not digest)
+        digest = digest or uploaded_digest
+        if cache and digest and s3_url != -1:
+            cache.add(path, digest, s3_url)
         return s3_url
+
+    def upload_fileobj(self, fileobj, path, upload_url=None):
+        """ Upload the contents of a seekable file object, eg. an in-memory buffer, as path.
+        Nothing is written to local disk. The data from the current position of fileobj
+        to its end is sent in a single streaming PUT.
+
+        Args:
+             - fileobj (file) : Seekable binary file object
+             - path (string) : Path the data is uploaded as
+
+        Kwargs:
+             - upload_url (string) : A signed url already issued for path
+
+        Returns: The s3 url of the uploaded data, or -1 if a signed url was not issued
+
+        Raises: requests.HTTPError if the upload itself fails
+
+        """
+        start  = fileobj.tell()
+        fileobj.seek(0, os.SEEK_END)
+        length = fileobj.tell() - start
+        fileobj.seek(start)
+
+        if not upload_url:
+            code, response = self.signed_url(path)
+            if code != 200:
+                print ("ERROR: Failed to upload data :\n {0}".format(
+                    response.get('reason', 'Unknown')))
+                return -1
+            upload_url = response.get('upload_url')
+
+        self._upload_stream(upload_url, fileobj, length, path)
+        return self.s3_url(upload_url)
+
+    def upload_buffer(self, buf, suffix='.buf'):
+        """ Upload a contiguous buffer, eg. the data of a large array, as an object named
+        by the sha256 of its contents. Contents already uploaded by this connection, or
+        found in the upload_cache, are not uploaded again.
+
+        Returns: (name the object is staged as on job nodes, its s3 url). The s3 url is -1
+        if a signed url was not issued.
+
+        Raises: requests.HTTPError if the upload itself fails
+
+        """
+        view   = memoryview(buf).cast('B')
+        digest = hashlib.sha256(view).hexdigest()
+        name   = "{0}{1}".format(digest[:32], suffix)
+
+        with self._lazy_lock:
+            s3_url = self._buffer_urls.get(digest)
+        if s3_url is None and self.upload_cache is not None:
+            s3_url = self.upload_cache.get(digest, len(view), name)
+        if s3_url:
+            return name, s3_url
+
+        s3_url = self.upload_fileobj(BufferFile(view), "pkl/{0}".format(name))
+        if s3_url != -1:
+            with self._lazy_lock:
+                self._buffer_urls[digest] = s3_url
+            if self.upload_cache is not None:
+                self.upload_cache.put(digest, len(view), name, s3_url)
+        return name, s3_url
+
+    def _run_multipart(self, multipart, hash_upload):
+        """ Run a multipart upload. Returns (s3_url, digest combined from its parts if
+        hash_upload)
+        """
+        s3_url = self.s3_url(multipart.run())
+        return s3_url, multipart.digest if hash_upload else None
+
+    def _upload_file(self, path, upload_url=None, hash_upload=False):
+        """ Upload a local file, see upload_file.
+        Returns (s3_url, sha256 of the file if hash_upload and it could be computed)
+        """
+        if upload_url:
+            stats = self._upload(upload_url, path, hash_upload=hash_upload)
+            return self.s3_url(upload_url), stats['digest']
+
+        multipart = None
+        if self.multipart_threshold and os.path.getsize(path) >= self.multipart_threshold:
+            multipart = MultipartUpload(self, path, self.part_size,
+                                        workers=self.multipart_workers)
+            if multipart.resumable:
+                try:
+                    return self._run_multipart(multipart, hash_upload)
+                except requests.HTTPError as e:
+                    if e.response is None or e.response.status_code != 403:
+                        raise
+                    # The part urls expired and the manifest is gone, start over
+                    logger.info("Upload urls of %s expired, restarting its upload", path)
+
+        # Get a signed url
+        code, response = self.signed_url(path, **(multipart.url_request if multipart else {}))
+        if code != 200:
+            print ("ERROR: Failed to upload data :\n {0}".format(response.get('reason', 'Unknown')))
+            return -1, None
+        elif multipart and multipart.start(response):
+            return self._run_multipart(multipart, hash_upload)
+
+        stats = self._upload(response.get('upload_url'), path, hash_upload=hash_upload)
+        return self.s3_url(response.get('upload_url')), stats['digest']
+
+    @staticmethod
+    def s3_url(upload_url):
+        """ Returns the s3://<bucket>/<key> url that a signed upload url points to
+        """
+        parsed =  urlparse(upload_url) #.split('?')[0]
+        return "s3://{0}{1}".format(parsed.netloc.split('.')[0], parsed.path)
@@ -0,0 +1,359 @@
+""" Asyncio counterparts to Kotta and KottaJob.
+
+AsyncKotta talks to the same REST endpoints as Kotta over a pooled aiohttp session, so
+a single event loop can track a large number of in-flight jobs without a thread per job.
+Requires the optional aiohttp package.
+
+"""
+
+import os
+import json
+import pickle
+import asyncio
+import logging
+
+from .kotta import Kotta
+from .kotta_job import KottaJob
+
+logger  = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024*1024
+
+class AsyncKotta(object):
+    """
+    Async version of the Kotta class. All requests are coroutines and share one
+    connection pool of at most pool_size connections.
+    """
+
+    def __init__(self, creds, pool_size=100, max_retries=3, backoff_factor=0.5, timeouts=None,
+                 server_url=None, status_cache=None):
+        """ Create an async Kotta connection
+
+        Args:
+             - creds (string|dict) : Credentials as a json string or a dict
+
+        Kwargs:
+             - pool_size (int) : Max number of concurrent connections. Default=100
+             - max_retries (int) : Retries on connection errors and resets. Default=3
+             - backoff_factor (float) : Exponential backoff factor between retries. Default=0.5
+             - timeouts (dict) : Per endpoint (connect, read) timeouts that override
+               Kotta.default_timeouts
+             - server_url (string) : Url of the Kotta server. Default=Kotta.server_url
+             - status_cache (StatusCache) : Reuse recently fetched job stati. Default=None
+
+        """
+        if isinstance(creds, str):
+            self._creds = json.loads(creds)
+        elif isinstance(creds, dict):
+            self._creds = creds
+
+        self.server_url = (server_url or Kotta.server_url).rstrip('/')
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.timeouts = dict(Kotta.default_timeouts)
+        if timeouts:
+            self.timeouts.update(timeouts)
+        self.status_cache = status_cache
+        self._session = None
+
+    @property
+    def session(self):
+        """ Returns the aiohttp.ClientSession, creating it on first use.
+        Must be called from within the event loop that will use it.
+        """
+        if self._session is None or self._session.closed:
+            import aiohttp
+            connector = aiohttp.TCPConnector(limit=self.pool_size)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    def url(self, endpoint):
+        """ Returns the full url of a REST endpoint
+        """
+        return self.server_url + Kotta.endpoints[endpoint]
+
+    async def close(self):
+        """ Close all pooled connections
+        """
+        if self._session is not None:
+            await self._session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    def _timeout(self, endpoint):
+        import aiohttp
+        connect, read = self.timeouts[endpoint]
+        return aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+
+    @staticmethod
+    def _decode(code, body):
+        """ Decode the json body of a response.
+        Bodies of non-2xx responses that are not a json object, e.g. html error pages,
+        are returned as {'error' : ..., 'reason' : ...} instead of raising.
+        """
+        ok = 200 <= code < 300
+        try:
+            decoded = json.loads(body.decode('utf-8'))
+        except ValueError:
+            if ok:
+                raise
+            decoded = None
+        if ok or isinstance(decoded, dict):
+            return decoded
+        return {'error'  : "HTTP {0}".format(code),
+                'reason' : body.decode('utf-8', 'replace')[:512]}
+
+    async def _request(self, method, url, endpoint, decode=True, retry=True, **kwargs):
+        """ Make a request and return (http_status, body).
+        body is the decoded json if decode, see _decode, else raw bytes.
+
+        Connection failures are retried with exponential backoff. Resets after the
+        request was sent are only retried for idempotent methods.
+        """
+        import aiohttp
+        idempotent = method in ('GET', 'PUT', 'HEAD')
+        attempts = self.max_retries + 1 if retry else 1
+        for attempt in range(attempts):
+            try:
+                async with self.session.request(method, url, timeout=self._timeout(endpoint),
+                                                **kwargs) as resp:
+                    body = await resp.read()
+                    if decode:
+                        body = self._decode(resp.status, body)
+                    return resp.status, body
+
+            except aiohttp.ClientConnectorError:
+                if attempt == attempts - 1:
+                    raise
+
+            except (aiohttp.ServerDisconnectedError, aiohttp.ClientOSError):
+                if not idempotent or attempt == attempts - 1:
+                    raise
+
+            delay = self.backoff_factor * (2 ** attempt)
+            logger.debug("Retrying %s %s in %.2fs", method, url, delay)
+            await asyncio.sleep(delay)
+
+    async def status_task(self, jobid):
+        """ Get the status of the task
+
+        Args: jobid
+
+        Returns: A Dict of results if job exists
+
+        """
+        logger.debug("Status task : %s", jobid)
+        status = self.status_cache.get(jobid) if self.status_cache is not None else None
+        if status is not None:
+            return status
+
+        code, results = await self._request('GET', "{0}/{1}".format(self.url('status'), jobid),
+                                            'status')
+        if code != 200:
+            logger.error("Failed to fetch job, please check jobid")
+            return {}
+
+        status = Kotta.parse_status(results)
+        if self.status_cache is not None:
+            self.status_cache.put(jobid, status)
+        return status
+
+    async def _status_or_error(self, jobid):
+        """ Same as status_task, but failures are returned as {'error' : reason}
+        """
+        import aiohttp
+        status = self.status_cache.get(jobid) if self.status_cache is not None else None
+        if status is not None:
+            return status
+
+        try:
+            code, results = await self._request('GET',
+                                                "{0}/{1}".format(self.url('status'), jobid),
+                                                'status')
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            return {'error' : "Request failed : {0!r}".format(e)}
+        except ValueError as e:
+            return {'error' : "Malformed status response : {0!r}".format(e)}
+
+        if code != 200:
+            return {'error' : "Failed to fetch job, HTTP {0}".format(code)}
+
+        try:
+            status = Kotta.parse_status(results)
+        except (ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+            return {'error' : "Malformed status record : {0!r}".format(e)}
+
+        if self.status_cache is not None:
+            self.status_cache.put(jobid, status)
+        return status
+
+    async def status_many(self, job_ids):
+        """ Get the status of many tasks concurrently
+
+        Returns: A Dict keyed by jobid, with {'error' : reason} for jobs that could not
+        be fetched. Concurrency is bounded by pool_size.
+
+        """
+        job_ids = list(dict.fromkeys(job_ids))
+        stati = await asyncio.gather(*[self._status_or_error(jobid) for jobid in job_ids])
+        return dict(zip(job_ids, stati))
+
+    async def submit_task(self, task_desc):
+        """ Submit a task
+        Args: task_desc which a dictionary
+        Returns: The json object returned from Kotta
+
+        """
+        task_desc["access_token"]  = self._creds.get("access_token")
+        task_desc["refresh_token"] = self._creds.get("refresh_token")
+        data = {key : str(val) for key, val in task_desc.items() if val is not None}
+        code, response = await self._request('POST', self.url('submit'), 'submit', data=data)
+        if not 200 <= code < 300:
+            logger.error("Submit failed with HTTP %s", code)
+            response = dict(response, status='Failed')
+        return response
+
+    async def upload_file(self, path):
+        """ Upload a local file
+        Requests a signed url from Kotta and streams the file to it.
+
+        Args: Path to file
+
+        Returns: The s3 url of the uploaded file, or -1 if a signed url was not issued
+
+        """
+        creds = { "access_token" : self._creds.get("access_token"),
+                  "refresh_token" : self._creds.get("refresh_token"),
+                  "filepath" : path }
+        creds = {key : val for key, val in creds.items() if val is not None}
+
+        code, response = await self._request('POST', self.url('upload_url'), 'upload_url',
+                                             data=creds)
+        if code != 200:
+            print ("ERROR: Failed to upload data :\n {0}".format(response.get('reason', 'Unknown')))
+            return -1
+
+        upload_url = response.get('upload_url')
+        with open(path, 'rb') as infile:
+            headers = {'Content-Length' : str(os.fstat(infile.fileno()).st_size)}
+            code, body = await self._request('PUT', upload_url, 'upload', decode=False,
+                                             retry=False, data=infile, headers=headers)
+        if not 200 <= code < 300:
+            raise IOError("Upload of {0} failed with HTTP {1} : {2}".format(path, code, body[:512]))
+
+        return Kotta.s3_url(upload_url)
+
+    async def fetch(self, kout, filename=None):
+        """ Fetch the remote url of a KOut to a local file
+
+        Kwargs:
+             - filename(string) : Specify path to download files to. Default=kout.file
+
+        Returns: The local path, or False if the output was not generated
+
+        """
+        if not kout.url:
+            logger.warning("File %s was not generated on Kotta. Nothing to fetch", kout.file)
+            return False
+
+        filename = filename or kout.file
+        async with self.session.get(kout.url, timeout=self._timeout('upload')) as resp:
+            resp.raise_for_status()
+            with open(filename, 'wb') as outfile:
+                async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                    outfile.write(chunk)
+        return filename
+
+    async def wait_all(self, jobs, maxwait=600, sleep=None, silent=True, timeout=None,
+                       policy=None):
+        """ Wait on many jobs concurrently, see KottaJob.wait for the arguments
+
+        Returns: list of final stati in the same order as jobs, with False for jobs
+        that did not finish within maxwait.
+
+        Raises: TimeoutError if timeout is set and any job did not finish within it
+
+        """
+        return await asyncio.gather(*[job.wait(self, maxwait=maxwait, sleep=sleep,
+                                               silent=silent, timeout=timeout, policy=policy)
+                                      for job in jobs])
+
+
+class AsyncKottaJob(KottaJob):
+    """ KottaJob whose network methods are coroutines to be used with AsyncKotta
+    """
+
+    def __init__ (self, kconn=None, job_id=None, **kwargs):
+        """ Create the job
+        Unlike KottaJob, a job_id does not trigger a status fetch here, await status()
+        to update the job.
+        """
+        super().__init__(**kwargs)
+        if job_id:
+            self.job_id = job_id
+
+    async def submit(self, kconn):
+        """ Submit job to Kotta.
+        Returns True/False depending on whether the job submission succeeded.
+        """
+        response = await kconn.submit_task(self.desc)
+        return self._submitted(response)
+
+    async def status(self, kconn):
+        """ Get status of a submitted job
+        """
+        if self.job_id and self.current_status not in self.terminal_stati:
+            self._update_status(await kconn.status_task(self.job_id))
+        return self.current_status
+
+    async def wait(self, kconn, maxwait=600, sleep=None, silent=True, timeout=None, policy=None):
+        """ Wait for job completion upto a maxtime duration.
+        Same arguments and behavior as KottaJob.wait
+        """
+        polls = self._polls(maxwait, sleep, silent, timeout, policy)
+        try:
+            delay = next(polls)
+            while True:
+                if delay:
+                    await asyncio.sleep(delay)
+                delay = polls.send(await self.status(kconn))
+        except StopIteration as done:
+            return done.value
+
+    async def fetch(self, kconn, files=None):
+        """ Download the outputs of the job concurrently
+
+        Kwargs:
+             - files (list) : Only fetch outputs with these filenames. Default=all outputs
+
+        Returns: list of local paths that were downloaded
+
+        """
+        kouts = [kout for kout in self.outputs if files is None or kout.file in files]
+        paths = await asyncio.gather(*[kconn.fetch(kout) for kout in kouts])
+        return [path for path in paths if path]
+
+    async def get_results(self, kconn, return_file='out.pkl'):
+        """ Fetch results from S3.
+        """
+        if self.current_status != "completed":
+            logger.warning("WARN: Job status != completed")
+            return None
+
+        try:
+            paths = await self.fetch(kconn, files=[return_file])
+        except Exception as e:
+            logger.error("Failed to download result %s", e)
+            return None
+
+        if not paths:
+            logger.error("Job had no results %s", self.current_status)
+            return None
+
+        with open(paths[0], 'rb') as result:
+            return pickle.load(result)
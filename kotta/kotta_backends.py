@@ -0,0 +1,228 @@
+""" Execution backends for KottaFn.
+
+By default a KottaFn runs every call as a Kotta job. A backend decides where calls run
+instead:
+
+RemoteBackend runs calls on Kotta, exactly like a KottaFn without a backend.
+LocalBackend runs calls on a local process pool, through the same serialize and
+runner.execute path that a Kotta job takes, without queueing or bootstrapping a node.
+RoutingBackend sends cheap calls to a LocalBackend and the rest to Kotta.
+
+"""
+
+import io
+import os
+import time
+import pickle
+import logging
+import tempfile
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import serialize
+
+from .kotta_job import KottaJobError
+from .kotta_future import KottaFuture
+
+logger  = logging.getLogger(__name__)
+
+def _run_local(payload):
+    """ Runs in a worker process. Executes a packed call with kotta.runner, as a Kotta
+    job would. Returns (result, seconds taken).
+    """
+    from kotta.runner import execute
+
+    with tempfile.TemporaryDirectory(prefix='kotta-') as workdir:
+        inputfile  = os.path.join(workdir, 'in.pkl')
+        outputfile = os.path.join(workdir, 'out.pkl')
+        with open(inputfile, 'wb') as ifile:
+            ifile.write(payload)
+
+        start = time.time()
+        execute(inputfile, outputfile)
+        elapsed = time.time() - start
+
+        with open(outputfile, 'rb') as ofile:
+            return pickle.load(ofile), elapsed
+
+
+class KottaBackend(object):
+    """ Decides where the calls of a KottaFn run.
+    """
+
+    def call(self, kfn, args, kwargs):
+        """ Run a call of kfn. Returns what calling kfn returns : the result if kfn blocks,
+        else a concurrent.futures.Future of the result.
+        """
+        raise NotImplementedError
+
+    def submit(self, kfn, args, kwargs, func=None):
+        """ Start a call of kfn, calling func in place of kfn.func if given. Returns a
+        concurrent.futures.Future of the result, whether or not kfn blocks.
+        """
+        raise NotImplementedError
+
+    def pool_size(self, kfn):
+        """ How many calls of kfn are worth starting at once, eg. by KottaFn.map.
+        None if the backend has no preference.
+        """
+        return None
+
+    def close(self):
+        """ Release any workers held by the backend
+        """
+        pass
+
+
+class RemoteBackend(KottaBackend):
+    """ Runs every call as a Kotta job
+    """
+
+    def call(self, kfn, args, kwargs):
+        return kfn._call_remote(args, kwargs)
+
+    def submit(self, kfn, args, kwargs, func=None):
+        job, out_pkl, submit_st = kfn._submit(args, kwargs, func=func)
+        if not submit_st:
+            raise KottaJobError("Submit failed")
+        return KottaFuture(job, return_file=out_pkl).watch(kfn.conn.monitor)
+
+    def pool_size(self, kfn):
+        return kfn.conn.pool_size
+
+
+class LocalBackend(KottaBackend):
+    """ Runs calls on a local pool of worker processes.
+
+    Calls are packed with serialize.pack_apply_message and executed by kotta.runner.execute
+    from temporary files, so they exercise the same path as a Kotta job. Calls that take
+    input or output files on Kotta can not run locally.
+    """
+
+    def __init__(self, max_workers=None):
+        """ Create a local backend. Worker processes are started by the first call.
+
+        Kwargs:
+             - max_workers (int) : Worker processes. Default=os.cpu_count()
+
+        """
+        self.max_workers = max_workers
+        self._pool      = None
+        self._runtimes  = {}
+        self._lock      = threading.Lock()
+
+    @property
+    def pool(self):
+        """ The process pool, started on first use
+        """
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.max_workers)
+            return self._pool
+
+    def expected_runtime(self, kfn):
+        """ Mean seconds the calls of kfn took locally so far, or None if it never ran
+        """
+        with self._lock:
+            _, mean = self._runtimes.get(kfn.__name__, (0, None))
+        return mean
+
+    def _record(self, kfn, elapsed):
+        with self._lock:
+            count, mean = self._runtimes.get(kfn.__name__, (0, 0.0))
+            self._runtimes[kfn.__name__] = (count + 1, mean + (elapsed - mean) / (count + 1))
+
+    def pool_size(self, kfn):
+        return self.max_workers or os.cpu_count()
+
+    def submit(self, kfn, args, kwargs, func=None):
+        if 'inputs' in kwargs or 'outputs' in kwargs:
+            raise ValueError("Calls with Kotta inputs or outputs can not run locally")
+
+        bufs = serialize.pack_apply_message(func or kfn.func, args, kwargs,
+                                            buffer_threshold=1024*1024,
+                                            item_threshold=1024)
+        # Written the way KottaFn stages a payload for a job
+        payload = io.BytesIO()
+        serialize.write_frames(bufs, payload)
+        payload = payload.getvalue()
+
+        future = Future()
+        future.set_running_or_notify_cancel()
+
+        def done(running):
+            try:
+                result, elapsed = running.result()
+            except BaseException as e:
+                future.set_exception(e)
+                return
+            self._record(kfn, elapsed)
+            future.set_result(result)
+
+        self.pool.submit(_run_local, payload).add_done_callback(done)
+        return future
+
+    def call(self, kfn, args, kwargs):
+        future = self.submit(kfn, args, kwargs)
+        return future.result() if kfn.block else future
+
+    def close(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown()
+
+
+class RoutingBackend(KottaBackend):
+    """ Runs calls expected to cost less than threshold locally, and the rest on Kotta.
+
+    cost is called with (kfn, args, kwargs) and returns the expected cost of the call.
+    By default it is the mean local runtime of the function in seconds, so a function
+    runs locally until its calls are seen to take longer than threshold seconds, and
+    from then on goes to Kotta. Calls with Kotta inputs or outputs always go to Kotta.
+    """
+
+    def __init__(self, threshold=10, cost=None, local=None):
+        """ Create a routing backend
+
+        Kwargs:
+             - threshold (float) : Calls costing less run locally. Default=10
+             - cost (callable) : cost(kfn, args, kwargs) -> expected cost of a call.
+               Default=mean local runtime in seconds, 0 for functions not yet run
+             - local (LocalBackend) : Backend for cheap calls. Default=a new LocalBackend
+
+        """
+        self.threshold = threshold
+        self.local     = local or LocalBackend()
+        self.remote    = RemoteBackend()
+        self.cost      = cost or self._local_runtime
+
+    def _local_runtime(self, kfn, args, kwargs):
+        return self.local.expected_runtime(kfn) or 0
+
+    def route(self, kfn, args, kwargs):
+        """ Returns the backend that the call should run on
+        """
+        if 'inputs' in kwargs or 'outputs' in kwargs:
+            return self.remote
+        if self.cost(kfn, args, kwargs) < self.threshold:
+            return self.local
+        return self.remote
+
+    def call(self, kfn, args, kwargs):
+        backend = self.route(kfn, args, kwargs)
+        logger.debug("Routing call of %s to %s", kfn.__name__, type(backend).__name__)
+        return backend.call(kfn, args, kwargs)
+
+    def submit(self, kfn, args, kwargs, func=None):
+        backend = self.route(kfn, args, kwargs)
+        logger.debug("Routing call of %s to %s", kfn.__name__, type(backend).__name__)
+        return backend.submit(kfn, args, kwargs, func=func)
+
+    def pool_size(self, kfn):
+        if kfn.conn is None:
+            return self.local.pool_size(kfn)
+        return max(self.local.pool_size(kfn), self.remote.pool_size(kfn))
+
+    def close(self):
+        self.local.close()
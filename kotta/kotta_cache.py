@@ -0,0 +1,617 @@
+""" Local caches used by the Kotta client.
+
+UploadCache remembers the s3 url that each uploaded file content was stored at, so that
+byte-identical files are only ever uploaded once.
+
+StatusCache shares recently fetched job stati between everything polling the same jobs.
+
+ResultCache memoizes the results of kottajob functions on local disk, so that repeating
+a call with the same function and arguments does not resubmit it.
+
+"""
+
+import os
+import json
+import time
+import types
+import pickle
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger  = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024*1024
+
+def hash_file(path, algorithm='sha256'):
+    """ Streamed hex digest of a file, read in chunks
+    """
+    hasher = hashlib.new(algorithm)
+    with open(path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def write_json(path, obj):
+    """ Atomically replace the json file at path by obj, creating its directory.
+    Readers see the old or the new contents, never a partly written file.
+    """
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    tmp = "{0}.{1}.{2}.tmp".format(path, os.getpid(), threading.get_ident())
+    with open(tmp, 'w') as jfile:
+        json.dump(obj, jfile)
+    os.replace(tmp, path)
+
+def read_json(path, default):
+    """ The json file at path, or default if it is missing or unreadable
+    """
+    try:
+        with open(path) as jfile:
+            return json.load(jfile)
+    except (IOError, OSError, ValueError):
+        return default
+
+@contextmanager
+def locked_file(path):
+    """ Excludes other processes from the file at path while held, by locking path.lock.
+    Threads of this process are not excluded, so hold a threading.Lock as well. Where
+    fcntl is missing, only the threading.Lock applies.
+    """
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    with open(path + '.lock', 'a') as lfile:
+        if fcntl is not None:
+            fcntl.flock(lfile, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lfile, fcntl.LOCK_UN)
+
+
+class UploadCache(object):
+    """ Content addressed index of uploaded files.
+
+    Maps the sha256 of a file's contents to the s3 url it was uploaded to. Jobs see
+    inputs under the basename of their s3 url, so entries are also keyed on the file's
+    basename and a hit never changes the name a job sees. A second index maps
+    (path, size, mtime) to the digest, so unchanged files are not rehashed.
+    Entries older than max_age seconds are treated as misses and evicted, and the least
+    recently used entries are evicted beyond max_entries. Several processes may share
+    the index. Each change is merged into the index on disk under a file lock.
+
+    Files up to prehash_limit bytes are hashed before uploading so that a hit skips the
+    upload. Larger files are hashed as they are streamed to the upload rather than with
+    a separate read up front, so they hit from the second upload onwards. Multipart
+    uploads hash each part as it is sent, see MultipartUpload.
+    """
+
+    def __init__(self, path=None, max_entries=10000, max_age=7*24*3600,
+                 prehash_limit=64*1024*1024):
+        """ Create or open an upload cache
+
+        Kwargs:
+             - path (string) : Index file. Default=~/.kotta/upload_cache.json
+             - max_entries (int) : Max number of cached uploads. Default=10000
+             - max_age (int) : Seconds after which an upload is no longer trusted. Default=7 days
+             - prehash_limit (int) : Max file size hashed ahead of an upload. Default=64MB
+
+        """
+        self.path = path or os.path.join(os.path.expanduser('~'), '.kotta', 'upload_cache.json')
+        self.max_entries   = max_entries
+        self.max_age       = max_age
+        self.prehash_limit = prehash_limit
+        self._lock  = threading.Lock()
+        self._index = None
+
+    @property
+    def index(self):
+        """ The index dict, loaded from disk on first use
+        """
+        if self._index is None:
+            self._index = read_json(self.path, {})
+            self._index.setdefault('uploads', {})
+            self._index.setdefault('files', {})
+        return self._index
+
+    def _merge(self):
+        """ Replace the index by the one on disk, which other processes may have changed,
+        keeping the later use time of each upload and the files hashed here. Called with
+        the lock held.
+        """
+        index = read_json(self.path, {})
+        uploads = index.setdefault('uploads', {})
+        for key, entry in uploads.items():
+            mine = self.index['uploads'].get(key)
+            if mine:
+                entry['used'] = max(entry['used'], mine['used'])
+        index['files'] = dict(index.get('files', {}), **self.index['files'])
+        self._index = index
+
+    @contextmanager
+    def _shared(self):
+        """ Hold the lock and the file lock of the index, merged from disk, to change it
+        """
+        with self._lock, locked_file(self.path):
+            self._merge()
+            yield
+
+    def _save(self):
+        """ Atomically write the index. Called within _shared().
+        """
+        write_json(self.path, self.index)
+
+    @staticmethod
+    def _file_key(path):
+        stat = os.stat(path)
+        return os.path.abspath(path), [stat.st_size, stat.st_mtime]
+
+    def known_digest(self, path):
+        """ Returns the digest of path if the file is unchanged since it was last hashed
+        """
+        key, stamp = self._file_key(path)
+        with self._lock:
+            entry = self.index['files'].get(key)
+        if entry and entry[:2] == stamp:
+            return entry[2]
+        return None
+
+    def digest(self, path):
+        """ Returns the digest of path, hashing it if it is small enough to prehash.
+        Returns None for large files that have not been hashed before.
+        """
+        digest = self.known_digest(path)
+        if digest is None and os.path.getsize(path) <= self.prehash_limit:
+            digest = hash_file(path)
+            self._remember_file(path, digest)
+        return digest
+
+    def _remember_file(self, path, digest):
+        key, stamp = self._file_key(path)
+        with self._lock:
+            self.index['files'][key] = stamp + [digest]
+
+    @staticmethod
+    def _upload_key(digest, name):
+        return "{0}:{1}".format(digest, os.path.basename(name))
+
+    def get(self, digest, size, name):
+        """ Returns the s3 url a file with this digest, size and basename was uploaded to,
+        or None. Entries that are too old or do not match the size are evicted, and
+        the use of a hit is saved to the index.
+        """
+        key = self._upload_key(digest, name)
+        with self._lock:
+            entry = self.index['uploads'].get(key)
+            if entry is None:
+                # another process may have uploaded it since the index was read
+                self._merge()
+                entry = self.index['uploads'].get(key)
+            if entry is None:
+                return None
+
+        # the use is saved, so that eviction in other processes sees it
+        with self._shared():
+            entry = self.index['uploads'].get(key)
+            if entry is None:
+                return None
+            if entry['size'] != size or time.time() - entry['time'] > self.max_age:
+                logger.debug("Evicting stale upload cache entry %s", key)
+                del self.index['uploads'][key]
+                self._save()
+                return None
+
+            entry['used'] = time.time()
+            self._save()
+            logger.debug("Upload cache hit %s -> %s", key, entry['url'])
+            return entry['url']
+
+    def add(self, path, digest, url):
+        """ Record that the file at path, with this digest, was uploaded to url
+        """
+        self._remember_file(path, digest)
+        self.put(digest, os.path.getsize(path), path, url)
+
+    def put(self, digest, size, name, url):
+        """ Record that data with this digest and size was uploaded to url, with the
+        basename of name. Used for uploads that did not come from a local file.
+        """
+        now = time.time()
+        with self._shared():
+            entry = {'url'  : url,
+                     'size' : size,
+                     'time' : now,
+                     'used' : now}
+            self.index['uploads'][self._upload_key(digest, name)] = entry
+            self._evict()
+            self._save()
+
+    def _evict(self):
+        """ Drop expired entries, then the least recently used ones beyond max_entries.
+        Called within _shared().
+        """
+        uploads = self.index['uploads']
+        now = time.time()
+        for key in [k for k, e in uploads.items() if now - e['time'] > self.max_age]:
+            del uploads[key]
+
+        if len(uploads) > self.max_entries:
+            lru = sorted(uploads, key=lambda k: uploads[k]['used'])
+            for key in lru[:len(uploads) - self.max_entries]:
+                del uploads[key]
+
+        files = self.index['files']
+        if len(files) > self.max_entries:
+            for key in list(files)[:len(files) - self.max_entries]:
+                del files[key]
+
+    def invalidate(self, digest, name):
+        """ Forget a cached upload
+        """
+        with self._shared():
+            if self.index['uploads'].pop(self._upload_key(digest, name), None):
+                self._save()
+
+    def clear(self):
+        """ Forget all cached uploads
+        """
+        with self._shared():
+            self._index = {'uploads' : {}, 'files' : {}}
+            self._save()
+
+
+class StatusCache(object):
+    """ Thread-safe cache of job status dicts, shareable between connections.
+
+    Statuses are served from the cache for ttl seconds after they were fetched.
+    Jobs in a terminal state never change again, so they are kept until evicted and
+    never refetched. Callers always receive a copy, so they may modify it freely.
+    """
+
+    def __init__(self, ttl=5, max_entries=100000, terminal=('completed', 'cancelled', 'failed')):
+        """ Create a status cache
+
+        Kwargs:
+             - ttl (float) : Seconds for which a non-terminal status is reused. Default=5
+             - max_entries (int) : Max number of cached jobs. Default=100000
+             - terminal (tuple) : Stati that never change once reached
+
+        """
+        self.ttl         = ttl
+        self.max_entries = max_entries
+        self.terminal    = terminal
+        self._lock   = threading.Lock()
+        self._status = {}
+
+    @staticmethod
+    def _copy(status):
+        return {key : list(val) if isinstance(val, list) else val
+                for key, val in status.items()}
+
+    def get(self, jobid):
+        """ Returns a copy of the cached status of jobid, or None if missing or stale
+        """
+        with self._lock:
+            entry = self._status.get(jobid)
+            if entry is None:
+                return None
+            fetched, status = entry
+            if status.get('status') not in self.terminal and time.time() - fetched > self.ttl:
+                del self._status[jobid]
+                return None
+            return self._copy(status)
+
+    def put(self, jobid, status):
+        """ Cache the status of jobid
+        """
+        with self._lock:
+            self._status.pop(jobid, None)
+            self._status[jobid] = (time.time(), self._copy(status))
+            if len(self._status) > self.max_entries:
+                # Entries are in insertion order, drop the oldest
+                for key in list(self._status)[:len(self._status) - self.max_entries]:
+                    del self._status[key]
+
+    def invalidate(self, jobid=None):
+        """ Forget the status of jobid, or of all jobs if jobid is None
+        """
+        with self._lock:
+            if jobid is None:
+                self._status.clear()
+            else:
+                self._status.pop(jobid, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._status)
+
+
+class _CanonicalPickler(pickle._Pickler):
+    """ Pickler whose output does not depend on the string hash seed of the process.
+    The items of sets and frozensets are written sorted by their own digests. The
+    python implementation of the pickler is used, since the C one can not be made to
+    handle builtin types differently.
+    """
+
+    dispatch = pickle._Pickler.dispatch.copy()
+
+    def save_set(self, obj):
+        items = sorted(obj, key=lambda item: canonical_digest(item).digest())
+        self.save_reduce(type(obj), (items,), obj=obj)
+
+    dispatch[set] = save_set
+    dispatch[frozenset] = save_set
+
+
+def canonical_digest(obj, hasher=None):
+    """ Feed a pickle of obj that is the same in every process to hasher, a new sha256
+    by default, and return it. Large contiguous buffers, e.g. of numpy arrays, are
+    hashed in place rather than copied into the pickle.
+
+    Raises what pickling obj raises.
+    """
+    hasher = hasher or hashlib.sha256()
+
+    def buffer_callback(pickle_buffer):
+        try:
+            raw = pickle_buffer.raw()
+        except BufferError:
+            # not contiguous, pickle it in-band
+            return True
+        hasher.update(raw)
+        return False
+
+    _CanonicalPickler(types.SimpleNamespace(write=hasher.update), protocol=5,
+                      buffer_callback=buffer_callback).dump(obj)
+    return hasher
+
+
+def _const_repr(const):
+    """ repr of a code constant, with frozensets in a hash seed independent order
+    """
+    if isinstance(const, frozenset):
+        return "frozenset({{{0}}})".format(', '.join(sorted(_const_repr(c) for c in const)))
+    if isinstance(const, tuple):
+        return "({0})".format(', '.join(_const_repr(c) for c in const))
+    return repr(const)
+
+
+def _code_digest(code, hasher):
+    """ Feed everything that determines what code does, but not where it was defined, to
+    hasher. Filenames and line numbers change between reruns of a notebook cell.
+    """
+    hasher.update(code.co_code)
+    hasher.update(repr((code.co_names, code.co_varnames, code.co_freevars,
+                        code.co_cellvars)).encode('utf-8'))
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _code_digest(const, hasher)
+        else:
+            hasher.update(_const_repr(const).encode('utf-8'))
+
+
+def function_digest(f):
+    """ Stable hex digest of a function's code, defaults and closure contents, the same
+    in every process. Globals the function reads are not included.
+    Returns None if f is not a plain function or its state can not be pickled.
+    """
+    code = getattr(f, '__code__', None)
+    if code is None:
+        return None
+
+    hasher = hashlib.sha256()
+    hasher.update(f.__name__.encode('utf-8'))
+    _code_digest(code, hasher)
+    try:
+        cells = [cell.cell_contents for cell in f.__closure__ or ()]
+        canonical_digest((f.__defaults__, f.__kwdefaults__, cells), hasher)
+    except (ValueError, pickle.PicklingError, TypeError, AttributeError) as e:
+        logger.debug("Can not digest the state of %s : %s", f.__name__, e)
+        return None
+    return hasher.hexdigest()
+
+
+class ResultCache(object):
+    """ Size bounded, persistent store of the results of kottajob calls.
+
+    Results are keyed by the digest of the function and of the packed args, see key().
+    Each result is pickled to its own file in the cache directory, next to an index of
+    the job that produced it and when it was last used. The least recently used results
+    are evicted beyond max_bytes or max_entries. A hit also touches the result file, so
+    that results used by other processes count as recently used. Several processes may
+    share the directory. Each change is merged into the index on disk under a file lock.
+    """
+
+    def __init__(self, path=None, max_bytes=1024*1024*1024, max_entries=10000):
+        """ Create or open a result cache
+
+        Kwargs:
+             - path (string) : Cache directory. Default=~/.kotta/results
+             - max_bytes (int) : Max total size of the cached results. Default=1GB
+             - max_entries (int) : Max number of cached results. Default=10000
+
+        """
+        self.path = path or os.path.join(os.path.expanduser('~'), '.kotta', 'results')
+        self.max_bytes   = max_bytes
+        self.max_entries = max_entries
+        self._lock  = threading.Lock()
+        self._index = None
+
+    @staticmethod
+    def call_key(fn_digest, args, kwargs):
+        """ Key of a call of the function with fn_digest, the same in every process.
+        Returns None if the arguments can not be pickled as they are, see key().
+        """
+        try:
+            hasher = canonical_digest((args, sorted(kwargs.items())),
+                                      hashlib.sha256(fn_digest.encode('utf-8')))
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            logger.debug("Can not digest the arguments : %s", e)
+            return None
+        return hasher.hexdigest()
+
+    @staticmethod
+    def key(fn_digest, bufs):
+        """ Key of a call of the function with fn_digest, whose args packed to bufs.
+        Used for arguments that only serialize can pack, e.g. lambdas. Set arguments
+        are ordered by the string hash seed in bufs, so their keys vary by process.
+        """
+        hasher = hashlib.sha256(fn_digest.encode('utf-8'))
+        for buf in bufs:
+            hasher.update(hashlib.sha256(buf).digest())
+        return hasher.hexdigest()
+
+    @property
+    def index(self):
+        """ The index dict, loaded from disk on first use
+        """
+        if self._index is None:
+            self._index = read_json(self.index_path, {})
+        return self._index
+
+    @property
+    def index_path(self):
+        return os.path.join(self.path, 'index.json')
+
+    def _merge(self):
+        """ Replace the index by the one on disk, which other processes may have changed,
+        keeping the later use time of each entry. Called with the lock held.
+        """
+        index = read_json(self.index_path, {})
+        for key, entry in index.items():
+            mine = self.index.get(key)
+            if mine:
+                entry['used'] = max(entry['used'], mine['used'])
+        self._index = index
+
+    @contextmanager
+    def _shared(self):
+        """ Hold the lock and the file lock of the index, merged from disk, to change it
+        """
+        with self._lock, locked_file(self.index_path):
+            self._merge()
+            yield
+
+    def _save(self):
+        """ Atomically write the index. Called within _shared().
+        """
+        write_json(self.index_path, self.index)
+
+    def _result_path(self, key):
+        return os.path.join(self.path, "{0}.pkl".format(key))
+
+    def get(self, key):
+        """ Returns (result, job_id) of a cached call, or None on a miss
+        """
+        with self._lock:
+            entry = self.index.get(key)
+            if entry is None:
+                # another process may have cached it since the index was read
+                self._merge()
+                entry = self.index.get(key)
+            if entry is None:
+                return None
+            try:
+                with open(self._result_path(key), 'rb') as rfile:
+                    result = pickle.load(rfile)
+            except Exception as e:
+                logger.debug("Dropping unreadable cached result %s : %s", key, e)
+            else:
+                entry['used'] = time.time()
+                try:
+                    # persists the use without rewriting the index on every hit
+                    os.utime(self._result_path(key), (entry['used'], entry['used']))
+                except OSError:
+                    pass
+                logger.debug("Result cache hit %s from job %s", key, entry['job_id'])
+                return result, entry['job_id']
+
+        with self._shared():
+            self._remove(key)
+            self._save()
+        return None
+
+    def put(self, key, result, job_id=None, fn_digest=None):
+        """ Cache the result of a call, and the id of the job that computed it
+        """
+        data = pickle.dumps(result)
+        if len(data) > self.max_bytes:
+            logger.debug("Result %s is larger than the whole cache, not cached", key)
+            return
+
+        with self._shared():
+            tmp = "{0}.{1}.tmp".format(self._result_path(key), os.getpid())
+            with open(tmp, 'wb') as rfile:
+                rfile.write(data)
+            os.replace(tmp, self._result_path(key))
+
+            now = time.time()
+            self.index[key] = {'size'   : len(data),
+                               'job_id' : job_id,
+                               'fn'     : fn_digest,
+                               'time'   : now,
+                               'used'   : now}
+            self._evict()
+            self._save()
+
+    def _remove(self, key):
+        """ Drop an entry and its file. Called within _shared().
+        """
+        self.index.pop(key, None)
+        try:
+            os.remove(self._result_path(key))
+        except OSError:
+            pass
+
+    def _used(self, key):
+        """ When a result was last used, in this or any other process
+        """
+        try:
+            touched = os.path.getmtime(self._result_path(key))
+        except OSError:
+            touched = 0
+        return max(self.index[key]['used'], touched)
+
+    def _evict(self):
+        """ Drop the least recently used results beyond max_bytes or max_entries.
+        Called within _shared().
+        """
+        total = sum(entry['size'] for entry in self.index.values())
+        lru   = sorted(self.index, key=self._used)
+        while lru and (total > self.max_bytes or len(self.index) > self.max_entries):
+            key = lru.pop(0)
+            total -= self.index[key]['size']
+            self._remove(key)
+
+    def invalidate(self, key=None, fn_digest=None):
+        """ Forget the result of the call with key, or all results of the function with
+        fn_digest
+        """
+        with self._shared():
+            keys = [k for k, entry in self.index.items()
+                    if k == key or (fn_digest and entry.get('fn') == fn_digest)]
+            for k in keys:
+                self._remove(k)
+            if keys:
+                self._save()
+
+    def clear(self):
+        """ Forget all cached results
+        """
+        with self._shared():
+            for key in list(self.index):
+                self._remove(key)
+            self._save()
+
+    def __len__(self):
+        with self._lock:
+            return len(self.index)
@@ -0,0 +1,177 @@
+""" Prebuilt python environments for kottajob functions.
+
+By default every kottajob installs python3, pip and all of its requirements from the
+network before running the function. An EnvBundle instead installs the requirements
+once, in a build job on Kotta, into a tarball that is kept in s3 as that job's output.
+Later jobs with the same requirement set list the tarball as an input and unpack it,
+which takes seconds instead of minutes.
+
+Bundles are keyed by a hash of the normalized requirement set, and the s3 url of each
+built bundle is remembered locally so that the build only ever runs once.
+
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+
+from .kotta_job import KottaJob, KottaJobError
+from .kotta_cache import write_json
+
+logger  = logging.getLogger(__name__)
+
+BASE_REQUIREMENTS = ['PyMySQL', 'ipython_genutils']
+
+_index_lock = threading.Lock()
+
+def requirements_hash(requirements):
+    """ Hash of a requirement set, independent of ordering, blank lines and comments
+
+    Args:
+         - requirements (string or list) : requirements.txt style lines
+    """
+    if isinstance(requirements, str):
+        requirements = requirements.splitlines()
+    lines = set(line.split('#', 1)[0].strip() for line in requirements)
+    lines.discard('')
+    return hashlib.sha256('\n'.join(sorted(lines)).encode('utf-8')).hexdigest()
+
+
+class EnvBundle(object):
+    """ A python environment built once on Kotta and shared by every job that needs
+    the same requirements.
+
+    The bundle is built with pip3 install --target on a node of the same queue the jobs
+    run on, so it matches the python3 version of those nodes. Call invalidate() to force
+    a rebuild, e.g. after the node image changed.
+    """
+
+    def __init__(self, kconn, requirements='', queue='Test', walltime=30, index_path=None,
+                 timeout=3600):
+        """ Describe an environment bundle. Nothing is built until url() is first called.
+
+        Args:
+             - kconn (Kotta) : Connection used to run the build job
+
+        Kwargs:
+             - requirements (string) : Extra requirements.txt lines. Default=''
+             - queue (string) : Queue the build job runs on. Default='Test'
+             - walltime (int) : Walltime of the build job. Default=30
+             - index_path (string) : Index of built bundles. Default=~/.kotta/env_bundles.json
+             - timeout (float) : Seconds to wait for the build job. Default=3600
+
+        """
+        self.kconn    = kconn
+        self.queue    = queue
+        self.walltime = walltime
+        self.timeout  = timeout
+        self.requirements = '\n'.join(BASE_REQUIREMENTS + [requirements])
+        self.key  = requirements_hash(self.requirements)
+        self.name = "env-{0}.tar.gz".format(self.key[:16])
+        self.index_path = index_path or os.path.join(os.path.expanduser('~'), '.kotta',
+                                                     'env_bundles.json')
+
+    def _load_index(self):
+        try:
+            with open(self.index_path) as ifile:
+                return json.load(ifile)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _save_index(self, index):
+        write_json(self.index_path, index)
+
+    @property
+    def build_script(self):
+        """ Script of the job that builds the bundle
+        """
+        return '''#!/bin/bash
+set -e
+apt-get -y install python3 python3-pip
+pip3 install -U pip
+cat <<EOF > requirements.txt
+{0}
+EOF
+mkdir -p kotta_env
+pip3 install --target kotta_env -r requirements.txt
+tar -czf {1} -C kotta_env .
+'''.format(self.requirements, self.name)
+
+    @property
+    def setup_script(self):
+        """ Shell lines that unpack the bundle on the job node, replacing the installs
+        """
+        return '''command -v python3 > /dev/null || apt-get -y install python3
+mkdir -p kotta_env
+tar -xzf {0} -C kotta_env
+export PYTHONPATH=$PWD/kotta_env${{PYTHONPATH:+:$PYTHONPATH}}
+'''.format(self.name)
+
+    def url(self):
+        """ Returns the s3 url of the bundle, building it first if it was never built
+        """
+        with _index_lock:
+            entry = self._load_index().get(self.key)
+        if entry:
+            return entry['url']
+        return self.build()
+
+    def build(self):
+        """ Run the build job and record the s3 url of the bundle it produced.
+
+        Raises: KottaJobError if the build job fails, TimeoutError if it does not
+        finish within timeout seconds
+        """
+        logger.info("Building environment bundle %s", self.name)
+        job = KottaJob(jobtype='script',
+                       jobname='Kotta env bundle {0}'.format(self.key[:16]),
+                       script_name='build_env.sh',
+                       script=self.build_script,
+                       executable='/bin/bash build_env.sh',
+                       output_file_stdout='STDOUT.txt',
+                       output_file_stderr='STDERR.txt',
+                       walltime=self.walltime,
+                       queue=self.queue)
+        job.add_outputs([self.name])
+
+        if not job.submit(self.kconn):
+            raise KottaJobError("Failed to submit the build of {0}".format(self.name), job=job)
+
+        status = job.wait(self.kconn, timeout=self.timeout)
+        if status != 'completed':
+            raise KottaJobError("Build of {0} ended as {1}".format(self.name, status), job=job)
+
+        bundles = [output for output in job.outputs if output.file == self.name]
+        if not bundles or not bundles[0].s3_url:
+            raise KottaJobError("Build of {0} produced no bundle".format(self.name), job=job)
+
+        url = bundles[0].s3_url
+        with _index_lock:
+            index = self._load_index()
+            index[self.key] = {'url'  : url,
+                               'name' : self.name,
+                               'time' : time.time(),
+                               'requirements' : self.requirements}
+            self._save_index(index)
+        logger.info("Environment bundle %s is at %s", self.name, url)
+        return url
+
+    def invalidate(self):
+        """ Forget the built bundle, so that the next url() call rebuilds it
+        """
+        with _index_lock:
+            index = self._load_index()
+            if index.pop(self.key, None):
+                self._save_index(index)
+
+    def job_desc(self, job_desc, command):
+        """ Returns a copy of job_desc whose script unpacks this bundle and runs command,
+        and whose inputs include the bundle.
+        """
+        desc = dict(job_desc)
+        desc['inputs'] = ','.join(filter(None, [desc.get('inputs'), self.url()]))
+        desc['script'] = '#!/bin/bash\n{0}{1}\n'.format(self.setup_script, command)
+        return desc
@@ -8,22 +8,84 @@ A call to KottaFn constructs a KottaJob and calls it.
 """
 
 import pickle
-import uuid
 import os
+import hashlib
 import logging
+import tempfile
+import threading
+from itertools import islice
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 
 import serialize
-from .kotta_job import KottaJob
+from serialize.canning import interactive
+from .kotta_job import KottaJob, KottaJobError
+from .kotta_future import KottaFuture
+from .kotta_env import EnvBundle
+from .kotta_cache import ResultCache, function_digest
+from .kotta_runtime import RuntimeBundle
+from . import kotta_runtime
 
 logger  = logging.getLogger(__name__)
 
+_EMPTY_CELL = object()
+
+# Chunks of KottaFn.map submitted at once, for backends without a pool size of their own
+MAP_POOL_SIZE = 10
+
+class KottaMapError(Exception):
+    """ Stands in for the result of an item of KottaFn.map that failed.
+    remote_traceback holds the traceback from the remote node, if there was one.
+    """
+
+    def __init__(self, message, remote_traceback=None):
+        super(KottaMapError, self).__init__(message)
+        self.remote_traceback = remote_traceback
+
+
+@interactive
+def _kotta_map_chunk(f, calls):
+    """ Runs on the remote node. Applies f to each args tuple in calls, catching
+    failures per item so that one bad item does not lose the rest of the chunk.
+    """
+    import traceback
+    results = []
+    for args in calls:
+        try:
+            results.append((True, f(*args)))
+        except Exception as e:
+            results.append((False, ("{0}: {1}".format(type(e).__name__, e),
+                                    traceback.format_exc())))
+    return results
+
+
 class KottaFn(object):
     """
     This is modelled off of ipython parallel's RemoteFunction code
     view has to have some context of kotta
+
+    A KottaFn can be called from many threads at once. self.job is the most
+    recently submitted job, use the job or future returned by each call to
+    track that call.
     """
-    def __init__ (self, conn, job_desc, f, block=True, **flags):
+    def __init__ (self, conn, job_desc, f, block=True, env=None, memo=None,
+                  spill_threshold=64*1024*1024, backend=None, compression=None,
+                  offload_threshold=None, runtime=None, oob=True, **flags):
         """ Construct a KottaFn object
+        If runtime is a RuntimeBundle, it is added to the inputs of every job, whose
+        script runs runtime.command. Otherwise job_desc must stage runner.py and
+        serialize.tar.gz itself and run RUN_COMMAND.
+        If env is an EnvBundle, jobs unpack it instead of installing their requirements.
+        If memo is a ResultCache, calls whose function and args were seen before return
+        the cached result without submitting a job.
+        Payloads are staged in memory, those above spill_threshold bytes in a temporary
+        file that is deleted once uploaded.
+        A KottaBackend decides where calls run, by default they all run on Kotta.
+        compression names a serialize.compression codec that large payload buffers are
+        compressed with before uploading.
+        Payload buffers of at least offload_threshold bytes are uploaded once, as their
+        own content addressed objects, and referenced from the payload.
+        With oob=False arguments are pickled without protocol 5 out-of-band buffers, for
+        job nodes whose python3 is older than 3.8.
         """
         self.__name__ = f.__name__
         self.__doc__  = f.__doc__
@@ -34,6 +96,32 @@ class KottaFn(object):
         self.job_desc = job_desc
         self.block    = block
         self.job      = None
+        self.env      = env
+        self._call_desc = None
+        self.memo     = memo
+        self.spill_threshold = spill_threshold
+        self.backend  = backend
+        self.compression = compression
+        self.offload_threshold = offload_threshold
+        self.runtime  = runtime
+        self.oob      = oob
+        self._fn_upload = None
+        self._fn_digest = None
+        self._lock    = threading.Lock()
+
+        # Resolve the string keys of the canning maps now, since that mutates them
+        # and is not safe to first do from several calling threads at once.
+        serialize.can(None)
+
+    def _stage(self, obj, path, upload_url=None, write=pickle.dump):
+        """ Write obj with write(obj, fileobj), by default pickled, and upload it as path,
+        without leaving files behind.
+        Returns: the s3 url, or -1 if a signed url was not issued
+        """
+        with tempfile.SpooledTemporaryFile(max_size=self.spill_threshold) as staged:
+            write(obj, staged)
+            staged.seek(0)
+            return self.conn.upload_fileobj(staged, path, upload_url=upload_url)
 
     @staticmethod
     def dump_to_file(obj, filename):
@@ -45,87 +133,378 @@ class KottaFn(object):
             #sfile.write(fn_buf)
             pickle.dump(obj, sfile)
 
-    def __call__ (self, *args, **kwargs) :
-        """ Override the __call__ behavior to trap the args to the function,
-        serialize and ship to a remote node via Kotta. Pickled results sent
-        back are presented to the user.
+    def _job_desc(self):
+        """ The job description for a call. The runtime is uploaded, and with a prebuilt
+        env the bundle is looked up or built, by the first call. Later calls reuse them.
         """
+        if self.env is None and self.runtime is None:
+            return self.job_desc
+
+        with self._lock:
+            if self._call_desc is None:
+                desc    = self.job_desc
+                command = RUN_COMMAND
+                if self.runtime is not None:
+                    inputs  = self.runtime.inputs() + [desc.get('inputs')]
+                    desc    = dict(desc, inputs=','.join(filter(None, inputs)))
+                    command = self.runtime.command
+                if self.env is not None:
+                    desc = self.env.job_desc(desc, command)
+                self._call_desc = desc
+            return self._call_desc
 
-        self.job = KottaJob(**self.job_desc)
+    @staticmethod
+    def _function_parts(f):
+        """ The objects pack_function ships for f : its code, closure contents and defaults.
+        Returns None for callables that are not plain functions.
+        """
+        code = getattr(f, '__code__', None)
+        if code is None:
+            return None
+        cells = []
+        for cell in f.__closure__ or ():
+            try:
+                cells.append(cell.cell_contents)
+            except ValueError:
+                cells.append(_EMPTY_CELL)
+        return (code, f.__defaults__, f.__kwdefaults__) + tuple(cells)
 
-        if 'inputs' in kwargs:
-            self.job.add_inputs(kwargs['inputs'])
+    @staticmethod
+    def _same_parts(cached, parts):
+        """ Whether cached was computed for exactly the objects in parts
+        """
+        return bool(cached) and len(cached[0]) == len(parts) and \
+            all(old is new for old, new in zip(cached[0], parts))
 
-        if 'outputs' in kwargs:
-            self.job.add_outputs(kwargs['outputs'])
+    def _packed_function(self):
+        """ Returns (file name, s3 url) of the packed function, uploading it once and again
+        only when its code, closure or defaults are rebound. Objects mutated in place are
+        not noticed. Returns None if the function has to be shipped with each call.
+        """
+        parts = self._function_parts(self.func)
+        if parts is None:
+            return None
+
+        with self._lock:
+            if self._same_parts(self._fn_upload, parts):
+                return self._fn_upload[1:]
+
+            fn_bytes = serialize.pack_function(self.func)
+            fn_pkl   = "pkl/{0}.fn.pkl".format(hashlib.sha256(fn_bytes).hexdigest()[:32])
+            s3_url   = self._stage(fn_bytes, fn_pkl)
+            if s3_url == -1:
+                logger.warning("Failed to upload %s, shipping it with each call", fn_pkl)
+                return None
+
+            # Holding the parts keeps them alive, so identity comparisons stay valid
+            self._fn_upload = (parts, os.path.basename(fn_pkl), s3_url)
+            return self._fn_upload[1:]
+
+    def _digest(self):
+        """ function_digest of the function, recomputed only when its code, closure or
+        defaults are rebound
+        """
+        parts = self._function_parts(self.func)
+        if parts is None:
+            return None
+
+        with self._lock:
+            if not self._same_parts(self._fn_digest, parts):
+                self._fn_digest = (parts, function_digest(self.func))
+            return self._fn_digest[1]
+
+    def _pack(self, args, kwargs, func=None):
+        """ Pack a call. func replaces self.func as the function that is called remotely.
+        Returns: ((file name, s3 url) of the separately uploaded function or None,
+        message buffers)
+        """
+        # The function itself is uploaded once and shipped by reference
+        packed_fn = None if func else self._packed_function()
+        if packed_fn:
+            func = None
+        else:
+            func = func or self.func
 
-        fn_buf  = serialize.pack_apply_message(self.func, args, kwargs,
+        fn_buf  = serialize.pack_apply_message(func, args, kwargs,
                                                buffer_threshold=1024*1024,
-                                               item_threshold=1024)
-
-        fn_id   = uuid.uuid4()
-        pkl_dir = "pkl"
-        if not os.path.exists(pkl_dir):
-            os.makedirs(pkl_dir)
-        fn_pkl  = "{0}/{1}.in.pkl".format(pkl_dir, fn_id)
-        out_pkl = "{0}/out.pkl".format(pkl_dir)
-
-        with open(fn_pkl, 'wb') as sfile:
-            pickle.dump(fn_buf, sfile)
+                                               item_threshold=1024,
+                                               compression=self.compression,
+                                               oob=self.oob)
+        return packed_fn, fn_buf
+
+    def _offload(self, buf, job):
+        """ Upload a large payload buffer on its own and make it an input of job.
+        Returns the name the job sees it as.
+        """
+        name, s3_url = self.conn.upload_buffer(buf)
+        if s3_url == -1:
+            raise KottaJobError("Failed to upload a {0} byte argument of {1}".format(
+                len(memoryview(buf).cast('B')), self.__name__), job=job)
+        if s3_url not in job.desc['inputs']:
+            job.add_inputs([s3_url])
+        return name
+
+    def _submit(self, args, kwargs, func=None, packed=None):
+        """ Package one call into a new KottaJob and submit it.
+        func replaces self.func as the function that is called remotely.
+        packed is the call already packed by _pack.
+
+        Every call gets its own job and its own uniquely named payload and result
+        files, so this is safe to call from many threads at once.
+
+        Returns: (job, name of the result file, whether the submission succeeded)
+        """
+        job = KottaJob(**self._job_desc())
 
-        s3_url  = self.conn.upload_file(fn_pkl)
+        if 'inputs' in kwargs:
+            job.add_inputs(kwargs['inputs'])
 
+        if 'outputs' in kwargs:
+            job.add_outputs(kwargs['outputs'])
+
+        packed_fn, fn_buf = packed or self._pack(args, kwargs, func)
+        if self.offload_threshold:
+            fn_buf = serialize.offload_buffers(fn_buf, lambda buf: self._offload(buf, job),
+                                               self.offload_threshold)
+
+        # The signed url may already have been issued by the connection's prefetch pool
+        fn_pkl, upload_url = self.conn.reserve_upload()
+        out_pkl = "{0}.out.pkl".format(os.path.basename(fn_pkl).split('.')[0])
+
+        # A framed container, which runner.py memory-maps instead of unpickling
+        s3_url  = self._stage(fn_buf, fn_pkl, upload_url=upload_url,
+                              write=serialize.write_frames)
+
+        job.add_inputs([s3_url])
+        job.add_outputs([out_pkl])
+        executable = '/bin/bash exec.sh {0} {1}'.format(os.path.basename(fn_pkl), out_pkl)
+        if packed_fn:
+            job.add_inputs([packed_fn[1]])
+            executable = '{0} {1}'.format(executable, packed_fn[0])
+
+        job.desc = { 'jobname' : 'Kotta Ipython {0}'.format(self.func.__name__),
+                     'executable' : executable
+                   }
+
+        submit_st = job.submit(self.conn)
+        with self._lock:
+            self.job = job
+        return job, out_pkl, submit_st
+
+    def _memoized(self, result, job_id):
+        """ Present a cached result the way a call would have returned it
+        """
+        if self.block:
+            return result
+
+        job = KottaJob(**self.job_desc)
+        if job_id:
+            job.job_id = job_id
+        job.set_status('completed')
+        future = KottaFuture(job)
+        future.set_result(result)
+        return future
+
+    def _remember(self, key, job, result):
+        try:
+            self.memo.put(key, result, job_id=job.job_id, fn_digest=self._digest())
+        except Exception as e:
+            logger.warning("Failed to cache the result of %s : %s", job.job_id, e)
 
-        self.job.add_inputs([s3_url])
-        self.job.add_outputs([os.path.basename(out_pkl)])
-        self.job.desc = { 'jobname' : 'Kotta Ipython {0}'.format(self.func.__name__),
-                          'executable' : '/bin/bash exec.sh {0} {1}'.format(os.path.basename(fn_pkl),
-                                                                            os.path.basename(out_pkl))
-                        }
+    def __call__ (self, *args, **kwargs) :
+        """ Override the __call__ behavior to trap the args to the function,
+        serialize and ship to a remote node via Kotta. Pickled results sent
+        back are presented to the user.
+        """
+        if self.backend is not None:
+            return self.backend.call(self, args, kwargs)
+        return self._call_remote(args, kwargs)
 
-        submit_st = self.job.submit(self.conn)
+    def _call_remote(self, args, kwargs):
+        """ Run a call as a Kotta job
+        """
+        packed = key = None
+        if self.memo is not None:
+            digest = self._digest()
+            if digest:
+                key = self.memo.call_key(digest, args, kwargs)
+            if digest and key is None:
+                packed = self._pack(args, kwargs)
+                key = self.memo.key(digest, packed[1][1:])
+            if key:
+                hit = self.memo.get(key)
+                if hit:
+                    logger.debug("Returning memoized result of %s", self.__name__)
+                    return self._memoized(*hit)
+
+        job, out_pkl, submit_st = self._submit(args, kwargs, packed=packed)
         if not submit_st:
             # We should ideally raise an exception here with the exception object
             # containing the job object.
             logging.error("Submit failed, returning job object")
-            return self.job
+            return job
 
         if self.block :
             # Blocking behavior. Wait for completion
-            status = self.job.wait(self.conn)
+            status = job.wait(self.conn)
 
             if status == "completed":
-                #print(self.job.outputs)
-                results  = [output for output in self.job.outputs if output.file == 'out.pkl' ]
-                if results:
-                    for result in results:
-
-                        try:
-                            result.fetch()
-                        except Exception as e:
-                            logging.error("ERROR: Failed to download result %s", e)
-                            print("ERROR: Failed to download result")
-                            print("Returning job object for inspection")
-                            return (None, self.job)
-
-                        return pickle.load(open(result.file, 'rb'))
-                else:
-                    print("ERROR: No result was captured")
-                    logging.error("ERROR: No result was captured")
+                try:
+                    result = job.load_results(out_pkl)
+                except KottaJobError as e:
+                    logging.error("ERROR: %s", e)
+                    print("ERROR: {0}".format(e))
+                    print("Returning job object for inspection")
+                    return (None, job)
+                if key:
+                    self._remember(key, job, result)
+                return result
 
             else:
                 logging.debug("Job did not complete successfully")
 
         else:
-            # Non blocking. Return job object immediately
-            logging.debug("Returning job object for %s:%s", self.job.job_id, self.job.status)
+            # Non blocking. Return a future that the connection's monitor completes
+            logging.debug("Returning future for %s", job.job_id)
+            future = KottaFuture(job, return_file=out_pkl)
+            if key:
+                def remember(done):
+                    if not done.exception():
+                        self._remember(key, job, done.result())
+                future.add_done_callback(remember)
+            return future.watch(self.conn.monitor)
+
+        return job
+
+    def forget(self):
+        """ Drop all memoized results of this function
+        """
+        digest = self._digest()
+        if self.memo is not None and digest:
+            self.memo.invalidate(fn_digest=digest)
+
+    def map(self, *iterables, **kwargs):
+        """ Apply the function to every item of the iterables, like the builtin map,
+        packing chunksize calls into each Kotta job so that the per job setup is paid
+        once per chunk rather than once per call.
 
-        return self.job
+        With a backend, chunks run wherever the backend runs calls, eg. on a local
+        process pool.
 
+        Kwargs:
+             - chunksize (int) : Calls per job, at least 1. Default=100
+             - timeout (float) : Seconds to wait for all chunks. Default=None, no limit
 
-def kottajob(conn, queue, walltime, block=True, requirements='', inputs=[], **flags):
+        Returns: list of results in input order. An item that raised remotely, or
+        whose chunk failed to submit, failed or did not finish within timeout, has a
+        KottaMapError in its place.
+        """
+        chunksize = kwargs.pop('chunksize', 100)
+        timeout   = kwargs.pop('timeout', None)
+        if kwargs:
+            raise TypeError("Unexpected keyword arguments {0}".format(list(kwargs)))
+        if chunksize < 1:
+            raise ValueError("chunksize must be at least 1, not {0}".format(chunksize))
+
+        calls  = zip(*iterables)
+        chunks = []
+        while True:
+            chunk = list(islice(calls, chunksize))
+            if not chunk:
+                break
+            chunks.append(chunk)
+        if not chunks:
+            return []
+
+        def submit(chunk):
+            # Failures are returned, so that they only fail this chunk
+            try:
+                if self.backend is not None:
+                    return self.backend.submit(self, (self.func, chunk), {},
+                                               func=_kotta_map_chunk)
+                job, out_pkl, submit_st = self._submit((self.func, chunk), {},
+                                                       func=_kotta_map_chunk)
+            except Exception as e:
+                return KottaJobError("Submit failed : {0!r}".format(e))
+            if not submit_st:
+                return KottaJobError("Submit failed")
+            return KottaFuture(job, return_file=out_pkl).watch(self.conn.monitor)
+
+        if self.backend is not None:
+            pool_size = self.backend.pool_size(self) or MAP_POOL_SIZE
+        else:
+            pool_size = self.conn.pool_size
+
+        # Chunks are packed, uploaded and submitted concurrently
+        with ThreadPoolExecutor(max_workers=min(len(chunks), pool_size)) as pool:
+            futures = list(pool.map(submit, chunks))
+
+        # One timeout for all of the chunks
+        done, _ = wait([future for future in futures if isinstance(future, Future)], timeout)
+
+        results = []
+        for chunk, future in zip(chunks, futures):
+            try:
+                if isinstance(future, Exception):
+                    raise future
+                if future not in done:
+                    raise TimeoutError("Not done after {0}s".format(timeout))
+                chunk_results = future.result()
+            except Exception as e:
+                logger.error("Chunk of %s calls of %s failed : %s", len(chunk), self.__name__, e)
+                results.extend(KottaMapError("Chunk failed : {0}".format(e)) for _ in chunk)
+                continue
+
+            for success, value in chunk_results:
+                if success:
+                    results.append(value)
+                else:
+                    results.append(KottaMapError(value[0], remote_traceback=value[1]))
+        return results
+
+
+# Runs a call for job descriptions that stage runner.py and serialize.tar.gz themselves
+RUN_COMMAND = kotta_runtime.RUN_COMMAND.format(runner='runner.py',
+                                             serialize='serialize.tar.gz')
+
+def kottajob(conn, queue, walltime, block=True, requirements='', inputs=[], prebuilt_env=False,
+             memoize=False, spill_threshold=64*1024*1024, backend=None, compression=None,
+             offload_threshold=None, oob=True, **flags):
     '''     kottajob decorator
 
+    Jobs run with the runner.py and serialize package installed alongside this client.
+    Both are uploaded by the first call, as objects named by a hash of their contents, so
+    a new client version never needs the job side to be redeployed.
+
+    With prebuilt_env=True the requirements are installed once, by a build job on the same
+    queue, into an environment bundle that every job unpacks instead of reinstalling. The
+    bundle is keyed by the requirement set, so functions with the same requirements share it.
+
+    With memoize=True, or a ResultCache, results are cached on local disk keyed by the
+    function's code, closure and defaults and by the packed args. Repeated calls return the
+    cached result without submitting. Input files are keyed by name, not contents, and
+    globals the function reads are not part of the key. KottaFn.forget() drops the results.
+
+    Payloads are written in memory and streamed to the upload. Payloads larger than
+    spill_threshold bytes spill to a temporary file, which is deleted after the upload.
+
+    backend is a kotta.kotta_backends.KottaBackend that decides where calls run, eg. a
+    LocalBackend to run them on local processes, or a RoutingBackend to run only the
+    cheap ones locally. Default=None, every call runs on Kotta.
+
+    compression, eg. 'zlib', compresses payload buffers of 64KB or more before they are
+    uploaded, and runner.py decompresses them transparently. Default=None
+
+    Payload buffers of at least offload_threshold bytes, eg. large arrays, are uploaded as
+    their own objects named by a hash of their contents, so an argument reused across calls
+    is uploaded once. Jobs stage them as inputs and runner.py memory-maps them. Default=None
+
+    oob=True pickles large buffers at any depth of an argument out-of-band with pickle
+    protocol 5, which needs python 3.8 or later on the job nodes. Function code is shipped
+    for the python version of the client, which the nodes must run anyway, so this only
+    adds a requirement when builtins are called on older nodes. Set oob=False for those.
+    Default=True
+
     While we still have inputs=[] as a kwargs in kottajob, it is bad form to use it
     since inputs should be defined at function call time. Similarly outputs=[] are no
     longer defined here for that reason.
@@ -146,20 +525,17 @@ EOF
 pip3 install -r requirements.txt
 '''.format(requirements)
 
+    runtime = RuntimeBundle(conn)
+
     exec_sh = '''#!/bin/bash
 apt-get -y install python3 python3-pip
 pip3 install -U pip
 {0}
-tar -xzf serialize.tar.gz
-python3 runner.py -i $1 -o $2
-'''.format(req_string)
-
-    input_csl = 's3://klab-jobs/inputs/yadu/runner.py, s3://klab-jobs/inputs/yadu/serialize.tar.gz'
-    if inputs:
-        input_csl = input_csl + ',' + ','.join(inputs)
+{1}
+'''.format(req_string, runtime.command)
 
     job_desc  =  {'jobtype'            : 'script',
-                  'inputs'             : input_csl,
+                  'inputs'             : ','.join(inputs),
                   'output_file_stdout' : 'STDOUT.txt',
                   'output_file_stderr' : 'STDERR.txt',
                   'script_name'        : 'exec.sh',
@@ -169,11 +545,21 @@ python3 runner.py -i $1 -o $2
 
     logging.debug('Job desc : \n %s ', job_desc)
 
+    env = EnvBundle(conn, requirements, queue=queue) if prebuilt_env else None
+    memo = None
+    if isinstance(memoize, ResultCache):
+        memo = memoize
+    elif memoize:
+        memo = ResultCache()
+
     def kottajob_fn(func):
         """ The func definition is used to construct a KottaFn object
         that has the func code. On __call__ the args to func are received,
         at which point we serialize the function and it's args for shipping.
         """
-        return KottaFn(conn, job_desc, func, block, **flags)
+        return KottaFn(conn, job_desc, func, block, env=env, memo=memo,
+                       spill_threshold=spill_threshold, backend=backend,
+                       compression=compression, offload_threshold=offload_threshold,
+                       runtime=runtime, oob=oob, **flags)
 
     return kottajob_fn
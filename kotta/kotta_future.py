@@ -0,0 +1,71 @@
+""" KottaFuture, a concurrent.futures.Future for the result of a Kotta job.
+
+Non-blocking KottaFn calls return a KottaFuture. It is completed by the connection's
+JobMonitor once the job is terminal, and the result is downloaded on a small thread
+pool so that downloads overlap with jobs that are still running. Being a real Future,
+it works with concurrent.futures.as_completed and concurrent.futures.wait.
+
+"""
+
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from .kotta_job import KottaJobError
+
+logger  = logging.getLogger(__name__)
+
+_fetch_pool = None
+_fetch_pool_lock = threading.Lock()
+
+def fetch_pool():
+    """ Shared thread pool on which results are downloaded
+    """
+    global _fetch_pool
+    with _fetch_pool_lock:
+        if _fetch_pool is None:
+            _fetch_pool = ThreadPoolExecutor(max_workers=8)
+        return _fetch_pool
+
+
+class KottaFuture(Future):
+    """ Future for the result of a submitted KottaJob
+
+    result() returns the unpickled result of the job. If the job failed or its
+    result could not be fetched, result() raises and exception() returns a
+    KottaJobError. Remote jobs can not be cancelled, so cancel() returns False.
+    """
+
+    def __init__(self, job, return_file='out.pkl'):
+        super(KottaFuture, self).__init__()
+        self.job = job
+        self.return_file = return_file
+        self.set_running_or_notify_cancel()
+
+    def watch(self, monitor):
+        """ Complete this future when monitor sees the job finish.
+        Returns self.
+        """
+        monitor.add(self.job, callback=self._job_done)
+        return self
+
+    def _job_done(self, job):
+        """ Monitor callback, runs on the monitor thread so only schedules the download
+        """
+        if job.current_status != 'completed':
+            self.set_exception(KottaJobError("Job {0} finished as {1}".format(
+                job.job_id, job.current_status), job=job))
+            return
+        fetch_pool().submit(self._fetch)
+
+    def _fetch(self):
+        try:
+            result = self.job.load_results(self.return_file)
+        except Exception as e:
+            logger.debug("Failed to fetch result of %s : %s", self.job.job_id, e)
+            self.set_exception(e)
+        else:
+            self.set_result(result)
+
+    def __repr__(self):
+        return "<KottaFuture job={0} {1}>".format(self.job.job_id, self._state)
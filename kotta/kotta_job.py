@@ -5,15 +5,130 @@ http://docs.cloudkotta.org/userguide/kottalibrary.html#kottajob-class
 
 """
 
+import os
 import pickle
 import copy
 import time
+import random
 import logging
+import tempfile
+import threading
+from collections import deque, OrderedDict
 
 from .kotta_outputs import KOut
 
 logger  = logging.getLogger(__name__)
 
+class KottaJobError(Exception):
+    """ Raised when a job did not produce a usable result.
+    The job is available as the job attribute for inspection.
+    """
+
+    def __init__(self, message, job=None):
+        super(KottaJobError, self).__init__(message)
+        self.job = job
+
+
+class PollPolicy(object):
+    """ Decides how long to sleep between status polls of a job.
+
+    Polls start every initial seconds and back off by factor up to maximum, with
+    +/- jitter (a fraction of the delay) so that many waiters do not poll in lockstep.
+    Around the times a job is expected to end, ie. the median runtime of past jobs
+    with the same jobname and its walltime, polls are kept near_interval apart so
+    that completion is noticed promptly. Jobs without a jobname of their own have no
+    past jobs to learn from, and are not recorded.
+    """
+
+    # Recent runtimes of completed jobs by jobname, shared by all policies. The
+    # history_names most recently used jobnames are kept.
+    history       = OrderedDict()
+    history_size  = 20
+    history_names = 256
+    _history_lock = threading.Lock()
+
+    def __init__(self, initial=0.5, factor=1.5, maximum=30, jitter=0.25,
+                 near_interval=1, near_fraction=0.1, walltime_scale=60):
+        """
+        Kwargs:
+             - initial (float) : First delay in seconds. Default=0.5
+             - factor (float) : Growth of the delay after each poll. Default=1.5
+             - maximum (float) : Cap on the delay in seconds. Default=30
+             - jitter (float) : Random spread as a fraction of the delay. Default=0.25
+             - near_interval (float) : Delay used close to an expected end. Default=1
+             - near_fraction (float) : How close counts as close, as a fraction of the
+               expected runtime. Default=0.1
+             - walltime_scale (float) : Seconds per unit of walltime. Default=60, minutes
+
+        """
+        self.initial        = initial
+        self.factor         = factor
+        self.maximum        = maximum
+        self.jitter         = jitter
+        self.near_interval  = near_interval
+        self.near_fraction  = near_fraction
+        self.walltime_scale = walltime_scale
+
+    @classmethod
+    def constant(cls, sleep):
+        """ Policy that polls every sleep seconds, like the original fixed sleep
+        """
+        return cls(initial=sleep, factor=1, maximum=sleep, jitter=0, near_interval=sleep)
+
+    @classmethod
+    def record(cls, jobname, runtime):
+        """ Remember the runtime of a completed job. Ignored if jobname is None
+        """
+        if jobname is None:
+            return
+        with cls._history_lock:
+            runtimes = cls.history.pop(jobname, None) or deque(maxlen=cls.history_size)
+            runtimes.append(runtime)
+            cls.history[jobname] = runtimes
+            while len(cls.history) > cls.history_names:
+                cls.history.popitem(last=False)
+
+    @staticmethod
+    def history_key(job):
+        """ The jobname that the runtimes of job are recorded under, or None if it was
+        not given one and is only known by its job id
+        """
+        jobname = job.desc.get('jobname')
+        return None if jobname == job.job_id else jobname
+
+    def expected_ends(self, job):
+        """ Seconds after submission at which the job is expected to end
+        """
+        ends = []
+        with self._history_lock:
+            runtimes = sorted(self.history.get(self.history_key(job), ()))
+        if runtimes:
+            ends.append(runtimes[len(runtimes) // 2])
+        try:
+            ends.append(float(job.desc.get('walltime')) * self.walltime_scale)
+        except (TypeError, ValueError):
+            pass
+        return ends
+
+    def next_delay(self, polls, elapsed, job):
+        """ Seconds to sleep after the polls-th poll (0 based), elapsed seconds after
+        the job was submitted.
+        """
+        delay = min(self.maximum, self.initial * (self.factor ** polls))
+
+        for end in self.expected_ends(job):
+            window = max(end * self.near_fraction, self.near_interval)
+            if abs(end - elapsed) <= window:
+                delay = min(delay, self.near_interval)
+            elif elapsed < end:
+                # Sleep no further than the start of the window
+                delay = min(delay, max(end - window - elapsed, self.near_interval))
+
+        if self.jitter:
+            delay *= 1 + random.uniform(-self.jitter, self.jitter)
+        return max(delay, 0)
+
+
 class KottaJob(object):
     """ KottaJob object represents a job on Kotta
 
@@ -21,6 +136,9 @@ class KottaJob(object):
 
     """
 
+    # Once a job reaches one of these it will not change again
+    terminal_stati = ('completed', 'cancelled', 'failed')
+
     def __init__ (self, kconn=None, job_id=None, **kwargs) :
         """ Create the job
         If kconn and job_id are provided, the job object is updated to reflect the job launched on
@@ -41,6 +159,8 @@ class KottaJob(object):
 
         self.__job_id     = []
         self.__status     = 'unsubmitted'
+        self.submitted_at = None
+        self.polls        = 0
         self.__valid_stati= ['unsubmitted', 'pending', 'staging_inputs', 'cancelled',
                              'completed', 'failed', 'processing', 'staging_outputs']
         self.__job_desc.update(kwargs)
@@ -56,9 +176,16 @@ class KottaJob(object):
         Returns True/False depending on whether the job submission succeeded.
         """
         response  = kconn.submit_task(self.__job_desc)
+        return self._submitted(response)
+
+    def _submitted(self, response):
+        """ Only to be used internally.
+        Update the job from the response to a submit request.
+        """
         if response['status'] == "Success":
             self.job_id = response['job_id']
             self.__status = 'pending'
+            self.submitted_at = time.time()
             return True
 
         else:
@@ -70,51 +197,106 @@ class KottaJob(object):
         """
         raise NotImplementedError
 
-    def wait(self, kconn, maxwait=600, sleep=2, silent=True):
+    def wait(self, kconn, maxwait=600, sleep=None, silent=True, timeout=None, policy=None):
         """ Wait for job completion upto a maxtime duration.
 
+        Kwargs:
+             - maxwait (float) : Seconds after which False is returned. Default=600
+             - sleep (float) : Poll at this fixed interval instead of adaptively
+             - timeout (float) : Seconds after which TimeoutError is raised. Overrides maxwait
+             - policy (PollPolicy) : Adaptive polling policy. Default=PollPolicy()
+
+        Returns: The terminal status of the job, or False if maxwait elapsed.
+        The number of polls made is left in self.polls.
+
         """
-        for _ in range(int(maxwait/sleep)):
+        polls = self._polls(maxwait, sleep, silent, timeout, policy)
+        try:
+            delay = next(polls)
+            while True:
+                if delay:
+                    time.sleep(delay)
+                delay = polls.send(self.status(kconn))
+        except StopIteration as done:
+            return done.value
+
+    def _polls(self, maxwait=600, sleep=None, silent=True, timeout=None, policy=None):
+        """ Only to be used internally.
+        The polling schedule of wait, for both blocking and asyncio callers. Yields the
+        seconds to sleep before each status poll, 0 before the first, and is sent the
+        status that poll returned. Returns the result of wait, or raises TimeoutError.
+        """
+        if policy is None:
+            policy = PollPolicy.constant(sleep) if sleep else PollPolicy()
+        limit = maxwait if timeout is None else timeout
+
+        start = time.time()
+        submitted = self.submitted_at or start
+        self.polls = 0
+        delay = 0
+        while True:
             if not silent:
                 logger.debug("waiting on %s ", self.job_id)
-            cur_status = self.status(kconn)
-            if cur_status in [ 'completed', 'cancelled', 'failed' ]:
+            cur_status = yield delay
+            self.polls += 1
+            if cur_status in self.terminal_stati:
+                if cur_status == 'completed':
+                    policy.record(policy.history_key(self), time.time() - submitted)
+                logger.debug("Job %s is %s after %s polls", self.job_id, cur_status, self.polls)
                 return cur_status
-            time.sleep(sleep)
 
+            waited = time.time() - start
+            if waited >= limit:
+                break
+            delay = min(policy.next_delay(self.polls - 1, time.time() - submitted, self),
+                        limit - waited)
+
+        logger.debug("Gave up on %s after %s polls", self.job_id, self.polls)
+        if timeout is not None:
+            raise TimeoutError("Job {0} not done after {1}s ({2} polls)".format(
+                self.job_id, timeout, self.polls))
         return False
 
     def status(self, kconn):
         """ Get status of a submitted job
+        Jobs in a terminal state can not change, so they are not queried again.
         """
-        if self.job_id :
-            status = kconn.status_task(self.job_id)
-            if self.__status == status.get('status'):
-                return self.__status
+        if self.job_id and self.__status not in self.terminal_stati:
+            self._update_status(kconn.status_task(self.job_id))
+        return self.__status
 
-            self.set_status(status.get('status'))
+    def _update_status(self, status):
+        """ Only to be used internally.
+        Update the job from a status dict as returned by Kotta.status_task
+        """
+        if self.__status == status.get('status'):
+            return self.__status
 
-            if 'outputs' in status:
-                logger.debug("Received new status")
-                outputs = []
-                for output in status['outputs']:
-                    kout = KOut(output)
+        # The status dict may be shared with a status cache, do not modify it
+        status = dict(status)
+        self.set_status(status.get('status'))
 
-                    if kout.file.endswith('STDOUT.txt'):
-                        status['STDOUT'] = kout
-                        logger.debug("Set status for statas['STDOUT']: %s", kout)
+        if 'outputs' in status:
+            logger.debug("Received new status")
+            outputs = []
+            for output in status['outputs']:
+                kout = KOut(output)
 
-                    elif kout.file.endswith('STDERR.txt'):
-                        status['STDERR'] = kout
-                        logger.debug("Set status for status['STDERR']: %s", kout)
+                if kout.file.endswith('STDOUT.txt'):
+                    status['STDOUT'] = kout
+                    logger.debug("Set status for statas['STDOUT']: %s", kout)
 
-                    else:
-                        outputs.extend([kout])
+                elif kout.file.endswith('STDERR.txt'):
+                    status['STDERR'] = kout
+                    logger.debug("Set status for status['STDERR']: %s", kout)
 
-                status['outputs'] = outputs
+                else:
+                    outputs.extend([kout])
 
-            self.__job_desc.update(status)
-            logger.debug(self.__job_desc)
+            status['outputs'] = outputs
+
+        self.__job_desc.update(status)
+        logger.debug(self.__job_desc)
         return self.__status
 
     def set_status(self, status_string):
@@ -127,6 +309,12 @@ class KottaJob(object):
             print("[ERROR] Invalid Status : {0}".format(status_string))
             raise TypeError
 
+    @property
+    def current_status(self):
+        """ Returns the last known status without querying Kotta
+        """
+        return self.__status
+
     @property
     def jobname(self):
         """ Return the friendly name of the job
@@ -262,3 +450,31 @@ class KottaJob(object):
         else:
             logger.warning("WARN: Job status != completed")
             return None
+
+    def load_results(self, return_file='out.pkl'):
+        """ Fetch and unpickle the result file of a completed job.
+        Unlike get_results, failures raise KottaJobError instead of returning None.
+        The file is downloaded to a private temporary file, so concurrent calls
+        for different jobs do not collide.
+        """
+        if self.__status != "completed":
+            raise KottaJobError("Job {0} is {1}, not completed".format(self.job_id, self.__status),
+                                job=self)
+
+        results = [output for output in self.outputs if output.file == return_file]
+        if not results or not results[0].url:
+            raise KottaJobError("Job {0} had no result {1}".format(self.job_id, return_file),
+                                job=self)
+
+        fd, path = tempfile.mkstemp(suffix='.pkl')
+        os.close(fd)
+        try:
+            try:
+                results[0].fetch(path)
+            except Exception as e:
+                raise KottaJobError("Failed to download result of job {0} : {1}".format(
+                    self.job_id, e), job=self)
+            with open(path, 'rb') as result:
+                return pickle.load(result)
+        finally:
+            os.remove(path)
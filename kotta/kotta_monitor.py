@@ -0,0 +1,225 @@
+""" JobMonitor tracks many KottaJobs from a single background thread.
+
+Instead of one blocking KottaJob.wait loop per job, jobs are registered with a monitor
+that polls all outstanding jobs in batched sweeps using Kotta.status_many, and calls
+back when each job reaches a terminal state.
+
+"""
+
+import time
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+logger  = logging.getLogger(__name__)
+
+class JobMonitor(object):
+    """ Polls all outstanding jobs of a Kotta connection in batched sweeps.
+
+    Jobs stop being polled once they reach a terminal state, at which point their
+    callbacks are called with the job as the only argument. Callbacks run on the
+    monitor thread and should return quickly.
+
+    Status requests are made from a pool of threads that lives until stop(), so that
+    sweeps reuse its threads and their keep-alive sessions.
+    """
+
+    def __init__(self, kconn, interval=2, batch_size=500, max_workers=None):
+        """ Create a monitor. The background thread starts with the first job added.
+
+        Args:
+             - kconn (Kotta) : Connection used to poll the jobs
+
+        Kwargs:
+             - interval (float) : Seconds between the start of consecutive sweeps. Default=2
+             - batch_size (int) : Max job ids fetched by each status_many call. Default=500
+             - max_workers (int) : Concurrent status requests per batch. Default=kconn.pool_size
+
+        """
+        self.kconn       = kconn
+        self.interval    = interval
+        self.batch_size  = batch_size
+        self.max_workers = max_workers
+        self.sweeps      = 0
+
+        self._jobs      = {}
+        self._finished  = Counter()
+        self._lock      = threading.Lock()
+        self._idle      = threading.Condition(self._lock)
+        self._stopped   = threading.Event()
+        self._wakeup    = threading.Event()
+        self._thread    = None
+        self._executor  = None
+
+    def add(self, job, callback=None):
+        """ Start monitoring a submitted job
+
+        Kwargs:
+             - callback (callable) : Called with the job once it is terminal
+
+        Returns: the job
+
+        """
+        if not job.job_id:
+            raise ValueError("Only submitted jobs can be monitored")
+
+        callbacks = [callback] if callback else []
+        if job.current_status in job.terminal_stati:
+            self._dispatch(job, callbacks)
+            return job
+
+        with self._lock:
+            if job.job_id in self._jobs:
+                self._jobs[job.job_id][1].extend(callbacks)
+            else:
+                self._jobs[job.job_id] = (job, callbacks)
+
+            # A stopped thread may still be finishing its sweep, so it is replaced too
+            if self._thread is None or not self._thread.is_alive() or self._stopped.is_set():
+                self._stopped = threading.Event()
+                self._thread = threading.Thread(target=self._run, args=(self._stopped,),
+                                                name='kotta-job-monitor')
+                self._thread.daemon = True
+                self._thread.start()
+        return job
+
+    def remove(self, job):
+        """ Stop monitoring a job without calling its callbacks
+        """
+        with self._lock:
+            self._jobs.pop(job.job_id, None)
+            if not self._jobs:
+                self._idle.notify_all()
+
+    @property
+    def outstanding(self):
+        """ List of the jobs that have not reached a terminal state
+        """
+        with self._lock:
+            return [job for job, _ in self._jobs.values()]
+
+    def counts(self):
+        """ Returns a dict of the number of monitored jobs in each state
+        """
+        with self._lock:
+            counts = Counter(job.current_status for job, _ in self._jobs.values())
+            counts.update(self._finished)
+        return dict(counts)
+
+    def _dispatch(self, job, callbacks):
+        with self._lock:
+            self._finished[job.current_status] += 1
+        for callback in callbacks:
+            try:
+                callback(job)
+            except Exception:
+                logger.exception("Callback for job %s failed", job.job_id)
+
+    @property
+    def executor(self):
+        """ The pool that status requests are made from, started on first use
+        """
+        with self._lock:
+            if self._executor is None:
+                workers = self.max_workers or self.kconn.pool_size
+                self._executor = ThreadPoolExecutor(max_workers=workers,
+                                                    thread_name_prefix='kotta-status')
+            return self._executor
+
+    def sweep(self):
+        """ Poll every outstanding job once, in batches.
+        Returns the number of jobs that became terminal.
+        """
+        with self._lock:
+            job_ids = list(self._jobs)
+        executor = self.executor if job_ids else None
+
+        done = 0
+        for start in range(0, len(job_ids), self.batch_size):
+            batch = job_ids[start:start + self.batch_size]
+            stati = self.kconn.status_many(batch, executor=executor)
+
+            for jobid in batch:
+                status = stati.get(jobid, {})
+                with self._lock:
+                    job, callbacks = self._jobs.get(jobid, (None, None))
+                if job is None:
+                    continue
+
+                if 'error' in status:
+                    logger.warning("Failed to poll job %s : %s", jobid, status['error'])
+                    continue
+
+                try:
+                    job._update_status(status)
+                except TypeError:
+                    logger.warning("Job %s returned an invalid status %s", jobid,
+                                   status.get('status'))
+                    continue
+
+                if job.current_status in job.terminal_stati:
+                    with self._lock:
+                        self._jobs.pop(jobid, None)
+                    self._dispatch(job, callbacks)
+                    done += 1
+
+        self.sweeps += 1
+        with self._lock:
+            if not self._jobs:
+                self._idle.notify_all()
+        return done
+
+    def _run(self, stopped):
+        """ Background loop, exits once no jobs are outstanding or stopped is set
+        """
+        while not stopped.is_set():
+            start = time.time()
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception("Job monitor sweep failed")
+
+            with self._lock:
+                if not self._jobs:
+                    if self._thread is threading.current_thread():
+                        self._thread = None
+                    return
+
+            self._wakeup.wait(max(self.interval - (time.time() - start), 0))
+            self._wakeup.clear()
+
+    def poll_now(self):
+        """ Start the next sweep without waiting for the interval to elapse
+        """
+        self._wakeup.set()
+
+    def wait(self, timeout=None):
+        """ Block until all monitored jobs are terminal.
+        Returns False if timeout seconds elapsed first.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            while self._jobs:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def stop(self):
+        """ Stop polling and release the status request threads. Outstanding jobs remain
+        registered and polling resumes when another job is added.
+        """
+        with self._lock:
+            self._stopped.set()
+            thread, self._thread = self._thread, None
+        self._wakeup.set()
+        # From a callback, the monitor thread exits once the callback returns
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
@@ -0,0 +1,106 @@
+""" The client code that kottajob functions run with on Kotta.
+
+Jobs used to stage runner.py and serialize.tar.gz from fixed s3 objects, which had to be
+reuploaded by hand whenever the payload format changed, and broke every call until they
+were. A RuntimeBundle instead builds both from the installed kotta and serialize packages
+and uploads them as objects named by a hash of their contents, like packed functions and
+environment bundles. Jobs therefore always run the runner and serialize that packed their
+payloads, and a changed client uploads its new runtime once, by its first call.
+
+"""
+
+import io
+import os
+import gzip
+import tarfile
+import hashlib
+import logging
+import threading
+
+import serialize
+
+from .kotta_job import KottaJobError
+
+logger  = logging.getLogger(__name__)
+
+# Runs a call on the job node. $3, when given, is the separately uploaded function
+RUN_COMMAND = '''tar -xzf {serialize}
+python3 {runner} -i $1 -o $2 ${{3:+-f $3}}'''
+
+def package_tarball(package_dir, arcname):
+    """ A gzipped tarball of the python files of a package, as bytes. Timestamps and
+    owners are left out, so equal sources always give equal bytes.
+    """
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(package_dir):
+        dirnames[:] = sorted(d for d in dirnames if d != '__pycache__')
+        paths.extend(os.path.join(dirpath, name) for name in sorted(filenames)
+                     if name.endswith('.py'))
+
+    data = io.BytesIO()
+    with gzip.GzipFile(filename='', mode='wb', fileobj=data, mtime=0) as gz:
+        with tarfile.open(fileobj=gz, mode='w', format=tarfile.USTAR_FORMAT) as tar:
+            for path in paths:
+                with open(path, 'rb') as source:
+                    content = source.read()
+                relpath = os.path.relpath(path, package_dir).replace(os.sep, '/')
+                info = tarfile.TarInfo('{0}/{1}'.format(arcname, relpath))
+                info.size = len(content)
+                info.mode = 0o644
+                tar.addfile(info, io.BytesIO(content))
+    return data.getvalue()
+
+
+class RuntimeBundle(object):
+    """ runner.py and the serialize package, as uploaded for the jobs of a connection.
+
+    Files are uploaded with Kotta.upload_buffer, so each version is uploaded once per
+    connection, or once ever with an UploadCache, and staged on the node under a name
+    that includes the hash of its contents.
+    """
+
+    def __init__(self, kconn):
+        """ Describe the runtime of the installed packages. Nothing is uploaded until
+        inputs() is first called.
+
+        Args:
+             - kconn (Kotta) : Connection the files are uploaded with
+
+        """
+        self.kconn = kconn
+        runner = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'runner.py')
+        with open(runner, 'rb') as rfile:
+            runner_bytes = rfile.read()
+        tarball = package_tarball(os.path.dirname(os.path.abspath(serialize.__file__)),
+                                  'serialize')
+
+        # suffix -> contents, named the way upload_buffer names them
+        self.files = {'.runner.py' : runner_bytes, '.serialize.tar.gz' : tarball}
+        self.names = {suffix : "{0}{1}".format(hashlib.sha256(data).hexdigest()[:32], suffix)
+                      for suffix, data in self.files.items()}
+        self._urls = None
+        self._lock = threading.Lock()
+
+    @property
+    def command(self):
+        """ Shell lines that run a call with this runtime, see RUN_COMMAND
+        """
+        return RUN_COMMAND.format(runner=self.names['.runner.py'],
+                                  serialize=self.names['.serialize.tar.gz'])
+
+    def inputs(self):
+        """ Returns the s3 urls of the runtime files, uploading them on first use
+
+        Raises: KottaJobError if a signed url was not issued
+        """
+        with self._lock:
+            if self._urls is None:
+                urls = []
+                for suffix, data in sorted(self.files.items()):
+                    name, s3_url = self.kconn.upload_buffer(data, suffix=suffix)
+                    if s3_url == -1:
+                        raise KottaJobError("Failed to upload the runtime file {0}".format(name))
+                    logger.debug("Runtime file %s is at %s", name, s3_url)
+                    urls.append(s3_url)
+                self._urls = urls
+            return list(self._urls)
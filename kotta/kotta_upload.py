@@ -0,0 +1,333 @@
+""" Streaming and multipart uploads to signed urls.
+
+UploadReader streams a file, or a byte range of it, as a request body.
+BufferFile lets an in-memory buffer be streamed the same way without copying it.
+MultipartUpload splits a large file into parts that are uploaded in parallel to
+per-part signed urls, and records completed parts so that a failed upload can resume.
+
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from xml.sax.saxutils import escape
+
+import requests
+
+from .kotta_cache import write_json
+
+logger  = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024*1024
+
+class UploadReader(object):
+    """ Read-only file wrapper used as a streaming request body.
+
+    Hands the file to the http layer chunk by chunk so that it is never fully loaded
+    into memory, and counts the bytes sent. Supports tell/seek so that urllib3 can
+    rewind the body when it retries a request. If a hashlib hasher is given, the body
+    is hashed as it is read.
+    """
+
+    def __init__(self, fileobj, length, chunk_size=CHUNK_SIZE, hasher=None):
+        self._fileobj   = fileobj
+        self._start     = fileobj.tell()
+        self.length     = length
+        self.chunk_size = chunk_size
+        self.bytes_read = 0
+        self.hasher     = hasher
+
+    @property
+    def digest(self):
+        """ Hex digest of the body, if it was hashed and has been read completely
+        """
+        if self.hasher is None or self.bytes_read != self.length:
+            return None
+        return self.hasher.hexdigest()
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        """ Read at most chunk_size bytes, without going past length
+        """
+        remaining = self.length - self.bytes_read
+        if size is None or size < 0 or size > self.chunk_size:
+            size = self.chunk_size
+        data = self._fileobj.read(min(size, remaining))
+        self.bytes_read += len(data)
+        if self.hasher is not None:
+            self.hasher.update(data)
+        return data
+
+    def tell(self):
+        """ Position relative to the start of the body, which is what requests and
+        urllib3 expect when sizing and rewinding it.
+        """
+        return self.bytes_read
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """ Only absolute seeks are needed to rewind a body
+        """
+        if whence != os.SEEK_SET:
+            raise IOError("UploadReader only supports absolute seeks")
+        self._fileobj.seek(self._start + offset)
+        self.bytes_read = offset
+        if self.hasher is not None:
+            # A rewind to the start restarts the hash, anything else invalidates it
+            self.hasher = hashlib.new(self.hasher.name) if offset == 0 else None
+        return offset
+
+
+class BufferFile(object):
+    """ Read-only, seekable file over a contiguous buffer, eg. a large array.
+    Only the chunks being read are copied, never the whole buffer.
+    """
+
+    def __init__(self, buf):
+        self._view = memoryview(buf).cast('B')
+        self._pos  = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self._view) - self._pos
+        data = self._view[self._pos:self._pos + size].tobytes()
+        self._pos += len(data)
+        return data
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += len(self._view)
+        self._pos = max(0, offset)
+        return self._pos
+
+
+class MultipartUpload(object):
+    """ Parallel, resumable upload of one large file.
+
+    The file is split into parts of part_size bytes. Signed urls for the parts are
+    requested from Kotta by adding part_count and part_size to the usual upload_url
+    request. A server that supports multipart uploads answers with:
+
+        { "upload_url"   : <url of the whole object>,
+          "part_urls"    : [<signed PUT url for part 1>, ...],
+          "complete_url" : <signed POST url that completes the upload> }
+
+    Servers that only return upload_url do not support multipart, and the caller
+    falls back to a single streaming PUT.
+
+    Progress is saved to a manifest under state_dir after every part. Uploading the
+    same unchanged file again skips the parts that already completed.
+
+    Each part is hashed as it is sent. Once all parts are uploaded, digest holds the
+    sha256 of the part digests in order, suffixed with the number of parts as in S3
+    multipart ETags. It depends on part_size, so it never equals the plain sha256 of
+    the file, and it is None if a resumed part was not hashed.
+    """
+
+    def __init__(self, kconn, path, part_size, workers=4, part_retries=3, state_dir=None):
+        self.kconn        = kconn
+        self.path         = path
+        self.part_size    = part_size
+        self.workers      = workers
+        self.part_retries = part_retries
+        self.state_dir    = state_dir or os.path.join(os.path.expanduser('~'), '.kotta', 'uploads')
+
+        stat = os.stat(path)
+        self.size   = stat.st_size
+        self.mtime  = stat.st_mtime
+        self.nparts = max(1, -(-self.size // part_size))
+
+        key = "{0}:{1}".format(os.path.abspath(path), part_size).encode('utf-8')
+        self.manifest_path = os.path.join(self.state_dir,
+                                          hashlib.sha1(key).hexdigest() + '.json')
+        self.manifest = self._load_manifest()
+        self.digest   = None
+        self._lock = threading.Lock()
+
+    def _load_manifest(self):
+        """ Returns the saved manifest if it belongs to this exact file, else None
+        """
+        try:
+            with open(self.manifest_path) as mfile:
+                manifest = json.load(mfile)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if (manifest.get('size') != self.size or manifest.get('mtime') != self.mtime or
+                len(manifest.get('part_urls', [])) != self.nparts):
+            logger.debug("Discarding stale upload manifest for %s", self.path)
+            return None
+        return manifest
+
+    def _save_manifest(self):
+        """ Atomically write the manifest. Called with the lock held.
+        """
+        write_json(self.manifest_path, self.manifest)
+
+    def discard(self):
+        """ Forget any saved progress
+        """
+        self.manifest = None
+        if os.path.exists(self.manifest_path):
+            os.remove(self.manifest_path)
+
+    @property
+    def resumable(self):
+        """ True if signed part urls from an earlier attempt are available
+        """
+        return self.manifest is not None
+
+    @property
+    def url_request(self):
+        """ Extra fields that ask Kotta for multipart upload urls
+        """
+        return {'part_count' : self.nparts,
+                'part_size'  : self.part_size}
+
+    def start(self, response):
+        """ Start a new upload from the response to an upload_url request.
+
+        Returns: False if the response has no part urls, ie. the server does not
+        support multipart uploads
+
+        """
+        part_urls = response.get('part_urls')
+        if not part_urls or not response.get('complete_url'):
+            return False
+
+        if len(part_urls) != self.nparts:
+            raise ValueError("Expected {0} part urls, received {1}".format(self.nparts,
+                                                                           len(part_urls)))
+        self.manifest = {'path'         : os.path.abspath(self.path),
+                         'size'         : self.size,
+                         'mtime'        : self.mtime,
+                         'upload_url'   : response.get('upload_url'),
+                         'part_urls'    : part_urls,
+                         'complete_url' : response['complete_url'],
+                         'etags'        : {},
+                         'digests'      : {}}
+        with self._lock:
+            self._save_manifest()
+        return True
+
+    def _upload_part(self, index):
+        """ Upload part index (0 based), retrying failures with exponential backoff.
+        Returns (ETag of the part, sha256 of the part).
+        """
+        offset = index * self.part_size
+        length = min(self.part_size, self.size - offset)
+        url    = self.manifest['part_urls'][index]
+
+        for attempt in range(self.part_retries + 1):
+            try:
+                with open(self.path, 'rb') as infile:
+                    infile.seek(offset)
+                    reader = UploadReader(infile, length, hasher=hashlib.sha256())
+                    res = self.kconn.session.put(url, data=reader,
+                                                 timeout=self.kconn.timeouts['upload'])
+                if 200 <= res.status_code < 300:
+                    return res.headers.get('ETag', ''), reader.digest
+
+                if res.status_code == 403:
+                    # The signed url has expired, retrying will not help
+                    raise requests.HTTPError("Part {0} of {1} rejected with HTTP 403".format(
+                        index + 1, self.path), response=res)
+
+                error = "HTTP {0}".format(res.status_code)
+
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = repr(e)
+
+            if attempt < self.part_retries:
+                delay = 2 ** attempt
+                logger.debug("Part %s of %s failed (%s), retrying in %ss",
+                             index + 1, self.path, error, delay)
+                time.sleep(delay)
+
+        raise requests.HTTPError("Part {0} of {1} failed after {2} attempts : {3}".format(
+            index + 1, self.path, self.part_retries + 1, error))
+
+    def _part_done(self, index, etag, digest):
+        with self._lock:
+            self.manifest['etags'][str(index + 1)] = etag
+            if digest:
+                self.manifest.setdefault('digests', {})[str(index + 1)] = digest
+            self._save_manifest()
+
+    def _combined_digest(self):
+        """ The digest of the whole file from its part digests, or None if one is missing
+        """
+        digests = self.manifest.get('digests', {})
+        nums = [str(num) for num in range(1, self.nparts + 1)]
+        if not all(num in digests for num in nums):
+            return None
+        combined = hashlib.sha256(b''.join(bytes.fromhex(digests[num]) for num in nums))
+        return "{0}-{1}".format(combined.hexdigest(), self.nparts)
+
+    def _complete(self):
+        """ Ask S3 to assemble the uploaded parts
+        """
+        parts = ''.join("<Part><PartNumber>{0}</PartNumber><ETag>{1}</ETag></Part>".format(
+            num, escape(self.manifest['etags'][str(num)])) for num in range(1, self.nparts + 1))
+        body = "<CompleteMultipartUpload>{0}</CompleteMultipartUpload>".format(parts)
+        res = self.kconn.session.post(self.manifest['complete_url'], data=body.encode('utf-8'),
+                                      timeout=self.kconn.timeouts['upload'])
+        # S3 can report a failed completion inside a 200 response
+        if res.status_code != 200 or '<Error>' in res.text:
+            raise requests.HTTPError("Completing upload of {0} failed with HTTP {1} : {2}".format(
+                self.path, res.status_code, res.text[:512]), response=res)
+
+    def run(self):
+        """ Upload all parts that have not completed yet and complete the upload.
+
+        Returns: The signed url of the whole object, as it would have been returned for
+        a single part upload
+
+        Raises: requests.HTTPError if a part fails after its retries. Completed parts
+        are kept so that the next attempt resumes from them, unless the part urls have
+        expired. Then the manifest is discarded and the error has an HTTP 403 response,
+        so that the caller can start a new upload.
+
+        """
+        pending = [index for index in range(self.nparts)
+                   if str(index + 1) not in self.manifest['etags']]
+        logger.info("Uploading %s in %s parts, %s already done",
+                    self.path, self.nparts, self.nparts - len(pending))
+
+        start = time.time()
+        try:
+            with ThreadPoolExecutor(max_workers=min(self.workers, max(len(pending), 1))) as pool:
+                futures = {pool.submit(self._upload_part, index) : index for index in pending}
+                errors  = []
+                for future in as_completed(futures):
+                    try:
+                        self._part_done(futures[future], *future.result())
+                    except requests.HTTPError as e:
+                        errors.append(e)
+                if errors:
+                    raise errors[0]
+
+            self._complete()
+
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code == 403:
+                self.discard()
+            raise
+
+        upload_url  = self.manifest['upload_url'] or self.manifest['part_urls'][0]
+        self.digest = self._combined_digest()
+        elapsed = max(time.time() - start, 1e-6)
+        logger.info("Uploaded %s : %s bytes in %.2fs (%.0f bytes/sec)",
+                    self.path, self.size, elapsed, self.size / elapsed)
+        self.discard()
+        return upload_url
@@ -0,0 +1,136 @@
+""" Pool of pre-issued signed upload urls.
+
+Requesting a signed url is a full round trip to Kotta before every upload. UploadUrlPool
+requests urls for uniquely named files ahead of time from a background thread, so that
+uploads on the critical path can start immediately.
+
+"""
+
+import time
+import uuid
+import logging
+import calendar
+import threading
+from collections import deque
+from urllib.parse import urlparse, parse_qs
+
+logger  = logging.getLogger(__name__)
+
+def url_expiry(url, default):
+    """ Returns the epoch time at which a signed url expires.
+
+    Understands S3 signature v4 (X-Amz-Date + X-Amz-Expires) and v2 (Expires) urls,
+    and returns default for anything else.
+    """
+    query = parse_qs(urlparse(url).query)
+    try:
+        if 'X-Amz-Date' in query and 'X-Amz-Expires' in query:
+            signed = time.strptime(query['X-Amz-Date'][0], "%Y%m%dT%H%M%SZ")
+            return calendar.timegm(signed) + int(query['X-Amz-Expires'][0])
+        if 'Expires' in query:
+            return int(query['Expires'][0])
+    except ValueError:
+        logger.debug("Could not parse expiry of %s", url)
+    return default
+
+
+class UploadUrlPool(object):
+    """ Keeps up to size signed upload urls ready for use.
+
+    Each url is issued for a new file named <prefix>/<uuid><suffix>. Urls are dropped
+    once they are within margin seconds of expiring. Urls whose expiry can not be
+    parsed are assumed to last ttl seconds.
+    """
+
+    def __init__(self, kconn, size=8, prefix='pkl', suffix='.in.pkl', ttl=900, margin=60):
+        self.kconn  = kconn
+        self.size   = size
+        self.prefix = prefix
+        self.suffix = suffix
+        self.ttl    = ttl
+        self.margin = margin
+
+        self._urls    = deque()
+        self._lock    = threading.Lock()
+        self._refill  = threading.Event()
+        self._stopped = threading.Event()
+        self._thread  = threading.Thread(target=self._run, name='kotta-url-pool')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _new_path(self):
+        return "{0}/{1}{2}".format(self.prefix, uuid.uuid4(), self.suffix)
+
+    def _issue(self, path):
+        """ Request a signed url for path. Returns (path, url, expires) or None.
+        """
+        code, response = self.kconn.signed_url(path)
+        if code != 200:
+            logger.error("Failed to prefetch upload url : %s", response.get('reason', 'Unknown'))
+            return None
+        url = response.get('upload_url')
+        return path, url, url_expiry(url, time.time() + self.ttl)
+
+    def _expire(self):
+        """ Drop urls that are about to expire. Called with the lock held.
+        """
+        deadline = time.time() + self.margin
+        while self._urls and self._urls[0][2] <= deadline:
+            logger.debug("Dropping expiring upload url for %s", self._urls[0][0])
+            self._urls.popleft()
+
+    def _run(self):
+        """ Background loop that tops the pool up to size
+        """
+        backoff = 1
+        while not self._stopped.is_set():
+            with self._lock:
+                self._expire()
+                missing = self.size - len(self._urls)
+
+            for _ in range(missing):
+                try:
+                    entry = self._issue(self._new_path())
+                except Exception as e:
+                    logger.error("Failed to prefetch upload url : %s", e)
+                    entry = None
+
+                if entry is None:
+                    # Do not hammer the server while it is refusing urls
+                    self._stopped.wait(backoff)
+                    backoff = min(backoff * 2, 60)
+                    break
+
+                backoff = 1
+                with self._lock:
+                    self._urls.append(entry)
+
+            # Wake up when a url is taken, or in time to drop urls before they expire
+            self._refill.wait(max(min(self.margin, self.ttl) / 2, 1))
+            self._refill.clear()
+
+    def acquire(self):
+        """ Returns (path, signed url) for a new uniquely named file.
+        Falls back to requesting a url directly if the pool is empty.
+        """
+        with self._lock:
+            self._expire()
+            entry = self._urls.popleft() if self._urls else None
+        self._refill.set()
+
+        if entry is None:
+            logger.debug("Upload url pool is empty, requesting a url inline")
+            entry = self._issue(self._new_path())
+            if entry is None:
+                return self._new_path(), None
+        return entry[0], entry[1]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._urls)
+
+    def close(self):
+        """ Stop the background refill thread
+        """
+        self._stopped.set()
+        self._refill.set()
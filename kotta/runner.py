@@ -3,33 +3,45 @@
 Remote side executor code.
 
 Executes a pickled package of a function and it's arguments and returns it's result objects
-in a pickled file.
+in a pickled file. Arguments that were shipped as separate input files are memory-mapped
+from the working directory.
 """
 
 import argparse
+import builtins
 import pickle
 
-from serialize import unpack_apply_message
+from serialize import unpack_apply_message, load_frames
 
 
-def execute(inputfile, outputfile):
+def execute(inputfile, outputfile, fnfile=None):
     """ Executor.
     Args: name of the inputfile, which is a pickled object that contains
     the function to be executed, it's args, kwargs etc.
     name of the outputfile, where the outputs from the computation are to
     be pickled are written
+    name of the fnfile, a pickled packed function, for inputs that were packed
+    without their function
 
     """
 
-    all_names = dir(__builtins__)
+    # __builtins__ is a dict rather than the module when this file is imported
+    all_names = dir(builtins)
     user_ns   = locals()
-    user_ns.update( {'__builtins__' : {k : getattr(__builtins__, k)  for k in all_names} } )
+    user_ns.update( {'__builtins__' : {k : getattr(builtins, k)  for k in all_names} } )
 
-    bufs = None
-    with open(inputfile, 'rb') as pickled_bufs:
-        bufs = pickle.load(pickled_bufs)
+    # Framed inputs are memory-mapped, and their buffers used in place
+    bufs = load_frames(inputfile)
+    if bufs is None:
+        with open(inputfile, 'rb') as pickled_bufs:
+            bufs = pickle.load(pickled_bufs)
 
-    f, args, kwargs = unpack_apply_message(bufs, user_ns, copy=False)
+    fbuf = None
+    if fnfile:
+        with open(fnfile, 'rb') as pickled_fn:
+            fbuf = pickle.load(pickled_fn)
+
+    f, args, kwargs = unpack_apply_message(bufs, user_ns, copy=False, fbuf=fbuf)
 
     fname = getattr(f, '__name__', 'f')
     prefix     = "kotta_"
@@ -67,8 +79,9 @@ if __name__ == "__main__":
     parser   = argparse.ArgumentParser()
     parser.add_argument("-i", "--inputfile",  help="Serialized input", required=True)
     parser.add_argument("-o", "--outputfile", help="Serialized output file")
+    parser.add_argument("-f", "--fnfile",     help="Serialized function, if not in the input")
     parser.add_argument("-v", "--verbose",  dest='verbose',
                         action='store_true', help="Verbose output")
     args   = parser.parse_args()
 
-    execute(args.inputfile, args.outputfile)
+    execute(args.inputfile, args.outputfile, args.fnfile)
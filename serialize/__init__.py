@@ -1,14 +1,18 @@
 from .canning import (
-    Reference, can_map, uncan_map, can, uncan,
+    Reference, CanningMemo, can_map, uncan_map, can, uncan,
     use_dill, use_cloudpickle, use_pickle,
 )
+from .compression import register_codec
 from .serialize import (
     serialize_object, deserialize_object,
-    pack_apply_message, unpack_apply_message,
+    pack_function, pack_apply_message, unpack_apply_message,
+    BufferRef, offload_buffers, resolve_buffers,
 )
+from .framing import write_frames, read_frames, load_frames, is_framed
 
 __all__ = (
     'Reference',
+    'CanningMemo',
     'can_map',
     'uncan_map',
     'can',
@@ -18,6 +22,15 @@ __all__ = (
     'use_pickle',
     'serialize_object',
     'deserialize_object',
+    'pack_function',
     'pack_apply_message',
     'unpack_apply_message',
+    'register_codec',
+    'BufferRef',
+    'offload_buffers',
+    'resolve_buffers',
+    'write_frames',
+    'read_frames',
+    'load_frames',
+    'is_framed',
 )
\ No newline at end of file
@@ -0,0 +1,101 @@
+"""benchmarks of the serialize package
+
+Run with ``python -m serialize.benchmark``. Needs numpy.
+
+Compares serialize_object with protocol 5 out-of-band buffers (oob=True) against
+the canning-only path (oob=False). For each case, the table shows the time to
+serialize and deserialize, how many bytes were copied into pickles, and how many
+buffers travelled out-of-band.
+
+Then compares can/uncan of argument lists with the per-type dispatch cache of
+can_map and uncan_map against the uncached linear scan of the maps.
+"""
+
+import argparse
+import time
+
+from . import canning
+from .serialize import serialize_object, deserialize_object, _nbytes
+
+def cases():
+    """name -> object to serialize"""
+    import numpy as np
+    return {
+        'one 64MB array': np.ones(8 * 1024 * 1024),
+        'list of 1000 64KB arrays': [np.ones(8 * 1024) for _ in range(1000)],
+        'nested dict of 16 4MB arrays': {
+            'group%i' % i: {'a': np.ones(512 * 1024), 'b': np.ones(512 * 1024)}
+            for i in range(8)
+        },
+        'list of 100000 ints': list(range(100000)),
+    }
+
+def measure(obj, oob, repeat):
+    """best (serialize seconds, deserialize seconds), pickled bytes, buffers"""
+    best_s = best_d = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        bufs = serialize_object(obj, oob=oob)
+        best_s = min(best_s, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        deserialize_object(bufs)
+        best_d = min(best_d, time.perf_counter() - start)
+
+    pickled = _nbytes(bufs[0])
+    return best_s, best_d, pickled, len(bufs) - 1
+
+def dispatch_cases():
+    """name -> list of arguments, as long as KottaFn's item_threshold"""
+    import numpy as np
+    return {
+        '1023 ints': list(range(1023)),
+        '1023 mixed': [[1, 'a', 2.5, None, b'x', (1, 2), {'k': 1}, np.ones(2)][i % 8]
+                       for i in range(1023)],
+    }
+
+def measure_dispatch(args, cached, repeat):
+    """best (can seconds, uncan seconds) of a sequence, with or without dispatch caches"""
+    saved = canning.can_map, canning.uncan_map
+    if not cached:
+        # plain dicts have no dispatch cache
+        canning.can_map, canning.uncan_map = dict(saved[0]), dict(saved[1])
+    try:
+        best_c = best_u = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            canned = canning.can_sequence(args)
+            best_c = min(best_c, time.perf_counter() - start)
+
+            start = time.perf_counter()
+            canning.uncan_sequence(canned)
+            best_u = min(best_u, time.perf_counter() - start)
+    finally:
+        canning.can_map, canning.uncan_map = saved
+    return best_c, best_u
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-r", "--repeat", type=int, default=5,
+                        help="runs per case, the best is reported")
+    args = parser.parse_args(argv)
+
+    row = "{0:<30} {1:<8} {2:>12} {3:>14} {4:>14} {5:>8}"
+    print(row.format('case', 'path', 'dumps ms', 'loads ms', 'pickled bytes', 'buffers'))
+    for name, obj in cases().items():
+        for label, oob in (('canning', False), ('oob', True)):
+            dumps, loads, pickled, nbufs = measure(obj, oob, args.repeat)
+            print(row.format(name, label, "%.2f" % (dumps * 1e3), "%.2f" % (loads * 1e3),
+                             pickled, nbufs))
+
+    print()
+    row = "{0:<30} {1:<8} {2:>12} {3:>14}"
+    print(row.format('case', 'dispatch', 'can ms', 'uncan ms'))
+    canning.can(None)   # resolve the string keys of the maps first
+    for name, seq in dispatch_cases().items():
+        for label, cached in (('scan', False), ('cached', True)):
+            can_s, uncan_s = measure_dispatch(seq, cached, args.repeat)
+            print(row.format(name, label, "%.3f" % (can_s * 1e3), "%.3f" % (uncan_s * 1e3)))
+
+if __name__ == '__main__':
+    main()
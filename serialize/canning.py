@@ -6,6 +6,8 @@
 
 import copy
 import sys
+import pickle
+import threading
 from types import FunctionType
 
 from ipython_genutils import py3compat
@@ -67,6 +69,7 @@ def use_dill():
     serialize.pickle = dill
     
     # disable special function handling, let dill take care of it
+    # (changing can_map also invalidates its dispatch cache)
     can_map.pop(FunctionType, None)
 
 
@@ -81,6 +84,7 @@ def use_cloudpickle():
     serialize.pickle = cloudpickle
     
     # disable special function handling, let cloudpickle take care of it
+    # (changing can_map also invalidates its dispatch cache)
     can_map.pop(FunctionType, None)
 
 
@@ -102,6 +106,9 @@ def use_pickle():
 
 
 class CannedObject(object):
+    # position in the CanningMemo of the message it was canned for, if any
+    memo_key = None
+    
     def __init__(self, obj, keys=[], hook=None):
         """can an object for safe pickling
         
@@ -127,6 +134,22 @@ class CannedObject(object):
         
         self.buffers = []
 
+    def __reduce_ex__(self, protocol):
+        # Buffers are pulled out of the canned objects of a message before it is
+        # pickled, but not of those nested in others, eg. an array in a closure
+        # cell. Their memoryviews are pickled as PickleBuffers, which protocol 5
+        # can send out-of-band, or else as bytes.
+        reduced = object.__reduce_ex__(self, protocol)
+        state = reduced[2] if len(reduced) > 2 else None
+        if not state or not any(isinstance(buf, memoryview) for buf in state.get('buffers') or ()):
+            return reduced
+        if protocol >= 5 and hasattr(pickle, 'PickleBuffer'):
+            wrap = pickle.PickleBuffer
+        else:
+            wrap = buffer_to_bytes
+        buffers = [wrap(buf) if isinstance(buf, memoryview) else buf for buf in state['buffers']]
+        return reduced[:2] + (dict(state, buffers=buffers),) + reduced[3:]
+    
     def get_object(self, g=None):
         if g is None:
             g = {}
@@ -158,6 +181,23 @@ class Reference(CannedObject):
         return eval(self.name, g)
 
 
+class CannedRef(CannedObject):
+    """stands for an object that was canned earlier in the same message,
+    and already uncanned by the time this is"""
+    def __init__(self, key):
+        self.key = key
+        self.buffers = []
+    
+    def __repr__(self):
+        return "<CannedRef: %r>"%self.key
+    
+    def get_object(self, g=None):
+        memo = _active_memo()
+        if memo is None or self.key not in memo.objects:
+            raise ValueError("%r uncanned outside of the message it refers to" % self)
+        return memo.objects[self.key]
+
+
 class CannedCell(CannedObject):
     """Can a closure cell"""
     def __init__(self, cell):
@@ -238,14 +278,30 @@ class CannedClass(CannedObject):
         return type(self.name, parents, uncan_dict(self._canned_dict, g=g))
 
 class CannedArray(CannedObject):
+    """can a numpy array
+    
+    C and Fortran contiguous arrays are sent as their buffer, without copying.
+    Other views are sent as the extent of memory they span, with their strides,
+    if that is at most max_extent times their size, and copied to C order if not.
+    With the default of 1, broadcast, reversed and transposed views are sent
+    without a copy, and views that skip elements are copied. Raising it trades
+    bytes sent for the copy, eg. for a view of every other row. Views whose
+    elements share memory, eg. broadcasts, are unpacked read-only.
+    """
+    
+    max_extent = 1
+    
+    # defaults for arrays canned before order and strides were recorded
+    order = 'C'
+    strides = None
+    flipped = ()
+    
     def __init__(self, obj):
         from numpy import ascontiguousarray
         self.shape = obj.shape
         self.dtype = obj.dtype.descr if obj.dtype.fields else obj.dtype.str
         self.pickled = False
-        if sum(obj.shape) == 0:
-            self.pickled = True
-        elif obj.dtype == 'O':
+        if obj.dtype == 'O':
             # can't handle object dtype with buffer approach
             self.pickled = True
         elif obj.dtype.fields and any(dt == 'O' for dt,sz in obj.dtype.fields.values()):
@@ -254,24 +310,82 @@ class CannedArray(CannedObject):
             # just pickle it
             from . import serialize
             self.buffers = [serialize.pickle.dumps(obj, serialize.PICKLE_PROTOCOL)]
-        else:
-            # ensure contiguous
-            obj = ascontiguousarray(obj, dtype=None)
+        elif obj.size == 0:
+            # nothing to send but the shape
+            self.buffers = []
+        elif obj.flags.c_contiguous:
             self.buffers = [buffer(obj)]
+        elif obj.flags.f_contiguous:
+            # the transpose of a Fortran array is a C array of the same memory
+            self.order = 'F'
+            self.buffers = [buffer(obj.T)]
+        else:
+            extent = self._extent(obj)
+            if extent is not None:
+                self.buffers = [buffer(extent)]
+            else:
+                obj = ascontiguousarray(obj, dtype=None)
+                self.buffers = [buffer(obj)]
+    
+    def _extent(self, obj):
+        """the memory spanned by a strided view as a 1-d C array, recording the
+        strides to rebuild the view from it, or None if a copy is cheaper"""
+        from numpy.lib.stride_tricks import as_strided
+        itemsize = obj.dtype.itemsize
+        if any(stride % itemsize for stride in obj.strides):
+            return None
+        # flip axes with negative strides, so that the view starts at the lowest address
+        flipped = tuple(axis for axis, stride in enumerate(obj.strides) if stride < 0)
+        if flipped:
+            obj = obj[tuple(slice(None, None, -1) if axis in flipped else slice(None)
+                            for axis in range(obj.ndim))]
+        span = sum((n - 1) * stride for n, stride in zip(obj.shape, obj.strides))
+        count = span // itemsize + 1
+        if count > self.max_extent * obj.size:
+            return None
+        self.strides = obj.strides
+        self.flipped = flipped
+        return as_strided(obj, shape=(count,), strides=(itemsize,))
+    
+    def _overlapping(self, itemsize):
+        """whether elements of the rebuilt view may share memory : when, in order of
+        stride, an axis does not step past all of the memory of the axes before it"""
+        axes = sorted((stride, n) for n, stride in zip(self.shape, self.strides) if n > 1)
+        span = 0
+        for stride, n in axes:
+            if stride < span + itemsize:
+                return True
+            span += (n - 1) * stride
+        return False
     
     def get_object(self, g=None):
-        from numpy import frombuffer
-        data = self.buffers[0]
+        from numpy import frombuffer, empty
+        from numpy.lib.stride_tricks import as_strided
         if self.pickled:
             from . import serialize
             # we just pickled it
-            return serialize.pickle.loads(buffer_to_bytes_py2(data))
-        else:
-            if not py3compat.PY3 and isinstance(data, memoryview):
-                # frombuffer doesn't accept memoryviews on Python 2,
-                # so cast to old-style buffer
-                data = buffer(data.tobytes())
-            return frombuffer(data, dtype=self.dtype).reshape(self.shape)
+            return serialize.pickle.loads(buffer_to_bytes_py2(self.buffers[0]))
+        if not self.buffers:
+            return empty(self.shape, dtype=self.dtype, order=self.order)
+        data = self.buffers[0]
+        if not py3compat.PY3 and isinstance(data, memoryview):
+            # frombuffer doesn't accept memoryviews on Python 2,
+            # so cast to old-style buffer
+            data = buffer(data.tobytes())
+        arr = frombuffer(data, dtype=self.dtype)
+        if self.strides is not None:
+            arr = as_strided(arr, shape=self.shape, strides=self.strides)
+            if self._overlapping(arr.itemsize):
+                # elements alias each other, eg. in a broadcast, so like numpy's
+                # broadcast_to the view is read-only
+                arr.setflags(write=False)
+            if self.flipped:
+                arr = arr[tuple(slice(None, None, -1) if axis in self.flipped else slice(None)
+                                for axis in range(arr.ndim))]
+            return arr
+        if self.order == 'F':
+            return arr.reshape(self.shape[::-1]).T
+        return arr.reshape(self.shape)
 
 
 class CannedBytes(CannedObject):
@@ -290,6 +404,99 @@ class CannedBuffer(CannedBytes):
 class CannedMemoryView(CannedBytes):
     wrap = memoryview
 
+#-------------------------------------------------------------------------------
+# Identity memo
+#-------------------------------------------------------------------------------
+
+_local = threading.local()
+
+def _active_memo():
+    return getattr(_local, 'memo', None)
+
+class CanningMemo(object):
+    """identity memo of one message, active in the current thread inside a
+    ``with`` block.
+    
+    While canning, an object met again is canned to the same CannedObject,
+    so its buffers are extracted once and pickle keeps the shared reference.
+    Once a part of the message has been pickled, call seal(): objects canned
+    before then are referred to by CannedRef from later parts.
+    
+    While uncanning, each CannedObject is uncanned once, so shared references
+    are restored as the same object. Parts must be uncanned in the order they
+    were canned.
+    
+    Only CannedObjects, eg. arrays, buffers and functions, are memoised by
+    can(). Plain containers are pickled as they are, so a dict or list is
+    shared across parts only when it is itself a part, eg. an argument passed
+    twice, see part(). One that is also nested in another argument, as in
+    ``(d, [d])``, is sent and unpacked once per part it is reached from.
+    """
+    
+    def __init__(self):
+        # id(obj) -> (obj, key, canned), obj is kept so its id is not reused
+        self.canned = {}
+        # key -> uncanned object
+        self.objects = {}
+        self.sealed = 0
+        # id(obj) -> (obj, key) of the first part each object was
+        self.parts = {}
+        self.nparts = 0
+    
+    def __enter__(self):
+        self._outer = _active_memo()
+        _local.memo = self
+        return self
+    
+    def __exit__(self, *exc_info):
+        _local.memo = self._outer
+    
+    def seal(self):
+        """mark everything canned so far as pickled"""
+        self.sealed = len(self.canned)
+    
+    def can(self, canner, obj):
+        hit = self.canned.get(id(obj))
+        if hit is not None:
+            _, key, canned = hit
+            return CannedRef(key) if key < self.sealed else canned
+        canned = canner(obj)
+        if isinstance(canned, CannedObject):
+            # keyed after canning, so that keys follow the order of uncanning
+            canned.memo_key = key = len(self.canned)
+            self.canned[id(obj)] = (obj, key, canned)
+        return canned
+    
+    def uncan(self, obj, g=None):
+        if obj.memo_key is None:
+            return obj.get_object(g)
+        try:
+            return self.objects[obj.memo_key]
+        except KeyError:
+            newobj = self.objects[obj.memo_key] = obj.get_object(g)
+            return newobj
+    
+    def part(self, obj):
+        """record obj as the next part of the message while canning.
+        Returns a CannedRef to the earlier part if obj was one, else None."""
+        key = ('part', self.nparts)
+        self.nparts += 1
+        hit = self.parts.setdefault(id(obj), (obj, key))
+        return CannedRef(hit[1]) if hit[1] != key else None
+    
+    def add_part(self, newobj):
+        """record newobj as the next part of the message while uncanning"""
+        self.objects[('part', self.nparts)] = newobj
+        self.nparts += 1
+
+def _can_with(canner, obj):
+    memo = _active_memo()
+    return canner(obj) if memo is None else memo.can(canner, obj)
+
+def _uncan_canned(obj, g=None):
+    memo = _active_memo()
+    return obj.get_object(g) if memo is None else memo.uncan(obj, g)
+
 #-------------------------------------------------------------------------------
 # Functions
 #-------------------------------------------------------------------------------
@@ -329,6 +536,13 @@ def istype(obj, check):
 def can(obj):
     """prepare an object for pickling"""
     
+    # the canner only depends on the exact type, so it is looked up once per type
+    cache = getattr(can_map, 'dispatch', None)
+    if cache is not None:
+        canner = cache.get(type(obj), _MISSING)
+        if canner is not _MISSING:
+            return obj if canner is None else _can_with(canner, obj)
+    
     import_needed = False
     
     for cls,canner in iteritems(can_map):
@@ -336,7 +550,9 @@ def can(obj):
             import_needed = True
             break
         elif istype(obj, cls):
-            return canner(obj)
+            if cache is not None:
+                cache[type(obj)] = canner
+            return _can_with(canner, obj)
     
     if import_needed:
         # perform can_map imports, then try again
@@ -344,6 +560,8 @@ def can(obj):
         _import_mapping(can_map, _original_can_map)
         return can(obj)
     
+    if cache is not None:
+        cache[type(obj)] = None
     return obj
 
 def can_class(obj):
@@ -375,12 +593,23 @@ def can_sequence(obj):
 def uncan(obj, g=None):
     """invert canning"""
     
+    # isinstance is decided by the type, unless the object fakes its __class__
+    cache = getattr(uncan_map, 'dispatch', None)
+    if cache is not None and obj.__class__ is not type(obj):
+        cache = None
+    if cache is not None:
+        uncanner = cache.get(type(obj), _MISSING)
+        if uncanner is not _MISSING:
+            return obj if uncanner is None else uncanner(obj, g)
+    
     import_needed = False
     for cls,uncanner in iteritems(uncan_map):
         if isinstance(cls, string_types):
             import_needed = True
             break
         elif isinstance(obj, cls):
+            if cache is not None:
+                cache[type(obj)] = uncanner
             return uncanner(obj, g)
     
     if import_needed:
@@ -389,6 +618,8 @@ def uncan(obj, g=None):
         _import_mapping(uncan_map, _original_uncan_map)
         return uncan(obj, g)
     
+    if cache is not None:
+        cache[type(obj)] = None
     return obj
 
 def uncan_dict(obj, g=None):
@@ -418,9 +649,43 @@ def can_dependent(obj):
 # API dictionaries
 #-------------------------------------------------------------------------------
 
+_MISSING = object()
+
+class DispatchMap(dict):
+    """dict of type -> handler, with a cache of which handler applies to each
+    exact type of object, in ``dispatch``.
+    
+    Any change to the dict clears the cache. A map replaced by a plain dict
+    is simply used without a cache.
+    """
+    
+    def __init__(self, *args, **kwargs):
+        super(DispatchMap, self).__init__(*args, **kwargs)
+        self.dispatch = {}
+    
+    def _changed(method):
+        def changed(self, *args, **kwargs):
+            self.dispatch.clear()
+            return method(self, *args, **kwargs)
+        changed.__name__ = method.__name__
+        changed.__doc__ = method.__doc__
+        return changed
+    
+    __setitem__ = _changed(dict.__setitem__)
+    __delitem__ = _changed(dict.__delitem__)
+    pop = _changed(dict.pop)
+    popitem = _changed(dict.popitem)
+    setdefault = _changed(dict.setdefault)
+    update = _changed(dict.update)
+    clear = _changed(dict.clear)
+    if hasattr(dict, '__ior__'):
+        # ``map |= other``, Python 3.9+
+        __ior__ = _changed(dict.__ior__)
+    del _changed
+
 # These dicts can be extended for custom serialization of new objects
 
-can_map = {
+can_map = DispatchMap({
     'numpy.ndarray' : CannedArray,
     FunctionType : CannedFunction,
     bytes : CannedBytes,
@@ -428,14 +693,14 @@ can_map = {
     cell_type : CannedCell,
     class_type : can_class,
     'ipyparallel.dependent': can_dependent,
-}
+})
 if buffer is not memoryview:
     can_map[buffer] = CannedBuffer
 
-uncan_map = {
-    CannedObject : lambda obj, g: obj.get_object(g),
+uncan_map = DispatchMap({
+    CannedObject : _uncan_canned,
     dict : uncan_dict,
-}
+})
 
 # for use in _import_mapping:
 _original_can_map = can_map.copy()
@@ -13,23 +13,20 @@ Reference: A. Tremols, P Cogolo, "Python Cookbook," p 302-305
 # Copyright (c) IPython Development Team.
 # Distributed under the terms of the Modified BSD License.
 
-import sys
 import types
+import marshal
 try:
     import copyreg  # Py 3
 except ImportError:
     import copy_reg as copyreg  # Py 2
 
-def code_ctor(*args):
-    return types.CodeType(*args)
+def code_ctor(data):
+    return marshal.loads(data)
 
 def reduce_code(co):
-    args =  [co.co_argcount, co.co_nlocals, co.co_stacksize,
-            co.co_flags, co.co_code, co.co_consts, co.co_names,
-            co.co_varnames, co.co_filename, co.co_name, co.co_firstlineno,
-            co.co_lnotab, co.co_freevars, co.co_cellvars]
-    if sys.version_info[0] >= 3:
-        args.insert(1, co.co_kwonlyargcount)
-    return code_ctor, tuple(args)
+    # marshal knows the fields of code objects of the running version, which the
+    # CodeType constructor has changed in most releases. Like marshal data, a
+    # pickled code object only loads on the same Python version.
+    return code_ctor, (marshal.dumps(co),)
 
 copyreg.pickle(types.CodeType, reduce_code)
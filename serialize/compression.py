@@ -0,0 +1,99 @@
+"""compression of the buffers of apply messages
+
+Codecs are registered by name. Buffers of a message at least ``min_size`` bytes long
+are compressed, large ones in parallel threads since the stdlib codecs release the GIL.
+A buffer is only replaced when compressing it saves space, and the indices of the
+replaced buffers are recorded so that they can be decompressed on the other side.
+"""
+
+import bz2
+import lzma
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+MIN_SIZE = 64 * 1024
+PARALLEL_SIZE = 1024 * 1024
+
+_codecs = {}
+
+def register_codec(name, compress, decompress):
+    """register a codec
+
+    compress(data, level) must return bytes, level may be None for the default.
+    decompress(data) must return the original bytes.
+    """
+    _codecs[name] = (compress, decompress)
+
+def get_codec(name):
+    """returns the (compress, decompress) pair registered as name"""
+    try:
+        return _codecs[name]
+    except KeyError:
+        raise ValueError("Unknown compression codec %r, known codecs are %s"
+                         % (name, sorted(_codecs)))
+
+register_codec('zlib',
+               lambda data, level: zlib.compress(data, 6 if level is None else level),
+               zlib.decompress)
+register_codec('bz2',
+               lambda data, level: bz2.compress(data, 9 if level is None else level),
+               bz2.decompress)
+register_codec('lzma',
+               lambda data, level: lzma.compress(data, preset=level),
+               lzma.decompress)
+
+def _nbytes(buf):
+    return buf.nbytes if isinstance(buf, memoryview) else len(buf)
+
+def compress_buffers(bufs, codec='zlib', level=None, min_size=MIN_SIZE,
+                     parallel_size=PARALLEL_SIZE, max_workers=4, skip=()):
+    """compress the buffers of a message
+
+    Parameters
+    ----------
+
+    bufs : list of bytes/buffers
+    codec : name of a registered codec
+    level : codec specific compression level, None for the codec's default
+    min_size : buffers smaller than this many bytes are left alone
+    parallel_size : buffers at least this large are compressed in worker threads
+    max_workers : number of worker threads
+    skip : indices of buffers that must not be compressed
+
+    Returns
+    -------
+
+    (bufs, indices) : new list of buffers, and the indices of the compressed ones
+    """
+    compress, _ = get_codec(codec)
+    bufs = list(bufs)
+    todo = [i for i, buf in enumerate(bufs)
+            if i not in skip and _nbytes(buf) >= min_size]
+    if not todo:
+        return bufs, []
+
+    big = [i for i in todo if _nbytes(bufs[i]) >= parallel_size]
+    compressed = {}
+    if len(big) > 1 and max_workers > 1:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(big))) as pool:
+            for i, data in zip(big, pool.map(lambda i: compress(bufs[i], level), big)):
+                compressed[i] = data
+    for i in todo:
+        if i not in compressed:
+            compressed[i] = compress(bufs[i], level)
+
+    indices = []
+    for i in todo:
+        # incompressible data is sent as is
+        if len(compressed[i]) < _nbytes(bufs[i]):
+            bufs[i] = compressed[i]
+            indices.append(i)
+    return bufs, indices
+
+def decompress_buffers(bufs, codec, indices):
+    """undo compress_buffers, returns a new list of buffers"""
+    _, decompress = get_codec(codec)
+    bufs = list(bufs)
+    for i in indices:
+        bufs[i] = decompress(bufs[i])
+    return bufs
@@ -0,0 +1,107 @@
+"""framed binary container for the buffers of an apply message
+
+Layout, all integers little-endian:
+
+    header  : magic b'KFRM', version (u16), flags (u16), number of frames (u32)
+    table   : per frame, offset (u64), length (u64), kind (u8), 7 bytes padding
+    frames  : the raw bytes of each frame, each starting at a multiple of ALIGNMENT
+
+A frame of kind FRAME_DATA holds a buffer as is. A frame of kind FRAME_REF holds a
+BufferRef, as its nbytes (u64) followed by its utf-8 name.
+
+Unlike a pickled list of buffers, a container can be memory-mapped and its buffers
+handed out as memoryviews of the mapping, so loading it copies nothing.
+"""
+
+import mmap
+import struct
+
+from .serialize import BufferRef, _nbytes
+
+FRAME_MAGIC = b'KFRM'
+FRAME_VERSION = 1
+ALIGNMENT = 64
+
+FRAME_DATA = 0
+FRAME_REF = 1
+
+_HEADER = struct.Struct('<4sHHI')
+_ENTRY = struct.Struct('<QQB7x')
+_REF = struct.Struct('<Q')
+
+def _aligned(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+def _frame(buf):
+    """(kind, bytes-like) of one buffer"""
+    if isinstance(buf, BufferRef):
+        return FRAME_REF, _REF.pack(buf.nbytes) + buf.name.encode('utf-8')
+    if isinstance(buf, memoryview):
+        return FRAME_DATA, buf.cast('B') if buf.ndim != 1 or buf.format != 'B' else buf
+    return FRAME_DATA, buf
+
+def write_frames(bufs, fileobj):
+    """write a list of buffers and BufferRefs to fileobj as a framed container.
+
+    fileobj only needs a write method, the buffers are written without copies.
+    Returns the number of bytes written.
+    """
+    frames = [_frame(buf) for buf in bufs]
+    offset = _aligned(_HEADER.size + _ENTRY.size * len(frames))
+    table = []
+    for kind, data in frames:
+        table.append(_ENTRY.pack(offset, _nbytes(data), kind))
+        offset = _aligned(offset + _nbytes(data))
+
+    head = _HEADER.pack(FRAME_MAGIC, FRAME_VERSION, 0, len(frames)) + b''.join(table)
+    fileobj.write(head)
+    written = len(head)
+    for (kind, data), entry in zip(frames, table):
+        start = _ENTRY.unpack(entry)[0]
+        fileobj.write(b'\0' * (start - written))
+        fileobj.write(data)
+        written = start + _nbytes(data)
+    return written
+
+def is_framed(data):
+    """whether data, eg. the first bytes of a file, starts a framed container"""
+    return bytes(data[:len(FRAME_MAGIC)]) == FRAME_MAGIC
+
+def read_frames(data):
+    """the buffers and BufferRefs of the framed container in data.
+
+    Data frames are returned as memoryviews of data, not copies.
+    """
+    data = memoryview(data).cast('B')
+    magic, version, _, count = _HEADER.unpack_from(data)
+    if magic != FRAME_MAGIC:
+        raise ValueError("not a framed container")
+    if version > FRAME_VERSION:
+        raise ValueError("framed container version %i is newer than %i"
+                         % (version, FRAME_VERSION))
+
+    bufs = []
+    for i in range(count):
+        offset, length, kind = _ENTRY.unpack_from(data, _HEADER.size + i * _ENTRY.size)
+        frame = data[offset:offset + length]
+        if kind == FRAME_REF:
+            nbytes, = _REF.unpack_from(frame)
+            bufs.append(BufferRef(bytes(frame[_REF.size:]).decode('utf-8'), nbytes))
+        else:
+            bufs.append(frame)
+    return bufs
+
+def load_frames(path):
+    """memory-map the file at path and return its buffers, see read_frames.
+
+    The mapping is copy-on-write: the buffers are writable, like those of a
+    message read into memory, but writes only copy the pages they touch and
+    never reach the file.
+
+    Returns None if the file is not a framed container.
+    """
+    with open(path, 'rb') as f:
+        if not is_framed(f.read(len(FRAME_MAGIC))):
+            return None
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    return read_frames(memoryview(mapped))
@@ -16,17 +16,27 @@ try:
 except AttributeError:
     PICKLE_PROTOCOL = pickle.HIGHEST_PROTOCOL
 
+import mmap
+import struct
 from itertools import chain
 
 from ipython_genutils.py3compat import PY3, buffer_to_bytes_py2
 from .canning import (
-    can, uncan, can_sequence, uncan_sequence, CannedObject,
-    istype, sequence_types,
+    can, uncan, can_sequence, uncan_sequence, CannedObject, CanningMemo,
+    istype, sequence_types, _active_memo,
 )
+from .compression import compress_buffers, decompress_buffers, MIN_SIZE
 
 MAX_ITEMS = 64
 MAX_BYTES = 1024
 
+# Prefix of every serialized object, followed by the number of its protocol 5
+# out-of-band buffers, 0 without oob, and whether a container was canned item
+# by item. Pickles of protocol 2 and up, written by older versions without the
+# prefix, start with b'\x80' instead.
+OOB_MAGIC = b'KOB5'
+OOB_HEADER = struct.Struct('<4sI?')
+
 if PY3:
     buffer = memoryview
 
@@ -55,6 +65,9 @@ def _extract_buffers(obj, threshold=MAX_BYTES):
     buffers = []
     if isinstance(obj, CannedObject) and obj.buffers:
         for i, buf in enumerate(obj.buffers):
+            if buf is None:
+                # already extracted, the object is shared
+                continue
             nbytes = _nbytes(buf)
             if nbytes > threshold:
                 # buffer larger than threshold, prevent pickling
@@ -75,7 +88,88 @@ def _restore_buffers(obj, buffers):
             if buf is None:
                 obj.buffers[i] = buffers.pop(0)
 
-def serialize_object(obj, buffer_threshold=MAX_BYTES, item_threshold=MAX_ITEMS):
+class BufferRef(object):
+    """stands in a message for a buffer that is shipped separately, as the file `name`"""
+
+    def __init__(self, name, nbytes):
+        self.name = name
+        self.nbytes = nbytes
+
+    def __repr__(self):
+        return "BufferRef(%r, %i)" % (self.name, self.nbytes)
+
+def offload_buffers(bufs, store, threshold, skip=(1,)):
+    """replace the buffers of a message that are at least threshold bytes long
+    by BufferRefs.
+
+    store(buf) is called with each of them, ships the buffer separately,
+    and returns the name of the file it will be available as.
+    Buffers at the indices in skip (by default pinfo) are kept.
+    """
+    bufs = list(bufs)
+    for i, buf in enumerate(bufs):
+        nbytes = _nbytes(buf)
+        if i not in skip and nbytes >= threshold:
+            bufs[i] = BufferRef(store(buf), nbytes)
+    return bufs
+
+def _map_file(ref):
+    """memory-map the file of a BufferRef, copy-on-write so that arrays built on it
+    stay writable without changing the file"""
+    with open(ref.name, 'rb') as f:
+        if ref.nbytes == 0:
+            return bytearray()
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY))
+
+def resolve_buffers(bufs, load=None):
+    """replace the BufferRefs in a message by their buffers
+
+    load(ref) returns the buffer of a BufferRef. By default the file ref.name
+    is memory-mapped, so the data is only paged in as it is used.
+    """
+    load = load or _map_file
+    return [load(buf) if isinstance(buf, BufferRef) else buf for buf in bufs]
+
+def _dumps_oob(cobj, threshold, itemwise):
+    """pickle cobj with protocol 5, sending contiguous buffers larger than
+    threshold out-of-band, wherever they are nested.
+    itemwise records whether cobj is a container canned item by item.
+
+    Returns (header + pickle, [out-of-band buffers])
+    """
+    oob = []
+
+    def buffer_callback(pickle_buffer):
+        try:
+            raw = pickle_buffer.raw()
+        except BufferError:
+            # not contiguous, pickle it in-band
+            return True
+        if raw.nbytes <= threshold:
+            return True
+        oob.append(raw)
+        return False
+
+    data = pickle.dumps(cobj, 5, buffer_callback=buffer_callback)
+    return OOB_HEADER.pack(OOB_MAGIC, len(oob), itemwise) + data, oob
+
+def _loads(bufs):
+    """unpickle the first of bufs, and the out-of-band buffers that follow it.
+    Returns (object, whether it was canned item by item or None if unknown,
+    remaining bufs)
+    """
+    pobj = buffer_to_bytes_py2(bufs.pop(0))
+    if bytes(pobj[:len(OOB_MAGIC)]) != OOB_MAGIC:
+        return pickle.loads(pobj), None, bufs
+    _, count, itemwise = OOB_HEADER.unpack(bytes(pobj[:OOB_HEADER.size]))
+    data = memoryview(pobj)[OOB_HEADER.size:]
+    if not count:
+        # also readable by Python older than 3.8, which has no buffers argument
+        return pickle.loads(data), itemwise, bufs
+    oob, bufs = bufs[:count], bufs[count:]
+    return pickle.loads(data, buffers=oob), itemwise, bufs
+
+def serialize_object(obj, buffer_threshold=MAX_BYTES, item_threshold=MAX_ITEMS, oob=True):
     """Serialize an object into a list of sendable buffers.
 
     Parameters
@@ -90,17 +184,36 @@ def serialize_object(obj, buffer_threshold=MAX_BYTES, item_threshold=MAX_ITEMS):
         The maximum number of items over which canning will iterate.
         Containers (lists, dicts) larger than this will be pickled without
         introspection.
+    oob : bool
+        Pickle with protocol 5 so that contiguous buffers larger than
+        buffer_threshold at any depth, eg. arrays in a large list, are sent
+        out-of-band instead of being copied into the pickle.
+        Needs Python 3.8 or later on both ends.
+
+    Objects referenced more than once are canned once. Within pack_apply_message,
+    this holds across all of the arguments of the message for arrays, buffers and
+    other canned objects, and for any object passed as more than one argument.
 
     Returns
     -------
     [bufs] : list of buffers representing the serialized object.
     """
+    memo = _active_memo()
+    if memo is None:
+        with CanningMemo():
+            return serialize_object(obj, buffer_threshold, item_threshold, oob)
+
     buffers = []
-    if istype(obj, sequence_types) and len(obj) < item_threshold:
+    ref = memo.part(obj)
+    itemwise = ref is None and istype(obj, sequence_types + (dict,)) and len(obj) < item_threshold
+    if ref is not None:
+        # the same object as an earlier part
+        cobj = ref
+    elif itemwise and istype(obj, sequence_types):
         cobj = can_sequence(obj)
         for c in cobj:
             buffers.extend(_extract_buffers(c, buffer_threshold))
-    elif istype(obj, dict) and len(obj) < item_threshold:
+    elif itemwise:
         cobj = {}
         for k in sorted(obj):
             c = can(obj[k])
@@ -110,7 +223,13 @@ def serialize_object(obj, buffer_threshold=MAX_BYTES, item_threshold=MAX_ITEMS):
         cobj = can(obj)
         buffers.extend(_extract_buffers(cobj, buffer_threshold))
 
-    buffers.insert(0, pickle.dumps(cobj, PICKLE_PROTOCOL))
+    if oob and _stdlib_pickle.HIGHEST_PROTOCOL >= 5:
+        pobj, oob_buffers = _dumps_oob(cobj, buffer_threshold, itemwise)
+        buffers = [pobj] + oob_buffers + buffers
+    else:
+        header = OOB_HEADER.pack(OOB_MAGIC, 0, itemwise)
+        buffers.insert(0, header + pickle.dumps(cobj, PICKLE_PROTOCOL))
+    memo.seal()
     return buffers
 
 def deserialize_object(buffers, g=None):
@@ -128,26 +247,49 @@ def deserialize_object(buffers, g=None):
 
     (newobj, bufs) : unpacked object, and the list of remaining unused buffers.
     """
+    memo = _active_memo()
+    if memo is None:
+        with CanningMemo():
+            return deserialize_object(buffers, g)
+
     bufs = list(buffers)
-    pobj = buffer_to_bytes_py2(bufs.pop(0))
-    canned = pickle.loads(pobj)
-    if istype(canned, sequence_types) and len(canned) < MAX_ITEMS:
+    canned, itemwise, bufs = _loads(bufs)
+    if itemwise is None:
+        # not recorded by older messages, assume the default item_threshold
+        itemwise = istype(canned, sequence_types + (dict,)) and len(canned) < MAX_ITEMS
+    if itemwise and istype(canned, sequence_types):
         for c in canned:
             _restore_buffers(c, bufs)
         newobj = uncan_sequence(canned, g)
-    elif istype(canned, dict) and len(canned) < MAX_ITEMS:
+    elif itemwise and istype(canned, dict):
+        # restore every buffer first, an entry may share a canned object with another
+        for k in sorted(canned):
+            _restore_buffers(canned[k], bufs)
         newobj = {}
         for k in sorted(canned):
-            c = canned[k]
-            _restore_buffers(c, bufs)
-            newobj[k] = uncan(c, g)
+            newobj[k] = uncan(canned[k], g)
     else:
         _restore_buffers(canned, bufs)
         newobj = uncan(canned, g)
 
+    memo.add_part(newobj)
     return newobj, bufs
 
-def pack_apply_message(f, args, kwargs, buffer_threshold=MAX_BYTES, item_threshold=MAX_ITEMS):
+def pack_function(f):
+    """can and pickle a function on its own, to be shipped separately from
+    messages packed with ``pack_apply_message(None, ...)``"""
+    with CanningMemo():
+        return pickle.dumps(can(f), PICKLE_PROTOCOL)
+
+def _pack_function(f, memo):
+    """pack_function within the memo of a message"""
+    pf = pickle.dumps(can(f), PICKLE_PROTOCOL)
+    memo.seal()
+    return pf
+
+def pack_apply_message(f, args, kwargs, buffer_threshold=MAX_BYTES, item_threshold=MAX_ITEMS,
+                       compression=None, compression_threshold=MIN_SIZE, compression_level=None,
+                       compression_workers=4, oob=True):
     """pack up a function, args, and kwargs to be sent over the wire
 
     Each element of args/kwargs will be canned for special treatment,
@@ -161,46 +303,90 @@ def pack_apply_message(f, args, kwargs, buffer_threshold=MAX_BYTES, item_thresho
     [ cf, pinfo, <arg_bufs>, <kwarg_bufs> ]
 
     With length at least two + len(args) + len(kwargs)
+
+    If f is None, cf is left empty and the function, packed by pack_function,
+    must be passed to unpack_apply_message as fbuf.
+
+    If compression names a codec registered in serialize.compression, buffers of at
+    least compression_threshold bytes are compressed, the largest in up to
+    compression_workers threads. pinfo is never compressed, and records the codec
+    and which buffers were compressed for unpack_apply_message.
+
+    oob is passed to serialize_object for each argument. Set it to False when the
+    message is unpacked by Python older than 3.8. Messages with a Python function
+    already need the Python version that packed them, see codeutil.
+
+    An object passed as several arguments, and an array, buffer or other canned
+    object referenced from several arguments or from f and an argument, is sent
+    once and unpacked as one shared object. A plain dict or list nested inside
+    arguments is shared only within the argument it is nested in, so with
+    ``args=(d, [d])`` the list holds a copy of d.
     """
 
-    arg_bufs = list(chain.from_iterable(
-        serialize_object(arg, buffer_threshold, item_threshold) for arg in args))
+    with CanningMemo() as memo:
+        # f first, since it is unpacked first
+        pf = _pack_function(f, memo) if f is not None else b''
+
+        arg_bufs = list(chain.from_iterable(
+            serialize_object(arg, buffer_threshold, item_threshold, oob) for arg in args))
 
-    kw_keys = sorted(kwargs.keys())
-    kwarg_bufs = list(chain.from_iterable(
-        serialize_object(kwargs[key], buffer_threshold, item_threshold) for key in kw_keys))
+        kw_keys = sorted(kwargs.keys())
+        kwarg_bufs = list(chain.from_iterable(
+            serialize_object(kwargs[key], buffer_threshold, item_threshold, oob)
+            for key in kw_keys))
 
     info = dict(nargs=len(args), narg_bufs=len(arg_bufs), kw_keys=kw_keys)
 
-    msg = [pickle.dumps(can(f), PICKLE_PROTOCOL)]
-    msg.append(pickle.dumps(info, PICKLE_PROTOCOL))
+    msg = [pf]
+    msg.append(None)
     msg.extend(arg_bufs)
     msg.extend(kwarg_bufs)
 
+    if compression:
+        msg, compressed = compress_buffers(msg, compression, level=compression_level,
+                                           min_size=compression_threshold,
+                                           max_workers=compression_workers, skip=(1,))
+        if compressed:
+            info['compression'] = dict(codec=compression, buffers=compressed)
+
+    msg[1] = pickle.dumps(info, PICKLE_PROTOCOL)
     return msg
 
-def unpack_apply_message(bufs, g=None, copy=True):
+def unpack_apply_message(bufs, g=None, copy=True, fbuf=None, load=None):
     """unpack f,args,kwargs from buffers packed by pack_apply_message()
+    fbuf is the separately packed function of a message packed without one.
+    BufferRefs left by offload_buffers are resolved with load, see resolve_buffers.
     Returns: original f,args,kwargs"""
-    bufs = list(bufs) # allow us to pop
+    bufs = resolve_buffers(bufs, load)
     assert len(bufs) >= 2, "not enough buffers!"
+    info = pickle.loads(buffer_to_bytes_py2(bufs[1]))
+    if 'compression' in info:
+        bufs = decompress_buffers(bufs, info['compression']['codec'],
+                                  info['compression']['buffers'])
     pf = buffer_to_bytes_py2(bufs.pop(0))
-    f = uncan(pickle.loads(pf), g)
-    pinfo = buffer_to_bytes_py2(bufs.pop(0))
-    info = pickle.loads(pinfo)
+    if not pf:
+        assert fbuf is not None, "message was packed without its function"
+        # packed by pack_function, with a memo of its own
+        with CanningMemo():
+            f = uncan(pickle.loads(buffer_to_bytes_py2(fbuf)), g)
+    bufs.pop(0)
     arg_bufs, kwarg_bufs = bufs[:info['narg_bufs']], bufs[info['narg_bufs']:]
 
-    args = []
-    for i in range(info['nargs']):
-        arg, arg_bufs = deserialize_object(arg_bufs, g)
-        args.append(arg)
-    args = tuple(args)
-    assert not arg_bufs, "Shouldn't be any arg bufs left over"
-
-    kwargs = {}
-    for key in info['kw_keys']:
-        kwarg, kwarg_bufs = deserialize_object(kwarg_bufs, g)
-        kwargs[key] = kwarg
-    assert not kwarg_bufs, "Shouldn't be any kwarg bufs left over"
+    with CanningMemo():
+        if pf:
+            f = uncan(pickle.loads(pf), g)
+
+        args = []
+        for i in range(info['nargs']):
+            arg, arg_bufs = deserialize_object(arg_bufs, g)
+            args.append(arg)
+        args = tuple(args)
+        assert not arg_bufs, "Shouldn't be any arg bufs left over"
+
+        kwargs = {}
+        for key in info['kw_keys']:
+            kwarg, kwarg_bufs = deserialize_object(kwarg_bufs, g)
+            kwargs[key] = kwarg
+        assert not kwarg_bufs, "Shouldn't be any kwarg bufs left over"
 
     return f,args,kwargs
@@ -12,4 +12,5 @@ setup(
     package_data={'': ['LICENSE']},
     packages=['kotta', 'serialize'],
     install_requires=['ipython_genutils', 'requests'],
+    extras_require={'async': ['aiohttp']},
 )
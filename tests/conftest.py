@@ -0,0 +1,62 @@
+""" A local stand-in for the Kotta server and its signed urls, shared by the tests.
+Each test module subclasses StandIn with the requests it answers, and starts it with
+the stand_in fixture.
+"""
+
+import json
+import threading
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+
+class StandIn(BaseHTTPRequestHandler):
+    """ Base of the request handlers, with helpers to read requests and send replies.
+    The server is self.server, with its base url and a lock.
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, code, body, content_type='application/json', headers=()):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        for header in headers:
+            self.send_header(*header)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _form(self):
+        """ The urlencoded form posted in the body, as a dict
+        """
+        return {k : v[0] for k, v in parse_qs(self._body().decode('utf-8')).items()}
+
+
+@pytest.fixture
+def stand_in():
+    """ Returns start(handler, **attributes), which serves handler on a local port and
+    returns the server with the attributes set. Servers stop at the end of the test.
+    """
+    servers = []
+
+    def start(handler, **attributes):
+        httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        httpd.base = 'http://127.0.0.1:{0}'.format(httpd.server_port)
+        httpd.lock = threading.Lock()
+        for name, value in attributes.items():
+            setattr(httpd, name, value)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        servers.append(httpd)
+        return httpd
+
+    yield start
+    for httpd in servers:
+        httpd.shutdown()
+        httpd.server_close()
@@ -0,0 +1,43 @@
+""" Changes to the canning maps take effect for types already dispatched
+"""
+
+import sys
+
+import pytest
+
+from serialize import can, uncan, canning
+from serialize.canning import CannedObject, can_map
+
+
+class Point(object):
+    pass
+
+
+class CannedPoint(CannedObject):
+    def __init__(self, obj):
+        self.buffers = []
+
+    def get_object(self, g=None):
+        return 'point'
+
+
+@pytest.fixture
+def registered():
+    yield
+    can_map.pop(Point, None)
+
+
+def test_setitem_after_lookup(registered):
+    assert isinstance(can(Point()), Point)
+    can_map[Point] = CannedPoint
+    assert uncan(can(Point())) == 'point'
+    del can_map[Point]
+    assert isinstance(can(Point()), Point)
+
+
+@pytest.mark.skipif(sys.version_info < (3, 9), reason="dict |= needs Python 3.9")
+def test_ior_after_lookup(registered):
+    assert isinstance(can(Point()), Point)
+    canning.can_map |= {Point : CannedPoint}
+    assert canning.can_map is can_map
+    assert uncan(can(Point())) == 'point'
@@ -0,0 +1,110 @@
+""" AsyncKotta and AsyncKottaJob against a local stand-in for the Kotta server
+"""
+
+import pickle
+import asyncio
+
+import pytest
+
+pytest.importorskip('aiohttp')
+
+from kotta import Kotta, AsyncKotta, AsyncKottaJob, PollPolicy
+
+from conftest import StandIn
+
+
+class AsyncStandIn(StandIn):
+    """ Answers the REST endpoints of Kotta and serves as the bucket of signed urls
+    """
+
+    def do_POST(self):
+        self._body()
+        if self.path == '/rest/v1/submit_task':
+            self._send(200, {'status' : 'Success', 'job_id' : '77'})
+        elif self.path == '/rest/v1/upload_url':
+            self._send(200, {'upload_url' : self.server.base + '/bucket/key.pkl?signature=x'})
+        else:
+            self._send(404, b'<html>Not found</html>', 'text/html')
+
+    def do_PUT(self):
+        self.server.uploads[self.path.split('?')[0]] = self._body()
+        self._send(200, b'', 'text/plain')
+
+    def do_GET(self):
+        prefix = '/rest/v1/status_task/'
+        if self.path.startswith(prefix) and self.path[len(prefix):] in self.server.polls:
+            jobid = self.path[len(prefix):]
+            self.server.polls[jobid] += 1
+            # job 88 never finishes
+            done = jobid != '88' and self.server.polls[jobid] > 1
+            status = 'completed' if done else 'pending'
+            link = '<a href="{0}/files/out.pkl">out.pkl</a>'.format(self.server.base)
+            self._send(200, {'status' : status, 'items' : {'0' : {'outputs' : link}}})
+        elif self.path == '/files/out.pkl':
+            self._send(200, pickle.dumps({'answer' : 42}), 'application/octet-stream')
+        else:
+            self._send(404, b'<html>Not found</html>', 'text/html')
+
+
+@pytest.fixture
+def server(stand_in):
+    return stand_in(AsyncStandIn, polls={'77' : 0, '88' : 0}, uploads={})
+
+
+def run(server, coro):
+    async def main():
+        async with AsyncKotta({'access_token' : 'token'}, server_url=server.base) as conn:
+            return await coro(conn)
+    return asyncio.run(main())
+
+
+def test_submit_wait_fetch(server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    async def go(conn):
+        job = AsyncKottaJob(jobname='test', executable='/bin/true')
+        assert await job.submit(conn)
+        assert job.job_id == '77'
+        status = await job.wait(conn, policy=PollPolicy.constant(0.01))
+        return status, job.polls, await job.get_results(conn)
+
+    status, polls, result = run(server, go)
+    assert status == 'completed'
+    assert polls == 2
+    assert result == {'answer' : 42}
+
+
+def test_wait_all_timeout(server):
+    jobs = [AsyncKottaJob(job_id='77'), AsyncKottaJob(job_id='88')]
+    policy = PollPolicy.constant(0.01)
+
+    stati = run(server, lambda conn: conn.wait_all(jobs, maxwait=0.2, policy=policy))
+    assert stati == ['completed', False]
+
+    with pytest.raises(TimeoutError):
+        run(server, lambda conn: conn.wait_all(jobs, timeout=0.2, policy=policy))
+
+
+def test_status_many_with_bad_jobid(server):
+    stati = run(server, lambda conn: conn.status_many(['77', 'nope']))
+    assert stati['77']['status'] == 'pending'
+    assert 'HTTP 404' in stati['nope']['error']
+
+
+def test_status_of_bad_jobid(server):
+    assert run(server, lambda conn: conn.status_task('nope')) == {}
+
+
+def test_failed_submit(server, monkeypatch):
+    monkeypatch.setitem(Kotta.endpoints, 'submit', '/missing')
+    job = AsyncKottaJob(jobname='test')
+    assert not run(server, job.submit)
+    assert job.submitted_at is None
+
+
+def test_upload(server, tmp_path):
+    path = tmp_path / 'data.bin'
+    path.write_bytes(b'payload' * 1000)
+    url = run(server, lambda conn: conn.upload_file(str(path)))
+    assert url == 's3://127/bucket/key.pkl'
+    assert server.uploads['/bucket/key.pkl'] == b'payload' * 1000
@@ -0,0 +1,47 @@
+""" Calls run through serialize and kotta.runner on local worker processes
+"""
+
+import pytest
+
+from kotta import KottaFn, KottaMapError
+from kotta.kotta_backends import LocalBackend, RoutingBackend
+
+
+def make_scaler(factor):
+    def scale(x, offset=1):
+        return x * factor + offset
+    return scale
+
+
+@pytest.fixture
+def local():
+    backend = LocalBackend(max_workers=2)
+    yield backend
+    backend.close()
+
+
+def test_local_backend_runs_closures(local):
+    kfn = KottaFn(None, {}, make_scaler(3), backend=local)
+    assert kfn(2) == 7
+    assert kfn(2, offset=10) == 16
+    assert local.expected_runtime(kfn) is not None
+
+
+def test_routing_backend_runs_cheap_calls_locally(local):
+    router = RoutingBackend(threshold=60, local=local)
+    kfn = KottaFn(None, {}, make_scaler(2), backend=router, block=False)
+    assert router.route(kfn, (1,), {}) is local
+    assert kfn(5).result(timeout=60) == 11
+
+
+def test_local_backend_runs_map(local):
+    def halve(x):
+        if x == 3:
+            raise ValueError("three")
+        return x / 2
+
+    kfn = KottaFn(None, {}, halve, backend=local)
+    results = kfn.map(range(5), chunksize=2)
+    assert results[:3] == [0, 0.5, 1]
+    assert isinstance(results[3], KottaMapError) and 'three' in str(results[3])
+    assert results[4] == 2
@@ -0,0 +1,132 @@
+""" Local caches : ResultCache keys must not change between processes, hits are served from
+the index written by earlier processes, and StatusCache expires non-terminal stati
+"""
+
+import os
+import sys
+import time
+import subprocess
+
+from kotta import ResultCache, UploadCache, StatusCache
+from kotta.kotta_cache import function_digest
+
+MODULE = '''
+def make():
+    labels = {'alpha', 'beta', 'gamma', 'delta'}
+    def classify(word, extra=frozenset({'x', 'y', 'z'})):
+        return word in {'a', 'b', 'c', 'd'} or word in labels or word in extra
+    return classify
+'''
+
+SCRIPT = '''
+import sys
+sys.path.insert(0, sys.argv[1])
+from digested import make
+from kotta import ResultCache, UploadCache
+from kotta.kotta_cache import function_digest
+digest = function_digest(make())
+print(digest)
+print(ResultCache.call_key(digest, ({'p', 'q', 'r', 's'}, [frozenset({'t', 'u', 'v'})]),
+                           {'tags' : {'k', 'l', 'm'}}))
+'''
+
+def digests(tmp_path, seed):
+    env = dict(os.environ, PYTHONHASHSEED=str(seed))
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [root, env.get('PYTHONPATH')]))
+    out = subprocess.check_output([sys.executable, '-c', SCRIPT, str(tmp_path)], env=env)
+    return out.decode('utf-8').split()
+
+
+def test_digests_stable_across_processes(tmp_path):
+    (tmp_path / 'digested.py').write_text(MODULE)
+    runs = [digests(tmp_path, seed) for seed in (0, 1, 2, 12345)]
+    assert all(len(run) == 2 and run[1] != 'None' for run in runs)
+    assert all(run == runs[0] for run in runs)
+
+
+def test_call_key_distinguishes_arguments():
+    digest = function_digest(test_call_key_distinguishes_arguments)
+    assert ResultCache.call_key(digest, ({1, 2},), {}) == ResultCache.call_key(digest, ({2, 1},), {})
+    assert ResultCache.call_key(digest, ({1, 2},), {}) != ResultCache.call_key(digest, ({1, 3},), {})
+    assert ResultCache.call_key(digest, (1,), {'a' : 2}) != ResultCache.call_key(digest, (1,), {'a' : 3})
+
+
+def test_call_key_of_unpicklable_arguments():
+    digest = function_digest(test_call_key_of_unpicklable_arguments)
+    assert ResultCache.call_key(digest, (lambda x: x,), {}) is None
+
+
+def test_eviction_counts_hits_in_other_processes(tmp_path):
+    writer = ResultCache(str(tmp_path), max_entries=2)
+    writer.put('old', 1)
+    writer.put('older', 2)
+    for age, key in enumerate(('old', 'older')):
+        # 'old' was used last, but both long ago
+        writer.index[key]['used'] = 2 - age
+        os.utime(writer._result_path(key), (2 - age, 2 - age))
+
+    # another process uses 'older', which this one does not see in its index
+    assert ResultCache(str(tmp_path)).get('older') == (2, None)
+    writer.put('new', 3)
+    assert writer.get('older') == (2, None)
+    assert writer.get('old') is None
+
+
+def test_processes_sharing_an_index_keep_each_others_entries(tmp_path):
+    first, second = ResultCache(str(tmp_path)), ResultCache(str(tmp_path))
+    assert first.get('k0') is None and second.get('k0') is None
+    first.put('k1', 1)
+    second.put('k2', 2)
+    assert first.get('k2') == (2, None) and second.get('k1') == (1, None)
+    assert sorted(ResultCache(str(tmp_path)).index) == ['k1', 'k2']
+
+    first.invalidate('k2')
+    assert second.get('k2') is None and len(ResultCache(str(tmp_path))) == 1
+    assert sorted(f for f in os.listdir(str(tmp_path)) if f.endswith('.pkl')) == ['k1.pkl']
+
+    index = str(tmp_path / 'uploads.json')
+    first, second = UploadCache(index), UploadCache(index)
+    assert first.get('d0', 1, 'a.buf') is None and second.get('d0', 1, 'a.buf') is None
+    first.put('d1', 3, 'pkl/a.buf', 's3://bucket/a.buf')
+    second.put('d2', 3, 'pkl/b.buf', 's3://bucket/b.buf')
+    assert second.get('d1', 3, 'a.buf') == 's3://bucket/a.buf'
+    assert UploadCache(index).get('d2', 3, 'b.buf') == 's3://bucket/b.buf'
+
+
+def test_upload_cache_hits_repeatedly(tmp_path):
+    index = str(tmp_path / 'uploads.json')
+    cache = UploadCache(index)
+    cache.put('d1', 3, 'pkl/a.buf', 's3://bucket/a.buf')
+
+    assert cache.get('d1', 3, 'a.buf') == 's3://bucket/a.buf'
+    assert cache.get('d1', 3, 'a.buf') == 's3://bucket/a.buf'
+    assert UploadCache(index).get('d1', 3, 'other/a.buf') == 's3://bucket/a.buf'
+
+
+def test_upload_cache_eviction_counts_hits_in_other_processes(tmp_path):
+    index = str(tmp_path / 'uploads.json')
+    writer = UploadCache(index, max_entries=2)
+    writer.put('d1', 3, 'pkl/a.buf', 's3://bucket/a.buf')
+    writer.put('d2', 3, 'pkl/b.buf', 's3://bucket/b.buf')
+
+    # another process uses a.buf, the older upload
+    assert UploadCache(index).get('d1', 3, 'a.buf') == 's3://bucket/a.buf'
+    writer.put('d3', 3, 'pkl/c.buf', 's3://bucket/c.buf')
+    assert writer.get('d1', 3, 'a.buf') == 's3://bucket/a.buf'
+    assert writer.get('d2', 3, 'b.buf') is None
+
+
+def test_status_cache_expires_running_jobs():
+    cache = StatusCache(ttl=0.05)
+    cache.put('1', {'status' : 'pending', 'outputs' : []})
+    cache.put('2', {'status' : 'completed', 'outputs' : ['out.pkl']})
+
+    status = cache.get('1')
+    assert status == {'status' : 'pending', 'outputs' : []}
+    status['outputs'].append('changed')
+    assert cache.get('1')['outputs'] == []
+
+    time.sleep(0.1)
+    assert cache.get('1') is None
+    assert cache.get('2') == {'status' : 'completed', 'outputs' : ['out.pkl']}
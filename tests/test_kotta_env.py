@@ -0,0 +1,103 @@
+""" EnvBundle against a local stand-in for the Kotta server : bundles are keyed by their
+requirement set, built by one job, and reused from the index afterwards
+"""
+
+import pytest
+
+from kotta import Kotta, KottaJobError, EnvBundle
+from kotta.kotta_env import requirements_hash
+
+from conftest import StandIn
+
+
+class BuildStandIn(StandIn):
+    """ Accepts build jobs, which end as server.outcome. A completed build links its
+    bundle in the bucket.
+    """
+
+    def do_POST(self):
+        form = self._form()
+        if self.path == '/rest/v1/submit_task':
+            with self.server.lock:
+                self.server.builds.append(form)
+                job_id = str(len(self.server.builds))
+            self._send(200, {'status' : 'Success', 'job_id' : job_id})
+        else:
+            self._send(404, {'reason' : 'Not found'})
+
+    def do_GET(self):
+        prefix = '/rest/v1/status_task/'
+        if self.path.startswith(prefix):
+            form = self.server.builds[int(self.path[len(prefix):]) - 1]
+            links = ['<a href="https://bucket.s3.amazonaws.com/env/{0}">{0}</a>'.format(name)
+                     for name in form['outputs'].split(',')]
+            items = {str(i) : {'outputs' : link} for i, link in enumerate(links)}
+            outcome = self.server.outcome
+            self._send(200, {'status' : outcome,
+                             'items'  : items if outcome == 'completed' else {}})
+        else:
+            self._send(404, {'reason' : 'Not found'})
+
+
+@pytest.fixture
+def server(stand_in):
+    return stand_in(BuildStandIn, builds=[], outcome='completed')
+
+
+@pytest.fixture
+def conn(server):
+    return Kotta({'access_token' : 'token'}, server_url=server.base)
+
+
+def test_requirements_hash_ignores_order_and_comments():
+    assert requirements_hash('numpy\nscipy==1.5') == requirements_hash(
+        ['# pinned', 'scipy==1.5   # for optimize', '', 'numpy'])
+    assert requirements_hash('numpy\nscipy==1.5') != requirements_hash('numpy\nscipy==1.6')
+
+
+def test_bundle_built_once(conn, server, tmp_path):
+    index = str(tmp_path / 'env_bundles.json')
+    bundle = EnvBundle(conn, 'numpy\nscipy', index_path=index)
+    url = bundle.url()
+    assert url == 's3://bucket/env/{0}'.format(bundle.name)
+    assert len(server.builds) == 1
+    assert 'pip3 install --target kotta_env' in server.builds[0]['script']
+
+    # the same requirement set, in another order, is served from the index
+    assert EnvBundle(conn, 'scipy # solvers\nnumpy', index_path=index).url() == url
+    assert len(server.builds) == 1
+
+    bundle.invalidate()
+    assert bundle.url() == url
+    assert len(server.builds) == 2
+
+
+def test_job_desc_unpacks_bundle(conn, tmp_path):
+    bundle = EnvBundle(conn, 'numpy', index_path=str(tmp_path / 'env_bundles.json'))
+    job_desc = {'inputs' : 's3://bucket/call.pkl', 'script' : 'pip3 install numpy'}
+    desc = bundle.job_desc(job_desc, 'python3 runner.py call.pkl out.pkl')
+
+    assert desc['inputs'] == 's3://bucket/call.pkl,' + bundle.url()
+    assert desc['script'].startswith('#!/bin/bash\n')
+    assert 'tar -xzf {0} -C kotta_env'.format(bundle.name) in desc['script']
+    assert 'pip3' not in desc['script']
+    assert desc['script'].endswith('python3 runner.py call.pkl out.pkl\n')
+    assert job_desc == {'inputs' : 's3://bucket/call.pkl', 'script' : 'pip3 install numpy'}
+
+
+def test_failed_build(conn, server, tmp_path):
+    server.outcome = 'failed'
+    bundle = EnvBundle(conn, 'numpy', index_path=str(tmp_path / 'env_bundles.json'))
+    with pytest.raises(KottaJobError):
+        bundle.url()
+    with pytest.raises(KottaJobError):
+        bundle.url()
+    assert len(server.builds) == 2
+
+
+def test_build_timeout(conn, server, tmp_path):
+    server.outcome = 'pending'
+    bundle = EnvBundle(conn, 'numpy', index_path=str(tmp_path / 'env_bundles.json'),
+                       timeout=0.3)
+    with pytest.raises(TimeoutError):
+        bundle.url()
@@ -0,0 +1,205 @@
+""" KottaFn calls run end to end : packed by the client, uploaded to a stand-in for the
+Kotta server, and executed by the uploaded runner.py and serialize package, as on a node
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from kotta import Kotta, KottaMapError, ResultCache, kottajob
+
+from conftest import StandIn
+
+
+class JobStandIn(StandIn):
+    """ Runs each submitted job on submission, with the command of its job script, in a
+    directory holding its inputs. Uploads are stored under the basename of their key,
+    and the names uploaded and the inputs of each job are recorded.
+    """
+
+    def do_POST(self):
+        form = self._form()
+        if self.path == '/rest/v1/submit_task':
+            with self.server.lock:
+                job_id = str(len(self.server.jobs) + 1)
+                self.server.jobs[job_id] = None
+                self.server.inputs[job_id] = form.get('inputs', '').split(',')
+            self.server.jobs[job_id] = run_job(self.server, form)
+            self._send(200, {'status' : 'Success', 'job_id' : job_id})
+        else:
+            name = os.path.basename(form.get('filepath', 'upload'))
+            self._send(200, {'upload_url' : '{0}/bucket/{1}?signature=x'.format(
+                self.server.base, name)})
+
+    def do_PUT(self):
+        name = os.path.basename(self.path.split('?')[0])
+        with self.server.lock:
+            self.server.puts.append(name)
+        self.server.blobs[name] = self._body()
+        self._send(200, b'', 'text/plain')
+
+    def do_GET(self):
+        prefix = '/rest/v1/status_task/'
+        if self.path.startswith(prefix):
+            outputs = self.server.jobs[self.path[len(prefix):]]
+            items = {str(i) : {'outputs' : '<a href="{0}/files/{1}">{1}</a>'.format(
+                self.server.base, name)} for i, name in enumerate(outputs or ())}
+            status = 'pending' if outputs is None else 'completed' if outputs else 'failed'
+            self._send(200, {'status' : status, 'items' : items})
+        else:
+            self._send(200, self.server.blobs[os.path.basename(self.path)],
+                       'application/octet-stream')
+
+
+def run_job(server, form):
+    """ Runs a job the way exec.sh would, returns the names of the outputs it wrote
+    """
+    args = form['executable'].split()[2:]
+    script = form['script']
+    command = script[script.index('tar -xzf'):]
+    workdir = tempfile.mkdtemp()
+    try:
+        for url in filter(None, form.get('inputs', '').split(',')):
+            with open(os.path.join(workdir, os.path.basename(url)), 'wb') as staged:
+                staged.write(server.blobs[os.path.basename(url)])
+        env = dict(os.environ)
+        env.pop('PYTHONPATH', None)
+        subprocess.run(['bash', '-c', command.replace('python3', sys.executable),
+                        'exec.sh'] + args, cwd=workdir, env=env, check=True)
+        output = os.path.join(workdir, args[1])
+        with open(output, 'rb') as ofile:
+            server.blobs[args[1]] = ofile.read()
+        return [args[1]]
+    except (subprocess.CalledProcessError, IOError):
+        return []
+    finally:
+        shutil.rmtree(workdir)
+
+
+def on_node(f):
+    """ This module is not importable on the node, so its functions are shipped like
+    those of an interactive session, with their closures
+    """
+    f.__module__ = '__main__'
+    return f
+
+
+@pytest.fixture
+def server(stand_in):
+    return stand_in(JobStandIn, jobs={}, blobs={}, puts=[], inputs={})
+
+
+@pytest.fixture
+def conn(server):
+    kconn = Kotta({'access_token' : 'token'}, server_url=server.base)
+    kconn.monitor.interval = 0.1
+    yield kconn
+    kconn.monitor.stop()
+
+
+def test_call(conn):
+    scale = 3
+
+    @kottajob(conn, 'Test', 5)
+    @on_node
+    def affine(x, offset=1):
+        return x * scale + offset
+
+    assert affine(2) == 7
+    assert affine(2, offset=10) == 16
+
+
+def test_call_closing_over_array(conn):
+    np = pytest.importorskip('numpy')
+    table = np.arange(300000.)
+
+    @kottajob(conn, 'Test', 5)
+    @on_node
+    def lookup(i):
+        return float(table[i])
+
+    assert lookup(7) == 7.0
+    assert lookup(9) == 9.0
+
+
+def test_offloaded_argument_uploaded_once(conn, server):
+    np = pytest.importorskip('numpy')
+    table = np.arange(300000.)
+
+    @kottajob(conn, 'Test', 5, offload_threshold=1024*1024)
+    @on_node
+    def total(values, scale=1):
+        import mmap
+        # the node maps the offloaded file instead of reading it into memory
+        base = values
+        while getattr(base, 'base', None) is not None:
+            base = base.base
+        mapped = isinstance(getattr(base, 'obj', base), mmap.mmap)
+        return float(values.sum()) * scale, mapped
+
+    assert total(table) == (table.sum(), True)
+    assert total(table, scale=2) == (2 * table.sum(), True)
+
+    offloaded = [name for name in server.puts if name.endswith('.buf')]
+    assert len(offloaded) == 1
+    assert np.frombuffer(server.blobs[offloaded[0]]).tolist() == table.tolist()
+    for inputs in server.inputs.values():
+        assert [url for url in inputs if url.endswith(offloaded[0])]
+
+
+def test_calls_from_many_threads(conn, server):
+    @kottajob(conn, 'Test', 5)
+    @on_node
+    def square(x):
+        return x * x
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        assert list(pool.map(square, range(16))) == [x * x for x in range(16)]
+
+    # every call staged its own payload and wrote its own result
+    payloads = [url for inputs in server.inputs.values() for url in inputs
+                if url.endswith('.in.pkl')]
+    results = [name for outputs in server.jobs.values() for name in outputs]
+    assert len(server.jobs) == 16
+    assert len(set(payloads)) == 16 and len(set(results)) == 16
+
+
+def test_memoized_call(conn, server, tmp_path):
+    @kottajob(conn, 'Test', 5, memoize=ResultCache(str(tmp_path)))
+    @on_node
+    def square(x):
+        return x * x
+
+    assert square(4) == 16
+    assert len(server.jobs) == 1
+    assert square(4) == 16
+    assert len(server.jobs) == 1
+
+    square.forget()
+    assert square(4) == 16
+    assert len(server.jobs) == 2
+
+
+def test_map(conn):
+    @on_node
+    def halve(x):
+        if x == 3:
+            raise ValueError("three")
+        return x / 2
+
+    results = kottajob(conn, 'Test', 5)(halve).map(range(5), chunksize=2)
+    assert results[:3] == [0, 0.5, 1]
+    assert isinstance(results[3], KottaMapError) and 'three' in str(results[3])
+    assert results[4] == 2
+
+    assert kottajob(conn, 'Test', 5)(divmod).map([7, 9], [2, 4]) == [(3, 1), (2, 1)]
+
+
+def test_map_chunksize(conn):
+    with pytest.raises(ValueError):
+        kottajob(conn, 'Test', 5)(abs).map([1, 2], chunksize=0)
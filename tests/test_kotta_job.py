@@ -0,0 +1,36 @@
+""" PollPolicy learns the runtimes of named jobs, within a bounded history
+"""
+
+import pytest
+
+from kotta import KottaJob, PollPolicy
+
+
+@pytest.fixture
+def history(monkeypatch):
+    monkeypatch.setattr(PollPolicy, 'history', type(PollPolicy.history)())
+    monkeypatch.setattr(PollPolicy, 'history_names', 3)
+    return PollPolicy.history
+
+
+def test_named_jobs_inform_later_polls(history):
+    policy = PollPolicy()
+    job = KottaJob(jobname='square', walltime='x')
+    for runtime in (8, 10, 12):
+        policy.record(policy.history_key(job), runtime)
+    assert policy.expected_ends(job) == [10]
+
+
+def test_unnamed_jobs_are_not_recorded(history):
+    policy = PollPolicy()
+    job = KottaJob()
+    job.job_id = '1234'
+    assert job.jobname == '1234' and policy.history_key(job) is None
+    policy.record(policy.history_key(job), 5)
+    assert not history
+
+
+def test_history_keeps_recent_jobnames(history):
+    for name in ('a', 'b', 'c', 'a', 'd'):
+        PollPolicy.record(name, 1)
+    assert list(history) == ['c', 'a', 'd']
@@ -0,0 +1,87 @@
+""" JobMonitor polls jobs from a background thread, across stop() and restart, and
+completes the KottaFutures watching them
+"""
+
+import threading
+
+import pytest
+
+from kotta import JobMonitor, KottaJob, KottaJobError, KottaFuture
+
+
+class Conn(object):
+    """ Stands in for a Kotta connection. Jobs are pending until finished, and polls
+    block while gate is clear.
+    """
+    pool_size = 2
+
+    def __init__(self):
+        self.done    = set()
+        self.failed  = set()
+        self.gate    = threading.Event()
+        self.polling = threading.Event()
+        self.gate.set()
+
+    def status_many(self, job_ids, executor=None):
+        self.polling.set()
+        self.gate.wait()
+        return {jobid : {'status' : 'failed' if jobid in self.failed else
+                         'completed' if jobid in self.done else 'pending'}
+                for jobid in job_ids}
+
+
+def submitted(jobid):
+    job = KottaJob()
+    job.job_id = jobid
+    job.set_status('pending')
+    return job
+
+
+def test_jobs_added_after_stop_are_polled():
+    conn = Conn()
+    conn.gate.clear()
+    monitor = JobMonitor(conn, interval=0.01)
+    monitor.add(submitted('1'))
+    assert conn.polling.wait(10)
+
+    # stopped in the middle of a sweep, which then finishes after the next add
+    stopper = threading.Thread(target=monitor.stop)
+    stopper.start()
+    while not monitor._stopped.is_set():
+        stopper.join(0.001)
+
+    finished = threading.Event()
+    monitor.add(submitted('2'), callback=lambda job: finished.set())
+    conn.done.update(('1', '2'))
+    conn.gate.set()
+    stopper.join()
+    assert finished.wait(10)
+    assert monitor.wait(10)
+    monitor.stop()
+
+
+def test_stop_from_a_callback():
+    conn = Conn()
+    monitor = JobMonitor(conn, interval=0.01)
+    conn.done.add('1')
+    monitor.add(submitted('1'), callback=lambda job: monitor.stop())
+    assert monitor.wait(10)
+
+    finished = threading.Event()
+    monitor.add(submitted('2'), callback=lambda job: finished.set())
+    conn.done.add('2')
+    assert finished.wait(10)
+    monitor.stop()
+
+
+def test_future_of_failed_job():
+    conn = Conn()
+    monitor = JobMonitor(conn, interval=0.01)
+    future = KottaFuture(submitted('1')).watch(monitor)
+    assert not future.done()
+
+    conn.failed.add('1')
+    with pytest.raises(KottaJobError):
+        future.result(timeout=10)
+    assert not future.cancel()
+    monitor.stop()
@@ -0,0 +1,168 @@
+""" Uploads against a local stand-in for the Kotta server and its signed urls : the upload
+cache, multipart uploads that resume from their manifest, and prefetched signed urls
+"""
+
+import os
+import hashlib
+from urllib.parse import parse_qs
+
+import pytest
+import requests
+
+from kotta import Kotta, UploadCache
+from kotta.kotta_upload import MultipartUpload
+
+from conftest import StandIn
+
+
+class UploadStandIn(StandIn):
+    """ Issues signed urls, with part urls when asked for a multipart upload, and stores
+    what is PUT to them. Parts listed in fail_parts are rejected once, and urls whose
+    signature is in expired are forbidden.
+    """
+
+    def do_POST(self):
+        body = self._body()
+        if self.path == '/rest/v1/upload_url':
+            form = {k : v[0] for k, v in parse_qs(body.decode('utf-8')).items()}
+            name = os.path.basename(form['filepath'])
+            with self.server.lock:
+                self.server.signatures += 1
+                signature = self.server.signatures
+            response = {'upload_url' : '{0}/bucket/{1}?signature={2}'.format(
+                self.server.base, name, signature)}
+            if 'part_count' in form:
+                response['part_urls'] = ['{0}/parts/{1}/{2}?signature={3}'.format(
+                    self.server.base, name, i, signature)
+                                         for i in range(int(form['part_count']))]
+                response['complete_url'] = '{0}/complete/{1}'.format(self.server.base, name)
+            self._send(200, response)
+        elif self.path.startswith('/complete/'):
+            self.server.completed.append(body)
+            self._send(200, b'<CompleteMultipartUploadResult/>', 'application/xml')
+        else:
+            self._send(404, {'reason' : 'Not found'})
+
+    def do_PUT(self):
+        path, query = self.path.split('?')
+        body = self._body()
+        with self.server.lock:
+            self.server.puts.append(path)
+            fail = path in self.server.fail_parts
+            self.server.fail_parts.discard(path)
+        if int(parse_qs(query)['signature'][0]) in self.server.expired:
+            self._send(403, b'<Error><Code>AccessDenied</Code></Error>', 'application/xml')
+            return
+        if fail:
+            self._send(500, b'')
+            return
+        self.server.blobs[path] = body
+        etag = '"{0}"'.format(len(self.server.puts))
+        self._send(200, b'', 'text/plain', headers=[('ETag', etag)])
+
+
+@pytest.fixture
+def server(stand_in):
+    return stand_in(UploadStandIn, puts=[], blobs={}, completed=[], fail_parts=set(),
+                    expired=set(), signatures=0)
+
+
+def connect(server, **kwargs):
+    return Kotta({'access_token' : 'token'}, server_url=server.base, **kwargs)
+
+
+def test_upload_cache_hit_and_miss(server, tmp_path):
+    cache = UploadCache(str(tmp_path / 'uploads.json'))
+    data = tmp_path / 'data.bin'
+    data.write_bytes(b'x' * 1000)
+
+    s3_url = connect(server, upload_cache=cache).upload_file(str(data))
+    assert s3_url.endswith('/data.bin') and len(server.puts) == 1
+    # hits in the same and in a new connection, as long as the contents are unchanged
+    assert connect(server, upload_cache=cache).upload_file(str(data)) == s3_url
+    assert connect(server, upload_cache=cache).upload_file(str(data)) == s3_url
+    assert len(server.puts) == 1
+
+    data.write_bytes(b'y' * 1000)
+    assert connect(server, upload_cache=cache).upload_file(str(data)) == s3_url
+    assert len(server.puts) == 2
+    assert server.blobs['/bucket/data.bin'] == b'y' * 1000
+
+
+def test_upload_cache_hit_for_buffers(server, tmp_path):
+    cache = UploadCache(str(tmp_path / 'uploads.json'))
+    name, s3_url = connect(server, upload_cache=cache).upload_buffer(b'z' * 1000)
+    assert connect(server, upload_cache=cache).upload_buffer(b'z' * 1000) == (name, s3_url)
+    assert len(server.puts) == 1
+
+
+def test_multipart_upload_resumes_from_manifest(server, tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    data = tmp_path / 'large.bin'
+    content = os.urandom(10 * 1024)
+    data.write_bytes(content)
+    kconn = connect(server, multipart_threshold=1024, part_size=4096)
+
+    # the second of three parts fails, without retries
+    upload = MultipartUpload(kconn, str(data), 4096, workers=1, part_retries=0)
+    _, response = kconn.signed_url(str(data), **upload.url_request)
+    assert upload.start(response)
+    server.fail_parts.add('/parts/large.bin/1')
+    with pytest.raises(requests.HTTPError):
+        upload.run()
+    assert sorted(upload.manifest['etags']) == ['1', '3']
+    assert not server.completed
+
+    # upload_file picks up the manifest and only sends the missing part
+    assert kconn.upload_file(str(data)) == 's3://127/bucket/large.bin'
+    assert server.puts[-1] == '/parts/large.bin/1' and len(server.puts) == 4
+    assert b''.join(server.blobs['/parts/large.bin/{0}'.format(i)] for i in range(3)) == content
+    assert len(server.completed) == 1 and server.completed[0].count(b'<Part>') == 3
+    assert not os.path.exists(upload.manifest_path)
+
+
+def test_multipart_upload_hashes_its_parts(server, tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    data = tmp_path / 'large.bin'
+    content = os.urandom(10 * 1024)
+    data.write_bytes(content)
+    cache = UploadCache(str(tmp_path / 'uploads.json'), prehash_limit=1024)
+    kconn = connect(server, multipart_threshold=1024, part_size=4096, upload_cache=cache)
+
+    s3_url = kconn.upload_file(str(data))
+    parts = b''.join(hashlib.sha256(content[i:i + 4096]).digest() for i in range(0, 10240, 4096))
+    assert cache.known_digest(str(data)) == hashlib.sha256(parts).hexdigest() + '-3'
+    assert kconn.upload_file(str(data)) == s3_url and len(server.puts) == 3
+
+
+def test_multipart_upload_restarts_when_part_urls_expire(server, tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    data = tmp_path / 'large.bin'
+    content = os.urandom(10 * 1024)
+    data.write_bytes(content)
+    kconn = connect(server, multipart_threshold=1024, part_size=4096)
+
+    upload = MultipartUpload(kconn, str(data), 4096, workers=1, part_retries=0)
+    _, response = kconn.signed_url(str(data), **upload.url_request)
+    assert upload.start(response)
+    server.fail_parts.add('/parts/large.bin/1')
+    with pytest.raises(requests.HTTPError):
+        upload.run()
+
+    # the urls saved in the manifest are rejected, so all parts go to fresh urls
+    server.expired.add(server.signatures)
+    assert kconn.upload_file(str(data)) == 's3://127/bucket/large.bin'
+    assert len(server.puts) == 3 + 1 + 3
+    assert b''.join(server.blobs['/parts/large.bin/{0}'.format(i)] for i in range(3)) == content
+    assert len(server.completed) == 1
+    assert not os.path.exists(upload.manifest_path)
+
+
+def test_prefetched_urls_are_unique(server):
+    kconn = connect(server, url_prefetch=2)
+    try:
+        reserved = [kconn.reserve_upload() for _ in range(3)]
+    finally:
+        kconn.close()
+    assert len(set(path for path, _ in reserved)) == 3
+    assert all(url and os.path.basename(path) in url for path, url in reserved)
@@ -0,0 +1,108 @@
+""" Apply messages round trip : objects shared between the arguments of a message are
+unpacked as one object, and compressed messages unpack to the original arguments
+"""
+
+import pytest
+
+from serialize import (pack_apply_message, unpack_apply_message, pack_function,
+                       write_frames, load_frames)
+
+np = pytest.importorskip('numpy')
+
+
+@pytest.mark.parametrize('oob', [True, False])
+def test_argument_passed_twice(oob):
+    d, l, a = {'a' : [1, 2]}, [1, {}], np.arange(10)
+    msg = pack_apply_message(len, (d, d, l, a), {'x' : l, 'y' : a}, oob=oob)
+    f, args, kwargs = unpack_apply_message(msg)
+    assert f is len
+    assert args[0] is args[1] and args[0] == d
+    assert kwargs['x'] is args[2] and kwargs['y'] is args[3]
+    assert (args[3] == a).all()
+
+
+def test_array_nested_in_argument():
+    a = np.arange(10)
+    _, args, _ = unpack_apply_message(pack_apply_message(len, ([a], a), {}))
+    assert args[0][0] is args[1]
+
+
+@pytest.mark.parametrize('oob', [True, False])
+def test_function_round_trip(oob):
+    def weigh(items, weight=2.0):
+        return sum(float(a.sum()) for a in items) * weight
+
+    # a large array nested in a list, which only oob sends without a copy
+    items = [np.ones(300000), np.arange(4)]
+    msg = pack_apply_message(weigh, (items,), {'weight' : 0.5}, oob=oob)
+    f, args, kwargs = unpack_apply_message(msg)
+    assert f(*args, **kwargs) == weigh(items, weight=0.5)
+
+
+def test_strided_views(tmp_path):
+    base = np.arange(12.).reshape(4, 3)
+    broadcast = np.broadcast_to(np.arange(3.), (4, 3))
+    msg = pack_apply_message(len, (broadcast, base[::-1]), {}, buffer_threshold=0)
+    # as runner.py reads a payload, copy-on-write
+    with open(tmp_path / 'in.pkl', 'wb') as payload:
+        write_frames(msg, payload)
+    _, (x, reversed_), _ = unpack_apply_message(load_frames(str(tmp_path / 'in.pkl')))
+
+    assert (x == broadcast).all() and not x.flags.writeable
+    with pytest.raises(ValueError):
+        x[0, 0] = -5
+
+    assert (reversed_ == base[::-1]).all() and reversed_.flags.writeable
+    reversed_[0, 0] = -5
+    assert reversed_[3, 0] == 0
+
+
+def test_function_closing_over_array():
+    table = np.arange(300000.)
+
+    def lookup(i, offset=np.ones(3)):
+        return table[i] + offset[0]
+
+    f, args, _ = unpack_apply_message(pack_apply_message(None, (7,), {}),
+                                      fbuf=pack_function(lookup))
+    assert f(*args) == 8
+    f, args, _ = unpack_apply_message(pack_apply_message(lookup, (7,), {}))
+    assert f(*args) == 8
+
+
+@pytest.mark.parametrize('codec', ['zlib', 'bz2', 'lzma'])
+def test_compressed_round_trip(codec):
+    a = np.zeros(100000)
+    text = b'kotta ' * 20000
+    plain = pack_apply_message(len, (a, text), {'small' : b'x'})
+    msg = pack_apply_message(len, (a, text), {'small' : b'x'}, compression=codec)
+    nbytes = lambda bufs: sum(memoryview(buf).nbytes for buf in bufs)
+    assert nbytes(msg) < nbytes(plain) // 10
+
+    f, (x, t), kwargs = unpack_apply_message(msg)
+    assert f is len and (x == a).all() and t == text and kwargs == {'small' : b'x'}
+
+
+@pytest.mark.parametrize('oob', [True, False])
+def test_dict_holding_array_and_its_closure(oob):
+    arr = np.arange(300000.)
+
+    def total():
+        return float(arr.sum())
+
+    msg = pack_apply_message(len, ({'a' : total, 'b' : arr},), {}, oob=oob)
+    _, (d,), _ = unpack_apply_message(msg)
+    assert (d['b'] == arr).all()
+    assert d['a']() == total()
+
+
+@pytest.mark.parametrize('oob', [True, False])
+@pytest.mark.parametrize('size', [10, 3000])
+def test_long_list_canned_item_by_item(oob, size):
+    # as KottaFn packs, with an item_threshold above the default of 64
+    arrays = [np.arange(size) + i for i in range(100)]
+    msg = pack_apply_message(len, (arrays,), {}, buffer_threshold=1024*8,
+                             item_threshold=1024, oob=oob)
+    _, (unpacked,), _ = unpack_apply_message(msg)
+    assert len(unpacked) == 100
+    assert all(isinstance(a, np.ndarray) and (a == b).all() for a, b in zip(unpacked, arrays))